@@ -6,6 +6,18 @@ from logging.handlers import RotatingFileHandler
 
 VERSION = '1.0.2'
 
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def parse_imap_credentials(stream):
+    """
+    Parse YAML IMAP credentials using the libyaml safe loader when it's available
+
+    :param stream: YAML string or file object
+    :return: dict
+    """
+    return yaml.load(stream, Loader=YAMLLoader)
+
 
 def load_imap_credentials(file='.acmagent'):
     home = os.path.expanduser('~')
@@ -13,13 +25,43 @@ def load_imap_credentials(file='.acmagent'):
 
     try:
         with open(filename, 'r') as ymlfile:
-            return yaml.load(ymlfile)
+            return parse_imap_credentials(ymlfile)
     except IOError as e:
         raise MissingIMAPCredentailsException('IMAP credentials file: {} is not found'.format(filename))
-    except yaml.scanner.ScannerError as e:
+    except yaml.YAMLError as e:
         raise InvalidIMAPCredentailsFileException('IMAP credentials file: {} is not valid YAML'.format(filename))
 
 
+def imap_mailboxes(imap_credentials):
+    """
+    Expand IMAP credentials into the list of mailboxes to scan. The credentials can
+    describe a single account or list several accounts under the "accounts" property,
+    every account can specify either a "folder" or a list of "folders"
+
+    :param imap_credentials: parsed IMAP credentials file
+    :return: list of credentials with a single folder each
+    """
+    if isinstance(imap_credentials, dict) and 'accounts' in imap_credentials:
+        accounts = imap_credentials['accounts'] or []
+    else:
+        accounts = [imap_credentials]
+
+    mailboxes = []
+    for account in accounts:
+        if isinstance(account, dict) and 'folders' in account:
+            for folder in account['folders']:
+                mailbox = {k: v for k, v in account.items() if k != 'folders'}
+                mailbox['folder'] = folder
+                mailboxes.append(mailbox)
+        else:
+            mailboxes.append(account)
+
+    if not mailboxes:
+        raise InvalidIMAPCredentailsFileException('IMAP credentials file does not list any accounts')
+
+    return mailboxes
+
+
 def _create_log_filename(filename):
     if os.name == 'nt':
         logdir = os.path.expandvars(r'${SystemDrive}\cfn\log')
@@ -93,6 +135,10 @@ class InvalidCertificateJsonFileException(ACManagerException):
     """Missing required CLI argument exception"""
 
 
+class InvalidCertificateSpecException(ACManagerException):
+    """Raised when the certificate spec fails the pre-flight validation"""
+
+
 class SMTPConnectionFailedException(ACManagerException):
     """Raised when failed to establish connection with SMTP server"""
 
@@ -116,6 +162,25 @@ class EmailBodyConfirmLinkIsMissingException(ACManagerException):
 class ConfirmPageIsMissingFormException(ACManagerException):
     """Raised when confirm page is missing the actual form"""
 
+
+class ConfirmFormRejectedException(ACManagerException):
+    """Raised when the approval site has not accepted the confirmation form"""
+
+
+class CertificateLeasedException(ACManagerException):
+    """Raised when certificate is being confirmed by another worker"""
+
+
+class InvalidLeaseBackendException(ACManagerException):
+    """Raised when lease backend url is not supported"""
+
+
+class OperationTimeoutException(ACManagerException):
+    """Raised when a stage has timed out or the operation deadline has been exceeded"""
+    def __init__(self, message, stage=None):
+        super(OperationTimeoutException, self).__init__(message)
+        self.stage = stage
+
 UserHeaders = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'
 }
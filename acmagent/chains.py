@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent import futures
+from acmagent.inventory import parse_certificate_id
+
+logger = logging.getLogger('acmagent')
+
+
+def normalize_serial(serial):
+    """
+    :param serial: certificate serial number, e.g. 0a:1b:2c
+    :return: lower case serial number without separators, e.g. 0a1b2c
+    """
+    return serial.replace(':', '').lower()
+
+
+class ChainCache(object):
+    """
+    Local cache of certificate and chain PEMs. Every PEM is stored once under objects/ by its
+    sha256 digest, so the intermediates shared by many certificates are kept once, the index
+    of every certificate has one file per serial number and certificate.pem, chain.pem and
+    fullchain.pem links to the PEMs of the newest serial number
+    """
+    DIRECTORY = '.acmagent-chains'
+    LINKS = ('certificate', 'chain', 'fullchain')
+
+    def __init__(self, directory=None):
+        self._directory = directory or os.path.join(os.path.expanduser('~'), ChainCache.DIRECTORY)
+        self._objects = os.path.join(self._directory, 'objects')
+        if not os.path.isdir(self._objects):
+            os.makedirs(self._objects)
+
+    def path(self, certificate_arn):
+        """
+        :param certificate_arn: certificate ARN
+        :return: directory with the certificate.pem, chain.pem and fullchain.pem of the certificate
+        """
+        return os.path.join(self._directory, parse_certificate_id(certificate_arn))
+
+    def object_path(self, digest):
+        return os.path.join(self._objects, '{}.pem'.format(digest))
+
+    def _index_path(self, certificate_arn, serial):
+        return os.path.join(self.path(certificate_arn), '{}.json'.format(normalize_serial(serial)))
+
+    @staticmethod
+    def _write(filename, data):
+        # readers never see partially written files
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as temporary_file:
+            temporary_file.write(data)
+        os.rename(temporary, filename)
+
+    def _put_object(self, pem):
+        pem = pem.encode('utf-8')
+        digest = hashlib.sha256(pem).hexdigest()
+        if not os.path.exists(self.object_path(digest)):
+            ChainCache._write(self.object_path(digest), pem)
+        return digest
+
+    def _link(self, digest, filename):
+        temporary = '{}.{}.tmp'.format(filename, os.getpid())
+        os.symlink(os.path.relpath(self.object_path(digest), os.path.dirname(filename)), temporary)
+        os.rename(temporary, filename)
+
+    def get(self, certificate_arn, serial):
+        """
+        :param certificate_arn: certificate ARN
+        :param serial: certificate serial number
+        :return: index entry, None when the serial number or any of its PEMs is not cached
+        """
+        try:
+            with open(self._index_path(certificate_arn, serial)) as index_file:
+                entry = json.load(index_file)
+        except (IOError, ValueError):
+            return None
+
+        if not all(os.path.exists(self.object_path(entry[name])) for name in ChainCache.LINKS):
+            return None
+        return entry
+
+    def put(self, certificate_arn, serial, certificate_pem, chain_pem):
+        """
+        Store the PEMs and point the certificate links at them
+
+        :param certificate_arn: certificate ARN
+        :param serial: certificate serial number
+        :param certificate_pem: GetCertificate Certificate
+        :param chain_pem: GetCertificate CertificateChain
+        :return: index entry
+        """
+        if not os.path.isdir(self.path(certificate_arn)):
+            os.makedirs(self.path(certificate_arn))
+
+        entry = {
+            'arn': certificate_arn,
+            'serial': serial,
+            'certificate': self._put_object(certificate_pem),
+            'chain': self._put_object(chain_pem),
+            'fullchain': self._put_object(certificate_pem.rstrip('\n') + '\n' + chain_pem),
+            'fetched_at': time.time()
+        }
+        for name in ChainCache.LINKS:
+            self._link(entry[name], os.path.join(self.path(certificate_arn), '{}.pem'.format(name)))
+        ChainCache._write(self._index_path(certificate_arn, serial), json.dumps(entry, sort_keys=True))
+        return entry
+
+
+class CertificateChains(object):
+    """
+    Retrieves certificates and chains of many certificates concurrently, certificates
+    with an already cached serial number are not requested again
+    """
+    MAX_WORKERS = 8
+
+    def __init__(self, cache, acm_certificate_request):
+        self._cache = cache
+        self._acm = acm_certificate_request
+
+    def _fetch(self, certificate_arn, serial):
+        response = self._acm.get_certificate(certificate_arn)
+        return self._cache.put(certificate_arn, serial, response['Certificate'], response.get('CertificateChain', ''))
+
+    def fetch(self, certificates, max_workers=None):
+        """
+        :param certificates: list of (certificate ARN, serial number) tuples
+        :param max_workers: number of concurrent GetCertificate calls, MAX_WORKERS by default
+        :return: generator of (certificate ARN, status, entry, error) tuples in the order of completion,
+            status is one of 'unchanged', 'fetched' or 'failed'
+        """
+        missing = []
+        for certificate_arn, serial in certificates:
+            entry = self._cache.get(certificate_arn, serial)
+            if entry:
+                yield certificate_arn, 'unchanged', entry, None
+            else:
+                missing.append((certificate_arn, serial))
+
+        if not missing:
+            return
+
+        logger.debug('Fetching {} certificate(s)'.format(len(missing)))
+        max_workers = min(len(missing), max_workers or CertificateChains.MAX_WORKERS)
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetching = {executor.submit(self._fetch, certificate_arn, serial): certificate_arn
+                        for certificate_arn, serial in missing}
+            for fetched in futures.as_completed(fetching):
+                try:
+                    yield fetching[fetched], 'fetched', fetched.result(), None
+                except Exception as e:
+                    logger.exception('Failed to fetch certificate')
+                    yield fetching[fetched], 'failed', None, str(e)
@@ -2,14 +2,26 @@ from __future__ import print_function
 import os
 import sys
 import argparse
+import cProfile
 import json
 import urllib2
 import time
 import yaml
 import acmagent
 import pkg_resources
+from concurrent import futures
 from acmagent import request
+from acmagent import chains
 from acmagent import confirm
+from acmagent import deadline
+from acmagent import inventory
+from acmagent import lease
+from acmagent import ledger
+from acmagent import loadtest
+from acmagent import metrics
+from acmagent import preflight
+from acmagent import ratelimit
+from acmagent import trace
 
 
 logger = acmagent.configure_logger('acmagent')
@@ -52,7 +64,7 @@ class ParseIMAPCredentials(argparse.Action):
     def __call__(self, parser, namespace, value, option_string=None):
         try:
             logger.debug('Opening IMAP credentials file'.format(value))
-            imap_credentials = yaml.load(urllib2.urlopen(value).read())
+            imap_credentials = acmagent.parse_imap_credentials(urllib2.urlopen(value).read())
             setattr(namespace, self.dest, imap_credentials)
         except urllib2.URLError as e:
             logger.exception('Failed reading json input')
@@ -64,6 +76,307 @@ class ParseIMAPCredentials(argparse.Action):
             else:
                 logger.exception('Input json file is not valid YAML')
                 parser.error('Specified file "{}" is not valid YAML'.format(value))
+        except yaml.YAMLError as e:
+            logger.exception('IMAP credentials file is not valid YAML')
+            parser.error('Specified file "{}" is not valid YAML'.format(value))
+
+
+def _read_stream(stream):
+    """
+    Read non-empty lines from the input stream as soon as they arrive
+
+    :param stream: file object, e.g. sys.stdin
+    :return: generator of stripped lines
+    """
+    for line in iter(stream.readline, ''):
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _write_result(args, result, text):
+    """
+    Write a single result as a NDJSON record or as plain text
+
+    :param args: cli arguments
+    :param result: result record
+    :param text: plain text representation of the result
+    :return: None
+    """
+    if args.output == 'ndjson':
+        sys.stdout.write('{}\n'.format(json.dumps(result, sort_keys=True)))
+    elif text:
+        sys.stdout.write('{}\n'.format(text))
+    sys.stdout.flush()
+
+
+def _timeout_options(args):
+    """
+    Connect and read timeouts and the operation deadline of the IMAP, HTTP and ACM clients
+
+    :param args: cli arguments
+    :return: dict of client options
+    """
+    return {
+        'connect_timeout': args.connect_timeout,
+        'read_timeout': args.read_timeout,
+        'deadline': deadline.Deadline(args.deadline) if args.deadline else None
+    }
+
+
+def _pause(args, operation_deadline):
+    """
+    Pause between the mailbox queries, the pause never extends past the deadline
+
+    :param args: cli arguments
+    :param operation_deadline: deadline.Deadline or None
+    :return: None
+    """
+    time.sleep(operation_deadline.timeout(args.wait, 'pause between mailbox queries') if operation_deadline
+               else args.wait)
+
+
+def _certificate_domains(acm_certificate_request, certificate_id):
+    """
+    Names of the certificate, ACM sends a validation email for each of them
+
+    :param acm_certificate_request: RequestCertificate
+    :param certificate_id: certificate id or ARN
+    :return: sorted list of lower case domain names
+    """
+    try:
+        certificate_arn = certificate_id if certificate_id.startswith('arn:') else next(
+            (summary['CertificateArn'] for summary in acm_certificate_request.list_certificates()
+             if inventory.parse_certificate_id(summary['CertificateArn']) == certificate_id), None)
+        if certificate_arn is None:
+            raise acmagent.ACManagerException('Certificate {} is not found'.format(certificate_id))
+        certificate = acm_certificate_request.describe_certificate(certificate_arn)
+    except acmagent.ACManagerException:
+        raise
+    except Exception as e:
+        logger.exception('Failed to describe certificate')
+        raise acmagent.ACManagerException('Failed to describe certificate {}: {}'.format(certificate_id, e))
+
+    names = [option['DomainName'] for option in certificate.get('DomainValidationOptions') or []] or \
+        [certificate['DomainName']] + (certificate.get('SubjectAlternativeNames') or [])
+    return sorted(set(name.lower() for name in names))
+
+
+def _wait_for_domains(acm_certificate_confirm, certificate_id, args, acm_certificate_request, operation_deadline=None):
+    """
+    Query IMAP server until every domain of the certificate is approved or attempts are exhausted,
+    the results of the attempts are merged and the approved domains are not approved again
+
+    :param acm_certificate_confirm: ConfirmCertificate
+    :param certificate_id: certificate id
+    :param args: cli arguments
+    :param acm_certificate_request: RequestCertificate
+    :param operation_deadline: optional deadline.Deadline bounding the pauses
+    :return: dict of domain to approval result, domains without an email are False
+    """
+    domains = _certificate_domains(acm_certificate_request, certificate_id)
+    results = dict.fromkeys(domains, False)
+    attempts_left = args.attempts
+    while attempts_left:
+        logger.debug('Starting ACM request for {} certificate domains, attempts left: {}, pause: {} seconds'.format(
+            certificate_id, attempts_left, args.wait))
+        attempts_left -= 1
+        _pause(args, operation_deadline)
+        approved = set(domain for domain, result in results.items() if result is True)
+        try:
+            scan_results = acm_certificate_confirm.confirm_domains(certificate_id, approved=approved)
+        except acmagent.NoEmailsFoundException as e:
+            continue
+        for domain, result in scan_results.items():
+            if results.get(domain) is not True:
+                results[domain] = result
+        if all(results[domain] is True for domain in domains):
+            break
+
+    return results
+
+
+def _wait_for_confirmation(acm_certificate_confirm, certificate_id, args, acm_certificate_request=None,
+                           operation_deadline=None):
+    """
+    Query IMAP server until the certificate is confirmed or attempts are exhausted
+
+    :param acm_certificate_confirm: ConfirmCertificate
+    :param certificate_id: certificate id
+    :param args: cli arguments
+    :param acm_certificate_request: RequestCertificate describing the certificate domains with --all-domains
+    :param operation_deadline: optional deadline.Deadline bounding the pauses
+    :return: True when certificate has been confirmed, with --all-domains the dict of
+        domain to approval result of every domain of the certificate
+    """
+    if args.all_domains:
+        return _wait_for_domains(acm_certificate_confirm, certificate_id, args, acm_certificate_request,
+                                 operation_deadline)
+
+    attempts_left = args.attempts
+    while attempts_left:
+        logger.debug('Starting ACM request for {} certificate, attempts left: {}, pause: {} seconds'.format(
+            certificate_id, attempts_left, args.wait))
+        attempts_left -= 1
+        _pause(args, operation_deadline)
+        try:
+            confirmed = acm_certificate_confirm.confirm_certificate(certificate_id)
+            if confirmed:
+                return confirmed
+        except acmagent.NoEmailsFoundException as e:
+            if attempts_left:
+                continue
+            raise
+
+    return False
+
+
+def _domain_statuses(results):
+    """
+    :param results: dict of domain to True, False or the approval error
+    :return: (certificate status, dict of domain to {'status': ..., 'error': ...})
+    """
+    domains = {}
+    for domain, result in results.items():
+        domains[domain or 'unknown'] = {
+            'status': 'confirmed' if result is True else 'pending' if result is False else 'failed',
+            'error': None if isinstance(result, bool) else str(result)
+        }
+
+    statuses = set(domain['status'] for domain in domains.values())
+    status = 'failed' if 'failed' in statuses else 'pending' if 'pending' in statuses else 'confirmed'
+    return status, domains
+
+
+def _confirm_leased(acm_certificate_confirm, certificate_id, args, leases, acm_certificate_request=None,
+                    operation_deadline=None):
+    """
+    Confirm the certificate holding its lease, so other workers skip it
+
+    :param acm_certificate_confirm: ConfirmCertificate
+    :param certificate_id: certificate id
+    :param args: cli arguments
+    :param leases: lease.Leases or None
+    :param acm_certificate_request: RequestCertificate, required with --all-domains
+    :param operation_deadline: optional deadline.Deadline bounding the pauses
+    :return: True when certificate has been confirmed
+    """
+    if leases is None:
+        return _wait_for_confirmation(acm_certificate_confirm, certificate_id, args, acm_certificate_request,
+                                      operation_deadline)
+
+    lease_key = 'certificate/{}'.format(certificate_id)
+    if not leases.acquire(lease_key):
+        raise acmagent.CertificateLeasedException('Certificate {} is being confirmed by another worker'.format(
+            certificate_id))
+    try:
+        return _wait_for_confirmation(acm_certificate_confirm, certificate_id, args, acm_certificate_request,
+                                      operation_deadline)
+    finally:
+        leases.release(lease_key)
+
+
+def _confirm_certs_stream(acm_certificate_confirm, args, parser, leases=None, acm_certificate_request=None,
+                          operation_deadline=None):
+    """
+    Confirm certificate ids read from the input stream, ids can be given as plain
+    lines or as NDJSON records produced by the request-certificate command
+
+    :param acm_certificate_confirm: ConfirmCertificate
+    :param args: cli arguments
+    :param acm_certificate_request: RequestCertificate, required with --all-domains
+    :param operation_deadline: optional deadline.Deadline bounding the pauses
+    :return: None
+    """
+    failed = 0
+    for line in _read_stream(args.input):
+        started = time.time()
+        result = {'id': line, 'status': 'confirmed', 'started': started, 'error': None}
+        try:
+            if line.startswith('{'):
+                result['id'] = json.loads(line).get('id')
+            if not result['id']:
+                raise acmagent.ACManagerException('Certificate id is missing')
+            confirmed = _confirm_leased(acm_certificate_confirm, result['id'], args, leases, acm_certificate_request,
+                                        operation_deadline)
+            if args.all_domains:
+                result['status'], result['domains'] = _domain_statuses(confirmed)
+            elif not confirmed:
+                result['status'] = 'pending'
+        except acmagent.CertificateLeasedException as e:
+            result['status'] = 'leased'
+            result['error'] = str(e)
+        except acmagent.OperationTimeoutException as e:
+            logger.error('Timed out confirming certificate: {}'.format(e))
+            result['status'] = 'timed_out'
+            result['error'] = str(e)
+        except (acmagent.ACManagerException, ValueError) as e:
+            logger.exception('Failed to confirm certificate')
+            result['status'] = 'failed'
+            result['error'] = str(e)
+
+        if result['status'] not in ('confirmed', 'leased'):
+            failed += 1
+
+        result['elapsed'] = round(time.time() - started, 3)
+        _write_result(args, result, '{} {}'.format(result['id'], result['status']))
+
+    parser.exit(1 if failed else 0)
+
+
+def _confirm_certs_scheduled(acm_certificate_confirm, args, parser, leases=None, operation_deadline=None):
+    """
+    Confirm all certificate ids read from the input stream with a single scheduler, every
+    tick checks all pending certificates with one mailbox query
+
+    :param acm_certificate_confirm: ConfirmCertificate
+    :param args: cli arguments
+    :param operation_deadline: optional deadline.Deadline, the certificates are not checked past it
+    :return: None
+    """
+    scheduler = confirm.ConfirmScheduler(acm_certificate_confirm, args.wait)
+    started = time.time()
+    deadline = started + args.wait * args.attempts
+    if operation_deadline:
+        deadline = min(deadline, started + operation_deadline.remaining())
+    failed = 0
+
+    def write(certificate_id, status, error):
+        result = {'id': certificate_id, 'status': status, 'started': started,
+                  'elapsed': round(time.time() - started, 3), 'error': error}
+        _write_result(args, result, '{} {}'.format(certificate_id, status))
+
+    for line in _read_stream(args.input):
+        try:
+            certificate_id = json.loads(line).get('id') if line.startswith('{') else line
+        except ValueError:
+            certificate_id = None
+        if not certificate_id:
+            failed += 1
+            write(line, 'failed', 'Certificate id is missing')
+        elif leases is not None and not leases.acquire('certificate/{}'.format(certificate_id)):
+            write(certificate_id, 'leased', 'Certificate {} is being confirmed by another worker'.format(certificate_id))
+        else:
+            scheduler.add(certificate_id, deadline)
+
+    try:
+        for certificate_id, confirmed, error in scheduler.run():
+            if leases is not None:
+                leases.release('certificate/{}'.format(certificate_id))
+            if not confirmed:
+                failed += 1
+            write(certificate_id, 'confirmed' if confirmed else 'failed' if error else 'pending', error)
+    except acmagent.ACManagerException as e:
+        logger.exception('Failed to confirm certificates')
+        for certificate_id in scheduler.pending:
+            failed += 1
+            write(certificate_id, 'failed', str(e))
+    finally:
+        if leases is not None:
+            for certificate_id in scheduler.pending:
+                leases.release('certificate/{}'.format(certificate_id))
+
+    parser.exit(1 if failed else 0)
 
 
 def _confirm_cert(args, parser):
@@ -73,27 +386,96 @@ def _confirm_cert(args, parser):
     :param args: cli arguments
     :return: None
     """
+    if not args.input and not args.certificate_id:
+        parser.error('--certificate-id is required')
+    if args.all_domains and args.schedule:
+        parser.error('--all-domains can not be used with --schedule')
+
+    parse_pool = futures.ProcessPoolExecutor(max_workers=args.parse_workers) if args.parse_workers else None
+    leases = None
     try:
+        leases = lease.Leases(lease.open_backend(args.lease), ttl=args.lease_ttl) if args.lease else None
         imap_credentials = args.credentials if args.credentials else acmagent.load_imap_credentials()
-        with confirm.ConfirmCertificate(imap_credentials) as acm_certificate_confirm:
-            attempts_left = args.attempts
-            while attempts_left:
-                logger.debug('Starting ACM request for {} certificate, attempts left: {}, pause: {} seconds'.format(
-                    args.certificate_id, attempts_left, args.wait))
-                attempts_left -= 1
-                time.sleep(args.wait)
-                try:
-                    success = acm_certificate_confirm.confirm_certificate(args.certificate_id)
-                    if success:
-                        parser.exit(0, 'Success: certificate has been confirmed\n')
-                except acmagent.NoEmailsFoundException as e:
-                    if attempts_left:
-                        continue
-                    parser.error(str(e))
-                except acmagent.ACManagerException as e:
-                    parser.error(str(e))
+        timeout_options = _timeout_options(args)
+        # the names of the certificate tell --all-domains which emails are still missing
+        acm_certificate_request = request.RequestCertificate(**timeout_options) if args.all_domains else None
+        with confirm.open_mailboxes(imap_credentials, index_days=args.index_days, parse_pool=parse_pool,
+                                    leases=leases, **timeout_options) as acm_certificate_confirm:
+            if args.input and args.schedule:
+                return _confirm_certs_scheduled(acm_certificate_confirm, args, parser, leases,
+                                                timeout_options['deadline'])
+            if args.input:
+                return _confirm_certs_stream(acm_certificate_confirm, args, parser, leases, acm_certificate_request,
+                                             timeout_options['deadline'])
+
+            started = time.time()
+            confirmed = _confirm_leased(acm_certificate_confirm, args.certificate_id, args, leases,
+                                        acm_certificate_request, timeout_options['deadline'])
+            if args.all_domains:
+                status, domains = _domain_statuses(confirmed)
+                text = '\n'.join('{} {} {}'.format(domain, domains[domain]['status'], domains[domain]['error'] or '').strip()
+                                 for domain in sorted(domains))
+                _write_result(args, {'id': args.certificate_id, 'status': status, 'domains': domains,
+                                     'started': started, 'elapsed': round(time.time() - started, 3), 'error': None}, text)
+                parser.exit(0 if status == 'confirmed' else 1)
+            elif confirmed:
+                if args.output == 'ndjson':
+                    _write_result(args, {'id': args.certificate_id, 'status': 'confirmed', 'started': started,
+                                         'elapsed': round(time.time() - started, 3), 'error': None}, None)
+                    parser.exit(0)
+                parser.exit(0, 'Success: certificate has been confirmed\n')
+            else:
+                # e.g. every candidate email is leased by another worker or the scan was cancelled
+                _write_result(args, {'id': args.certificate_id, 'status': 'pending', 'started': started,
+                                     'elapsed': round(time.time() - started, 3), 'error': None},
+                              'Pending: certificate has not been confirmed')
+                parser.exit(1)
     except acmagent.ACManagerException as e:
         parser.error(str(e))
+    finally:
+        if parse_pool:
+            parse_pool.shutdown()
+        if leases is not None:
+            leases.close()
+
+
+def _request_certs_stream(args, parser, specs):
+    """
+    Request certificates one by one as the specs are produced
+
+    :param args: cli arguments
+    :param specs: iterable of JSON spec lines or Certificate objects
+    :return: None
+    """
+    acm_certificate_request = request.RequestCertificate(**_timeout_options(args))
+    validator = preflight.Validator()
+    failed = 0
+    for spec in specs:
+        started = time.time()
+        result = {'id': None, 'domain_name': None, 'status': 'requested', 'started': started, 'error': None}
+        try:
+            if isinstance(spec, request.Certificate):
+                certificate = spec
+            else:
+                certificate = request.Certificate.from_json_input(json.loads(spec))
+            result['domain_name'] = certificate.domain_name
+            response = acm_certificate_request.request_certificate(dict(validator.check(certificate)))
+            result['id'] = response['CertificateArn'].split('/')[-1]
+        except acmagent.InvalidCertificateSpecException as e:
+            logger.debug('Certificate spec is invalid: {}'.format(e))
+            result['status'] = 'invalid'
+            result['error'] = str(e)
+            failed += 1
+        except Exception as e:
+            logger.exception('Failed to request certificate')
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            failed += 1
+
+        result['elapsed'] = round(time.time() - started, 3)
+        _write_result(args, result, result['id'] or 'failed: {}'.format(result['error']))
+
+    parser.exit(1 if failed else 0)
 
 
 def _request_cert(args, parser):
@@ -108,6 +490,15 @@ def _request_cert(args, parser):
         logger.debug('Generating json input file: {}'.format(json_file))
         parser.exit(0, "{}\n".format(json_file))
 
+    if args.input:
+        return _request_certs_stream(args, parser, _read_stream(args.input))
+
+    if args.cli_input_template:
+        try:
+            return _request_certs_stream(args, parser, request.Certificate.from_template(args.cli_input_template))
+        except acmagent.InvalidCertificateJsonFileException as e:
+            parser.error(str(e))
+
     if args.cli_input_json:
         try:
             certificate = request.Certificate.from_json_input(args.cli_input_json)
@@ -121,8 +512,13 @@ def _request_cert(args, parser):
         certificate = request.Certificate(args.__dict__)
         acm_certificate = dict(certificate)
 
-    acm_certificate_request = request.RequestCertificate()
+    errors = preflight.Validator().errors(certificate)
+    if errors:
+        parser.error('; '.join(errors))
 
+    acm_certificate_request = request.RequestCertificate(**_timeout_options(args))
+
+    started = time.time()
     try:
         logger.debug('Requesting certificate: {}'.format(json.dumps(acm_certificate)))
         response = acm_certificate_request.request_certificate(acm_certificate)
@@ -132,9 +528,235 @@ def _request_cert(args, parser):
 
     certificate_id = (response['CertificateArn'].split('/')[-1])
     logger.debug('Success, {} certificate was issued, id: {}'.format(acm_certificate['DomainName'], certificate_id))
+    if args.output == 'ndjson':
+        _write_result(args, {'id': certificate_id, 'domain_name': acm_certificate['DomainName'], 'status': 'requested',
+                             'started': started, 'elapsed': round(time.time() - started, 3), 'error': None}, None)
+        parser.exit(0)
     parser.exit(0, "{}\n".format(certificate_id))
 
 
+def _certificate_status(args, parser):
+    """
+    Print status of ACM certificates using the local inventory cache
+
+    :param args: cli arguments
+    :return: None
+    """
+    with inventory.InventoryStore(args.inventory) as store:
+        certificate_inventory = inventory.CertificateInventory(store, request.RequestCertificate(**_timeout_options(args)))
+        results = certificate_inventory.status(args.certificate_ids or None, refresh=args.refresh)
+
+    failed = 0
+    for certificate_id, entry, error in results:
+        result = {
+            'id': certificate_id,
+            'status': entry['status'] if entry else None,
+            'domain_name': entry['domain_name'] if entry else None,
+            'fetched_at': entry['fetched_at'] if entry else None,
+            'error': error
+        }
+        if error:
+            failed += 1
+        _write_result(args, result, '{} {} {}'.format(
+            certificate_id, result['status'] or 'UNKNOWN', error or result['domain_name']))
+
+    parser.exit(1 if failed else 0)
+
+
+def _fetch_chains(args, parser):
+    """
+    Fetch certificates and chains of the issued certificates into the local PEM cache,
+    certificates with a cached serial number are skipped
+
+    :param args: cli arguments
+    :return: None
+    """
+    certificates = list(args.certificate_arns)
+    if args.input:
+        certificates.extend(_read_stream(args.input))
+
+    failed = 0
+    issued = []
+    with inventory.InventoryStore(args.inventory) as store:
+        acm_certificate_request = request.RequestCertificate(**_timeout_options(args))
+        results = inventory.CertificateInventory(store, acm_certificate_request).status(certificates or None,
+                                                                                        refresh=args.refresh)
+
+    for certificate_id, entry, error in results:
+        if not error and entry['status'] != 'ISSUED':
+            error = 'Certificate is {}'.format(entry['status'])
+        if error:
+            failed += 1
+            _write_result(args, {'id': certificate_id, 'status': 'failed', 'serial': None, 'path': None,
+                                 'error': error}, '{} failed {}'.format(certificate_id, error))
+        else:
+            issued.append((entry['arn'], entry['certificate'].get('Serial')))
+
+    cache = chains.ChainCache(args.cache_dir)
+    certificate_chains = chains.CertificateChains(cache, acm_certificate_request)
+    for certificate_arn, status, entry, error in certificate_chains.fetch(issued, args.workers):
+        certificate_id = inventory.parse_certificate_id(certificate_arn)
+        if error:
+            failed += 1
+        result = {'id': certificate_id, 'status': status, 'serial': entry['serial'] if entry else None,
+                  'path': cache.path(certificate_arn) if entry else None, 'error': error}
+        _write_result(args, result, '{} {} {}'.format(certificate_id, status, error or result['path']))
+
+    parser.exit(1 if failed else 0)
+
+
+def _inventory_export(args, parser):
+    """
+    Describe every account certificate and export the inventory into a sqlite snapshot
+
+    :param args: cli arguments
+    :return: None
+    """
+    with inventory.InventoryStore(args.inventory) as store:
+        acm_certificate_request = request.RequestCertificate(**_timeout_options(args))
+        certificate_arns = [summary['CertificateArn'] for summary in acm_certificate_request.list_certificates()]
+        results = inventory.CertificateInventory(store, acm_certificate_request).status(certificate_arns, refresh=args.refresh)
+        store.export(args.file)
+
+    logger.debug('Exported {} certificate(s) into {}'.format(len(results), args.file))
+    parser.exit(0, '{} certificate(s) exported into {}\n'.format(len(results), args.file))
+
+
+def _inventory_import(args, parser):
+    """
+    Merge sqlite snapshot into the local inventory
+
+    :param args: cli arguments
+    :return: None
+    """
+    if not os.path.exists(args.file):
+        parser.error('Specified file "{}" is not readable'.format(args.file))
+
+    with inventory.InventoryStore(args.inventory) as store:
+        store.import_snapshot(args.file)
+
+    parser.exit(0, 'Snapshot {} has been imported\n'.format(args.file))
+
+
+def _inventory_query(args, parser):
+    """
+    Query the local inventory or an exported snapshot without calling ACM
+
+    :param args: cli arguments
+    :return: None
+    """
+    with inventory.InventoryStore(args.file or args.inventory) as store:
+        for entry in store.query(covers=args.covers, suffix=args.suffix, expiring_days=args.expiring_days,
+                                 status=args.status):
+            certificate = entry['certificate']
+            result = {
+                'id': entry['id'],
+                'arn': entry['arn'],
+                'status': entry['status'],
+                'domain_name': entry['domain_name'],
+                'subject_alternative_names': certificate.get('SubjectAlternativeNames', []),
+                'not_after': certificate.get('NotAfter')
+            }
+            _write_result(args, result, '{} {} {} {}'.format(
+                entry['id'], entry['status'], result['not_after'] or '-', entry['domain_name']))
+
+
+def _load_test(args, parser):
+    """
+    Request certificates from a local stub ACM endpoint at every concurrency level
+    and report throughput, latency percentiles and retries
+
+    :param args: cli arguments
+    :return: None
+    """
+    certificates = [{'DomainName': 'load-{}.example.com'.format(number)} for number in range(args.requests)]
+    with loadtest.StubACMServer(latency=args.latency, error_rate=args.error_rate,
+                                throttle_rate=args.throttle_rate, seed=args.seed) as server:
+        logger.debug('Stub ACM endpoint is listening on {}'.format(server.url))
+        for concurrency in args.concurrency:
+            rate_limiter = ratelimit.AdaptiveRateLimiter(rate=args.initial_rate, max_rate=args.max_rate,
+                                                         labels={'concurrency': concurrency})
+            acm_certificate_request = request.RequestCertificate(loadtest.stub_client(server.url, concurrency),
+                                                                 rate_limiter)
+            result = loadtest.run_workload(acm_certificate_request, certificates, concurrency)
+            result['rate'] = round(rate_limiter.rate, 2)
+            _write_result(args, result, 'concurrency: {concurrency} requests: {requests} throughput: {throughput}/s '
+                                        'p50: {p50}s p95: {p95}s p99: {p99}s retries: {retries} errors: {} '
+                                        'rate limit: {rate}/s'.format(sum(result['errors'].values()), **result))
+
+    parser.exit(0)
+
+
+def _report(args, parser):
+    """
+    Print latency percentiles of the certificate lifecycle stages recorded in the ledger
+
+    :param args: cli arguments
+    :return: None
+    """
+    if not args.ledger:
+        parser.error('--ledger is required')
+    if not os.path.exists(args.ledger):
+        parser.error('Specified file "{}" is not readable'.format(args.ledger))
+
+    entries = ledger.Ledger(args.ledger).entries()
+    if args.days:
+        since = time.time() - args.days * 24 * 60 * 60
+        entries = {certificate_id: stages for certificate_id, stages in entries.items()
+                   if stages.get('requested', since) >= since}
+
+    for result in ledger.report(entries):
+        _write_result(args, result, '{stage}: count: {count} p50: {p50}s p95: {p95}s p99: {p99}s max: {max}s'.format(
+            **result))
+
+    parser.exit(0)
+
+
+def _add_inventory_arguments(parser):
+    """
+    Add local inventory, output and debug arguments to the command parser
+
+    :param parser: command parser
+    :return: None
+    """
+    parser.add_argument('--inventory',
+        dest='inventory',
+        required=False,
+        help='Inventory sqlite file, ~/{} by default'.format(inventory.InventoryStore.FILENAME))
+    parser.add_argument('--output',
+        dest='output',
+        default='text',
+        choices=['text', 'ndjson'],
+        required=False,
+        help='Output format')
+    parser.add_argument('--debug',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) Send logging to standard output')
+
+
+def _add_stream_arguments(parser, input_help):
+    """
+    Add streaming input and output arguments to the command parser
+
+    :param parser: command parser
+    :param input_help: description of the expected input lines
+    :return: None
+    """
+    parser.add_argument('--input',
+        dest='input',
+        required=False,
+        type=argparse.FileType('r'),
+        help='Read {} from the file, use "-" for standard input'.format(input_help))
+    parser.add_argument('--output',
+        dest='output',
+        default='text',
+        choices=['text', 'ndjson'],
+        required=False,
+        help='Output format, ndjson writes one JSON result per item as soon as it completes')
+
+
 def _setup_argparser():
     """
     Argparse factory
@@ -149,6 +771,39 @@ def _setup_argparser():
         help='print acmagent version'
     )
 
+    parser.add_argument('--profile',
+        dest='profile',
+        required=False,
+        metavar='PSTATS_FILE',
+        help='Run the command under cProfile and write pstats to the given file')
+    parser.add_argument('--trace-file',
+        dest='trace_file',
+        required=False,
+        help='Write IMAP, HTTP and ACM spans to the given file in the Chrome trace format')
+    parser.add_argument('--connect-timeout',
+        dest='connect_timeout',
+        type=float,
+        required=False,
+        help='Seconds to connect to the IMAP, HTTP and ACM servers, 10 seconds for IMAP and HTTP by default')
+    parser.add_argument('--read-timeout',
+        dest='read_timeout',
+        type=float,
+        required=False,
+        help='Seconds to wait for a response of the IMAP, HTTP and ACM servers, 60 seconds by default')
+    parser.add_argument('--deadline',
+        dest='deadline',
+        type=float,
+        required=False,
+        help='Seconds the whole command may take, the stage in progress fails with a timeout once it has passed')
+    parser.add_argument('--metrics-file',
+        dest='metrics_file',
+        required=False,
+        help='Write metrics, e.g. the current ACM request rate, to the given JSON file when the command ends')
+    parser.add_argument('--ledger',
+        dest='ledger',
+        required=False,
+        help='Record the certificate lifecycle stages into the given sqlite file, e.g. on a shared volume')
+
     subparsers = parser.add_subparsers(
         title='ACM agent - automates ACM certificates',
         description='ACM agents provides functionality to request and confirm ACM certificates using the CLI interface')
@@ -182,6 +837,15 @@ def _setup_argparser():
         dest='cli_input_json',
         help='(boolean) Prints a sample input JSON  to  standard output')
 
+    request_cert_parser.add_argument('--cli-input-template',
+        required=False,
+        action=ParseJsonInput,
+        dest='cli_input_template',
+        help='Request a certificate for every combination of the "Dimensions" values '
+             'substituted into the input JSON template')
+
+    _add_stream_arguments(request_cert_parser, 'certificate JSON specs, one per line')
+
     request_cert_parser.add_argument('--debug',
         required=False,
         action='store_true',
@@ -192,7 +856,7 @@ def _setup_argparser():
     confirm_cert_parser.set_defaults(func=_confirm_cert)
     confirm_cert_parser.add_argument('--certificate-id',
         dest='certificate_id',
-        required=True,
+        required=False,
         help='Certificate id')
     confirm_cert_parser.add_argument('--wait',
         dest='wait',
@@ -207,6 +871,51 @@ def _setup_argparser():
         required=False,
         help='Number of attempts to query IMAP server')
 
+    confirm_cert_parser.add_argument('--index-days',
+        dest='index_days',
+        type=int,
+        default=None,
+        required=False,
+        help='Index ACM emails received in the last N days once per session instead of '
+             'running a full text search for every certificate')
+
+    confirm_cert_parser.add_argument('--schedule',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) With --input, read all certificate ids first and check them together, '
+             'one mailbox query every --wait seconds until --wait * --attempts seconds have passed')
+
+    confirm_cert_parser.add_argument('--all-domains',
+        dest='all_domains',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) Approve the validation emails of every domain of a multi-SAN certificate concurrently, '
+             'query until every domain of the certificate is approved and report the status of each domain')
+
+    confirm_cert_parser.add_argument('--parse-workers',
+        dest='parse_workers',
+        type=int,
+        default=None,
+        required=False,
+        help='Parse emails and confirmation pages in N worker processes, '
+             'emails are fetched in batches when enabled')
+
+    confirm_cert_parser.add_argument('--lease',
+        dest='lease',
+        required=False,
+        help='Share the mailbox with other workers by leasing certificate ids and emails, '
+             'e.g. sqlite:///mnt/shared/leases.sqlite, file:///mnt/shared/leases or redis://localhost:6379/0')
+    confirm_cert_parser.add_argument('--lease-ttl',
+        dest='lease_ttl',
+        type=int,
+        default=lease.Leases.TTL,
+        required=False,
+        help='Lease duration in seconds, leases of crashed workers expire after it')
+
+    _add_stream_arguments(confirm_cert_parser, 'certificate ids or request-certificate NDJSON records, one per line')
+
     confirm_cert_parser.add_argument('--debug',
         required=False,
         action='store_true',
@@ -218,6 +927,164 @@ def _setup_argparser():
         action=ParseIMAPCredentials,
         help='Explicitly provide IMAP credentials file')
 
+    status_parser = subparsers.add_parser('status')
+    status_parser.set_defaults(func=_certificate_status)
+    status_parser.add_argument('certificate_ids',
+        nargs='*',
+        metavar='CERTIFICATE_ID',
+        help='Certificate ids or ARNs, all certificates in the inventory by default')
+    status_parser.add_argument('--refresh',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) Describe certificates even if cached entries have not expired')
+    _add_inventory_arguments(status_parser)
+
+    fetch_chains_parser = subparsers.add_parser('fetch-chains')
+    fetch_chains_parser.set_defaults(func=_fetch_chains)
+    fetch_chains_parser.add_argument('certificate_arns',
+        nargs='*',
+        metavar='CERTIFICATE_ARN',
+        help='Certificate ARNs or ids, all certificates in the inventory by default')
+    fetch_chains_parser.add_argument('--input',
+        dest='input',
+        required=False,
+        type=argparse.FileType('r'),
+        help='Read certificate ARNs, one per line, from the file, use "-" for standard input')
+    fetch_chains_parser.add_argument('--cache-dir',
+        dest='cache_dir',
+        required=False,
+        help='PEM cache directory, ~/{} by default'.format(chains.ChainCache.DIRECTORY))
+    fetch_chains_parser.add_argument('--workers',
+        type=int,
+        default=chains.CertificateChains.MAX_WORKERS,
+        required=False,
+        help='Number of concurrent GetCertificate calls')
+    fetch_chains_parser.add_argument('--refresh',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) Describe certificates even if cached entries have not expired, e.g. to pick up renewals')
+    _add_inventory_arguments(fetch_chains_parser)
+
+    inventory_parser = subparsers.add_parser('inventory')
+    inventory_subparsers = inventory_parser.add_subparsers(
+        title='Certificate inventory snapshots',
+        description='Export, import and query certificate metadata offline')
+
+    export_parser = inventory_subparsers.add_parser('export')
+    export_parser.set_defaults(func=_inventory_export)
+    export_parser.add_argument('file', help='Snapshot sqlite file')
+    export_parser.add_argument('--refresh',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) Describe certificates even if cached entries have not expired')
+    _add_inventory_arguments(export_parser)
+
+    import_parser = inventory_subparsers.add_parser('import')
+    import_parser.set_defaults(func=_inventory_import)
+    import_parser.add_argument('file', help='Snapshot sqlite file')
+    _add_inventory_arguments(import_parser)
+
+    query_parser = inventory_subparsers.add_parser('query')
+    query_parser.set_defaults(func=_inventory_query)
+    query_parser.add_argument('--snapshot',
+        dest='file',
+        required=False,
+        help='Query the snapshot instead of the local inventory')
+    query_parser.add_argument('--covers',
+        required=False,
+        help='Certificates valid for the name, directly or using a wildcard, e.g. www.example.com')
+    query_parser.add_argument('--suffix',
+        required=False,
+        help='Certificates with names under the domain, e.g. example.com')
+    query_parser.add_argument('--expiring-days',
+        dest='expiring_days',
+        type=int,
+        required=False,
+        help='Certificates expiring in N days')
+    query_parser.add_argument('--status',
+        required=False,
+        help='Certificates with the status, e.g. ISSUED')
+    _add_inventory_arguments(query_parser)
+
+    report_parser = subparsers.add_parser('report')
+    report_parser.set_defaults(func=_report)
+    report_parser.add_argument('--days',
+        type=int,
+        required=False,
+        help='Only certificates requested in the last N days')
+    report_parser.add_argument('--output',
+        dest='output',
+        default='text',
+        choices=['text', 'ndjson'],
+        required=False,
+        help='Output format')
+    report_parser.add_argument('--debug',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) Send logging to standard output')
+
+    load_test_parser = subparsers.add_parser('load-test')
+    load_test_parser.set_defaults(func=_load_test)
+    load_test_parser.add_argument('--requests',
+        type=int,
+        default=200,
+        required=False,
+        help='Number of certificates requested at every concurrency level')
+    load_test_parser.add_argument('--concurrency',
+        type=int,
+        nargs='+',
+        default=[1, 4, 16],
+        required=False,
+        help='Space separated numbers of threads sending the requests')
+    load_test_parser.add_argument('--latency',
+        type=float,
+        default=0.05,
+        required=False,
+        help='Seconds the stub endpoint delays every response by')
+    load_test_parser.add_argument('--error-rate',
+        dest='error_rate',
+        type=float,
+        default=0,
+        required=False,
+        help='Share of the requests failed by the stub endpoint with InternalFailure, e.g. 0.01')
+    load_test_parser.add_argument('--throttle-rate',
+        dest='throttle_rate',
+        type=float,
+        default=0,
+        required=False,
+        help='Share of the requests failed by the stub endpoint with ThrottlingException, e.g. 0.05')
+    load_test_parser.add_argument('--initial-rate',
+        dest='initial_rate',
+        type=float,
+        default=ratelimit.AdaptiveRateLimiter.INITIAL_RATE,
+        required=False,
+        help='Initial calls per second of the adaptive rate limiter')
+    load_test_parser.add_argument('--max-rate',
+        dest='max_rate',
+        type=float,
+        default=ratelimit.AdaptiveRateLimiter.MAX_RATE,
+        required=False,
+        help='Maximum calls per second of the adaptive rate limiter')
+    load_test_parser.add_argument('--seed',
+        type=int,
+        required=False,
+        help='Random seed of the stub endpoint failures')
+    load_test_parser.add_argument('--output',
+        dest='output',
+        default='text',
+        choices=['text', 'ndjson'],
+        required=False,
+        help='Output format')
+    load_test_parser.add_argument('--debug',
+        required=False,
+        action='store_true',
+        default=False,
+        help='(boolean) Send logging to standard output')
+
     return parser
 
 
@@ -231,7 +1098,31 @@ def main():
 
     parser = _setup_argparser()
     args = parser.parse_args()
-    args.func(args, parser)
+
+    if args.trace_file:
+        trace.start(args.trace_file)
+    if args.ledger and args.func is not _report:
+        ledger.start(args.ledger)
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        args.func(args, parser)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.debug('Profile has been written to {}'.format(args.profile))
+        if args.trace_file:
+            trace.stop()
+            logger.debug('Trace has been written to {}'.format(args.trace_file))
+        ledger.stop()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+            logger.debug('Metrics have been written to {}'.format(args.metrics_file))
 
 if __name__ == "__main__":
     main()
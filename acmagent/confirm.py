@@ -1,49 +1,225 @@
 import imaplib
 import email
+import email.utils
+import datetime
+import itertools
+import re
 from bs4 import BeautifulSoup
 import requests
 import logging
 import acmagent
 import json
+import socket
+import threading
+import time
+import collections
+from concurrent import futures
+from acmagent import formtemplate
+from acmagent import imap
+from acmagent import ledger
+from acmagent import mailsource
+from acmagent import trace
 
 logger = logging.getLogger('acmagent')
 
+# RFC 6851 MOVE is not known to imaplib, register it to allow UID MOVE
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
 
-class ConfirmCertificate(object):
+
+def extract_approval_url(uid, raw_message):
     """
-    Certificate confirmation class, tried to confirm certificate with given id by connecting to IMAP server
+    Extract the approval url from the raw certificate email, the function is executed
+    in the parse pool worker processes so it receives and returns only plain data
+
+    :param uid: email UID
+    :param raw_message: RFC822 email
+    :return: approval url
     """
-    APPROVAL_URL_ID = 'approval_url'
-    APPROVAL_FORM_URL = 'https://certificates.amazon.com/approvals'
+    email_message = email.message_from_string(raw_message)
+    logger.debug('Opening email: {}'.format(email_message['subject']))
+    email_body = ''
+    if email_message.is_multipart():
+        for multipart in email_message.get_payload():
+            if 'text/html' == multipart.get_content_type():
+                email_body = multipart.get_payload(decode=True)
+                break
+    if not email_body:
+        logger.exception('Email is missing HTML')
+        raise acmagent.EmailBodyUnknownContentType('Email "{}" is not in the text/html Content-Type'.format(uid))
+
+    try:
+        logger.debug('Reading email: {} HTML body'.format(email_message['subject']))
+        html = BeautifulSoup(email_body, "html.parser")
+        approval_url = html.body.find('a', attrs={'id': ConfirmCertificate.APPROVAL_URL_ID}).get('href')
+        logger.debug('Found confirmation url: {}'.format(approval_url))
+        return approval_url
+    except AttributeError as e:
+        logger.exception('Failed to parse email html')
+        raise acmagent.EmailBodyConfirmLinkIsMissingException('Url with "id={}" is not found in the email'.format(ConfirmCertificate.APPROVAL_URL_ID))
+
+
+def email_date(raw_message):
+    """
+    Read the Date header without parsing the whole email
+
+    :param raw_message: RFC822 email
+    :return: unix time or None when the header is missing or malformed
+    """
+    headers_end = re.search(r'\r?\n\r?\n', raw_message)
+    headers = raw_message[:headers_end.start()] if headers_end else raw_message
+    match = re.search(r'^Date:[ \t]*(.+?)\r?$', headers, re.MULTILINE | re.IGNORECASE)
+    parsed = email.utils.parsedate_tz(match.group(1)) if match else None
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+
+def extract_domain(raw_message):
+    """
+    Find the domain the validation email approves, ACM sends an email for every name of the certificate
+
+    :param raw_message: RFC822 email
+    :return: lower case domain or None
+    """
+    # quoted-printable soft line breaks can split the domain
+    match = ConfirmCertificate.DOMAIN_PATTERN.search(raw_message.replace('=\r\n', '').replace('=\n', ''))
+    return match.group(1).lower() if match else None
+
+
+def extract_confirm_form(url, html):
+    """
+    Extract the confirmation form inputs from the approval page
+
+    :param url: approval url
+    :param html: approval page content
+    :return: form payload
+    """
+    try:
+        confirm_body = BeautifulSoup(html, "html.parser")
+        confirm_form = confirm_body.body.find('form').find_all('input')
+        payload = {input.get('name'): input.get('value') for input in confirm_form}
+        logger.debug('Found confirmation form: {}'.format(json.dumps(payload)))
+        return payload
+    except AttributeError as e:
+        logger.exception('Failed to extract confirmation form')
+        raise acmagent.ConfirmPageIsMissingFormException('The certificate has been confirmed or the confirmation link: "{}" has expired'.format(url))
+
+
+class ImapSource(mailsource.MailSource):
+    """
+    Emails of an IMAP folder. Certificates are found with the full text search, walking
+    the ESEARCH windows or with the per session index, approved emails are marked as read
+    and optionally moved to the approved folder
+    """
+    KEY = 'server'
     EMAIL_FOLDER = 'Inbox'
+    INDEX_TEXT_PREFIX = 4096
+    SEARCH_CHUNK_SIZE = 50
 
-    def __enter__(self):
-        return self
+    def __init__(self, mailbox, index_days=None, connect_timeout=None, read_timeout=None, deadline=None):
+        """
+        :param mailbox: single mailbox IMAP credentials
+        :param index_days: when set, certificate ids are looked up in a per-session index
+            of ACM emails received in the last index_days days instead of the full text search
+        :param connect_timeout: IMAP connect timeout in seconds
+        :param read_timeout: IMAP read timeout in seconds
+        :param deadline: optional deadline.Deadline of the whole operation
+        """
+        super(ImapSource, self).__init__(mailbox, index_days)
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._deadline = deadline
+        self._index = None
+        self._index_last_uid = 0
+        self._selected = False
+        self._read_credentials(mailbox)
+
+    @property
+    def location(self):
+        return '{}/{}/{}'.format(self._server, self._username, self._folder)
 
-    def __init__(self, imap_credentials):
+    def _read_credentials(self, imap_credentials):
         try:
             self._server = imap_credentials['server']
             self._username = imap_credentials['username']
             self._password = imap_credentials['password']
-        except TypeError as e:
+            self._folder = imap_credentials.get('folder', ImapSource.EMAIL_FOLDER)
+            self._approved_folder = imap_credentials.get('approved_folder')
+        except (TypeError, AttributeError) as e:
             logger.exception('IMAP credentials file is not well formatted')
-            raise acmagent.InvaliIMAPCredentailsFileException('IMAP credentials file is empty or not well formatted')
+            raise acmagent.InvalidIMAPCredentailsFileException('IMAP credentials file is empty or not well formatted')
         except KeyError as e:
             logger.exception('IMAP credentials missing property')
             raise acmagent.IMAPCredentialFileMissingPropertyException(
                 'Missing IMAP property "{}", check the credentials file'.format(e.args[0]))
 
-        self._connect_to_imap()
-
-    def _connect_to_imap(self):
+    def open(self):
         try:
             logger.info('Establishing connection with {} server'.format(self._server))
-            self._mail = imaplib.IMAP4_SSL(self._server)
-            self._mail.login(self._username, self._password)
+            with trace.span('IMAP CONNECT', 'imap', server=self._server):
+                self._mail = imap.IMAP4_SSL(self._server, connect_timeout=self._timeout(self._connect_timeout, 'IMAP CONNECT'),
+                                            read_timeout=self._timeout(self._read_timeout, 'IMAP CONNECT'))
+            self._imap('login', self._username, self._password)
+            if self._imap('compress'):
+                logger.debug('IMAP connection with {} server is compressed'.format(self._server))
+        except acmagent.OperationTimeoutException:
+            raise
+        except socket.timeout as e:
+            raise acmagent.OperationTimeoutException('IMAP CONNECT to "{}" server timed out'.format(self._server), 'IMAP CONNECT')
         except Exception as e:
             logger.exception('Failed establish IMAP connection: {}'.format(e))
             raise acmagent.SMTPConnectionFailedException('Can\'t login to the "{}" server'.format(self._server))
 
+    def _select(self):
+        # the folder stays selected for the session, the server reports the new emails
+        # with untagged EXISTS responses and the later searches include them
+        if not self._selected:
+            self._imap('select', self._folder)
+            self._selected = True
+
+    def _timeout(self, timeout, stage):
+        return self._deadline.timeout(timeout, stage) if self._deadline else timeout
+
+    def _imap(self, command, *args):
+        if command == 'uid':
+            stage = 'IMAP UID {}'.format(args[0])
+        elif command == 'uid_pipeline':
+            stage = 'IMAP UID {}'.format('+'.join(arg[0] for arg in args))
+        else:
+            stage = 'IMAP {}'.format(command.upper())
+        if self._deadline:
+            self._mail.set_timeout(self._deadline.timeout(self._read_timeout, stage))
+        with trace.span(stage, 'imap'):
+            try:
+                return getattr(self._mail, command)(*args)
+            except socket.timeout as e:
+                raise acmagent.OperationTimeoutException('{} timed out on "{}" server'.format(stage, self._server), stage)
+
+    def _uid_ok(self, *command):
+        """
+        Run the UID command and check its status
+
+        :param command: command and its arguments as passed to uid()
+        :return: response data
+        :raise imaplib.IMAP4.error: when the server has not completed the command, e.g. NO [TRYCREATE]
+        """
+        typ, data = self._imap('uid', *command)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error('UID {} failed on "{}" server: {} {}'.format(command[0], self._server, typ, data))
+        return data
+
+    def _uid_commands(self, commands):
+        """
+        Run independent UID commands, e.g. SEARCHes of the certificate id chunks, several
+        commands are pipelined to save the round trips. Commands which must not run when
+        a previous one has failed are sent one by one instead
+
+        :param commands: list of (command, arg1, ...) tuples
+        :return: list of (type, data) tuples
+        """
+        if len(commands) == 1:
+            return [self._imap('uid', *commands[0])]
+
+        return self._imap('uid_pipeline', *commands)
+
     @staticmethod
     def _search_query(certificate_id):
         search_query = (
@@ -54,85 +230,1068 @@ class ConfirmCertificate(object):
 
         return "({})".format(" ".join(search_query))
 
+    @staticmethod
+    def _combined_search_query(certificate_ids):
+        """
+        Single search matching emails of any of the certificates, IMAP OR takes exactly two
+        keys so the conditions are nested, e.g. OR BODY "a" OR BODY "b" BODY "c"
+        """
+        bodies = ['BODY "Certificate identifier: {}"'.format(certificate_id) for certificate_id in certificate_ids]
+        condition = bodies[-1]
+        for body in reversed(bodies[:-1]):
+            condition = 'OR {} {}'.format(body, condition)
+
+        return '(UNSEEN FROM "Amazon Certificates" {})'.format(condition)
+
+    @staticmethod
+    def _index_query(since, first_uid):
+        search_query = (
+            'UNSEEN',
+            'FROM "Amazon Certificates"',
+            'SINCE {}'.format(since.strftime('%d-%b-%Y')),
+            'UID {}:*'.format(first_uid)
+        )
+
+        return "({})".format(" ".join(search_query))
+
+    def _update_index(self):
+        """
+        Fetch headers and the beginning of the text of ACM emails that arrived since the last
+        update and add them to the certificate id to UIDs index
+
+        :return: None
+        """
+        if self._index is None:
+            self._index = {}
+
+        since = datetime.date.today() - datetime.timedelta(days=self._index_days)
+        imap_search = ImapSource._index_query(since, self._index_last_uid + 1)
+        success, messages = self._imap('uid', 'SEARCH', None, imap_search)
+        if success != 'OK':
+            raise acmagent.ACManagerException('An unknown error has occurred while reading emails, state={}'.format(success))
+
+        # "UID n:*" always matches the last message, even if it has been indexed already
+        uids = [uid for uid in messages[0].split() if int(uid) > self._index_last_uid]
+        if not uids:
+            return
+
+        for certificate_id, certificate_uids in self._certificate_ids(uids).items():
+            self._index.setdefault(certificate_id, []).extend(certificate_uids)
+
+        self._index_last_uid = max(int(uid) for uid in uids)
+        logger.debug('Indexed {} email(s) in {} folder, {} certificate(s) in total'.format(
+            len(uids), self._folder, len(self._index)))
+
+    def _certificate_ids(self, uids):
+        """
+        Fetch headers and the beginning of the text of the emails and map them to certificate ids
+
+        :param uids: list of UIDs
+        :return: dict of lower case certificate id to list of UIDs
+        """
+        success, response = self._imap('uid', 'FETCH', ','.join(uids),
+            '(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)] BODY.PEEK[TEXT]<0.{}>)'.format(
+                ImapSource.INDEX_TEXT_PREFIX))
+
+        # every FETCH response starts with "N (", its UID can be returned before, between or
+        # after the literals, e.g. in the closing " UID 5)" trailer
+        messages = []
+        for part in response:
+            prelude, literal = part if isinstance(part, tuple) else (part, '')
+            if not isinstance(prelude, str):
+                continue
+            if re.match(r'\d+ \(', prelude):
+                messages.append([None, []])
+            if not messages:
+                continue
+            match = re.search(r'UID (\d+)', prelude)
+            if match:
+                messages[-1][0] = match.group(1)
+            messages[-1][1].append(literal)
+
+        certificate_uids = {}
+        for uid, literals in messages:
+            # quoted-printable soft line breaks can split the certificate identifier
+            certificate_match = mailsource.CERTIFICATE_ID_PATTERN.search(''.join(literals).replace('=\r\n', ''))
+            if uid and certificate_match:
+                certificate_uids.setdefault(certificate_match.group(1).lower(), []).append(uid)
+
+        return certificate_uids
+
+    def _search_index(self, certificate_id):
+        uids = self._index.get(certificate_id.lower()) if self._index is not None else None
+        if not uids:
+            self._update_index()
+            uids = self._index.get(certificate_id.lower())
+
+        return list(uids or [])
+
+    @staticmethod
+    def _iter_newest_first(search_response):
+        """
+        Lazily yield UIDs from a SEARCH response starting from the end, i.e. the newest email
+
+        :param search_response: space separated UIDs
+        :return: generator of UIDs
+        """
+        end = len(search_response)
+        while end > 0:
+            start = search_response.rfind(' ', 0, end) + 1
+            if start < end:
+                yield search_response[start:end]
+            end = start - 1
+
+    @staticmethod
+    def _chunks(uids):
+        uids = iter(uids)
+        chunk = list(itertools.islice(uids, ImapSource.SEARCH_CHUNK_SIZE))
+        while chunk:
+            yield chunk
+            chunk = list(itertools.islice(uids, ImapSource.SEARCH_CHUNK_SIZE))
+
+    def _uid_search(self, *criteria):
+        success, messages = self._imap('uid', 'SEARCH', None, *criteria)
+        if success != 'OK':
+            logger.exception('Unknown error')
+            raise acmagent.ACManagerException('An unknown error has occurred while reading emails, state={}'.format(success))
+
+        return messages[0] or ''
+
+    def _esearch(self, imap_search):
+        """
+        Use ESEARCH to get only the UID range and the number of matching emails, then walk the
+        range newest first in windows expected to hold SEARCH_CHUNK_SIZE emails each
+
+        :param imap_search: search criteria
+        :return: generator of UID chunks
+        """
+        self._uid_search('RETURN', '(MIN MAX COUNT)', imap_search)
+        success, esearch = self._mail.response('ESEARCH')
+        result = dict(re.findall(r'(MIN|MAX|COUNT) (\d+)', ' '.join(response for response in esearch if response)))
+        count = int(result.get('COUNT', 0))
+        if not count:
+            return
+
+        logger.debug('Found {} email(s)'.format(count))
+        first_uid, last_uid = int(result['MIN']), int(result['MAX'])
+        window = max(ImapSource.SEARCH_CHUNK_SIZE,
+                     (last_uid - first_uid + 1) * ImapSource.SEARCH_CHUNK_SIZE // count)
+        while last_uid >= first_uid:
+            window_start = max(first_uid, last_uid - window + 1)
+            uids = list(ImapSource._iter_newest_first(
+                self._uid_search('UID', '{}:{}'.format(window_start, last_uid), imap_search)))
+            if uids:
+                yield uids
+            last_uid = window_start - 1
+
+    def _search(self, certificate_id):
+        """
+        Search emails of the certificate, newest first in chunks of at most SEARCH_CHUNK_SIZE UIDs
+
+        :param certificate_id: certificate id
+        :return: generator of UID chunks
+        """
+        imap_search = ImapSource._search_query(certificate_id)
+        logger.debug('Scan {} folder with {} condition'.format(self._folder, imap_search))
+        if 'ESEARCH' in self._mail.capabilities:
+            return self._esearch(imap_search)
+
+        return ImapSource._chunks(ImapSource._iter_newest_first(self._uid_search(imap_search)))
+
+    def _fetch_error(self, e):
+        """
+        :param e: imaplib.IMAP4.error
+        :return: acmagent exception to raise instead
+        """
+        if str(e).startswith('command EXAMINE illegal'):
+            return acmagent.SMTPConnectionFailedException('Can\'t establish connection with "{}" server'.format(self._server))
+        logger.exception('Failed to fetch emails')
+        return acmagent.FailedToFetchEmailException('Failed to fetch emails: {}'.format(e))
+
+    def _checked(self, chunks):
+        try:
+            for chunk in chunks:
+                yield chunk
+        except imaplib.IMAP4.error as e:
+            raise self._fetch_error(e)
+
+    def list(self, certificate_ids):
+        """
+        Find emails of all the certificates using the index or combined searches, the searches
+        of the certificate id chunks are pipelined
+
+        :param certificate_ids: list of certificate ids
+        :return: dict of lower case certificate id to list of UIDs, newest first
+        """
+        try:
+            self._select()
+            found = self._find(certificate_ids)
+        except imaplib.IMAP4.error as e:
+            raise self._fetch_error(e)
+
+        return {certificate_id.lower(): sorted(found[certificate_id.lower()], key=int, reverse=True)
+                for certificate_id in certificate_ids if found.get(certificate_id.lower())}
+
+    def _find(self, certificate_ids):
+        if self._index_days:
+            self._update_index()
+            found = self._index
+        else:
+            found = {}
+            uids = []
+            searches = [('SEARCH', None, ImapSource._combined_search_query(certificate_ids_chunk))
+                        for certificate_ids_chunk in ImapSource._chunks(certificate_ids)]
+            for success, messages in self._uid_commands(searches):
+                if success != 'OK':
+                    raise acmagent.ACManagerException('An unknown error has occurred while reading emails, state={}'.format(success))
+                uids.extend((messages[0] or '').split())
+
+            if uids:
+                for certificate_id, certificate_uids in self._certificate_ids(uids).items():
+                    found.setdefault(certificate_id, []).extend(certificate_uids)
+
+        return found
+
+    def search(self, certificate_id):
+        """
+        Find the emails of a single certificate, without the index the UIDs are searched lazily
+        so the newest chunk is approved before the older emails are searched
+
+        :param certificate_id: certificate id
+        :return: iterator of UID chunks, newest first
+        """
+        try:
+            self._select()
+            if self._index_days:
+                return iter([sorted(self._search_index(certificate_id), key=int, reverse=True)])
+            return self._checked(self._search(certificate_id))
+        except imaplib.IMAP4.error as e:
+            raise self._fetch_error(e)
+
+    def fetch(self, uids):
+        """
+        Fetch the raw emails with a single UID FETCH, BODY.PEEK[] leaves the \\Seen flag as it is
+        so emails of the failed approvals stay unread until the certificate is confirmed
+
+        :param uids: list of UIDs
+        :return: list of (uid, raw email) tuples in the order of given UIDs, emails moved or
+            expunged since the search, e.g. by another worker, are left out
+        """
+        try:
+            if len(uids) == 1:
+                type, response = self._imap('uid', 'FETCH', uids[0], '(BODY.PEEK[])')
+            else:
+                type, response = self._imap('uid', 'FETCH', ','.join(uids), '(UID BODY.PEEK[])')
+        except imaplib.IMAP4.error as e:
+            raise self._fetch_error(e)
+
+        messages = {}
+        if len(uids) == 1:
+            # the only message of the response is the requested one, the response of
+            # an email which is gone is OK with no message
+            if response and isinstance(response[0], tuple):
+                messages[uids[0]] = response[0][1]
+        else:
+            for index, part in enumerate(response):
+                if not isinstance(part, tuple):
+                    continue
+                # UID can be returned either before or after the message literal
+                trailer = response[index + 1] if index + 1 < len(response) else ''
+                match = re.search(r'UID (\d+)', part[0]) or re.search(r'UID (\d+)', trailer if isinstance(trailer, str) else '')
+                if match:
+                    messages[match.group(1)] = part[1]
+
+        for uid in uids:
+            if uid not in messages:
+                logger.debug('Email: {} has been moved or expunged'.format(uid))
+                self._discard(uid)
+        return [(uid, messages[uid]) for uid in uids if uid in messages]
+
+    def _discard(self, uid):
+        if self._index is not None:
+            super(ImapSource, self)._discard(uid)
+
+    def forget(self, certificate_id):
+        if self._index is not None:
+            self._index.pop(certificate_id.lower(), None)
+
+    @staticmethod
+    def _sequence_set(uids):
+        """
+        Compact UIDs into an IMAP sequence set, e.g. 1:3,7
+
+        :param uids: list of UIDs
+        :return: str
+        """
+        ranges = []
+        for uid in sorted(set(int(uid) for uid in uids)):
+            if ranges and ranges[-1][1] == uid - 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+
+        return ','.join(str(first) if first == last else '{}:{}'.format(first, last) for first, last in ranges)
+
+    def mark_approved(self, uids):
+        """
+        Mark the emails as read using a single UID STORE and optionally move them to the
+        approved folder. Every command depends on the previous one, so they are not pipelined
+
+        :param uids: list of UIDs
+        :return: None
+        """
+        sequence_set = ImapSource._sequence_set(uids)
+        try:
+            logger.debug('Marking emails: {} as read'.format(sequence_set))
+            self._uid_ok('STORE', sequence_set, '+FLAGS', '(\\Seen)')
+
+            if self._approved_folder:
+                logger.debug('Moving emails: {} to {} folder'.format(sequence_set, self._approved_folder))
+                if 'MOVE' in self._mail.capabilities:
+                    self._uid_ok('MOVE', sequence_set, self._approved_folder)
+                else:
+                    # emails are deleted, and expunged on close, only once their copies exist
+                    self._uid_ok('COPY', sequence_set, self._approved_folder)
+                    self._uid_ok('STORE', sequence_set, '+FLAGS', '(\\Deleted)')
+        except imaplib.IMAP4.error as e:
+            raise acmagent.ACManagerException('Failed to update flags of the approved emails: {}'.format(e))
+
+    def clear_deadline(self):
+        """
+        Run the following commands, e.g. the clean up, with the regular timeouts
+
+        :return: None
+        """
+        if self._deadline:
+            self._deadline = None
+            self._mail.set_timeout(self._read_timeout)
+
+    def close(self):
+        logger.info('Closing connection with {} server'.format(self._server))
+        try:
+            self._imap('close')
+        except (imaplib.IMAP4.error, acmagent.OperationTimeoutException) as e:
+            logger.exception('Failed to close connection with {} server'.format(self._server))
+
+
+
+class SourceConfirmCertificate(object):
+    """
+    Runs the certificate approval over the emails of a mail source, e.g. an IMAP folder,
+    a maildir or an S3 prefix. The source finds and fetches the emails, the approved emails
+    are marked in the source at the end of the batch
+    """
+    APPROVAL_URL_ID = 'approval_url'
+    APPROVAL_FORM_URL = 'https://certificates.amazon.com/approvals'
+    # the approval site answers the accepted form with the "Success!" page
+    APPROVAL_SUCCESS_PATTERN = re.compile(r'\bSuccess\b')
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 60
+    CERTIFICATE_ID_PATTERN = mailsource.CERTIFICATE_ID_PATTERN
+    DOMAIN_PATTERN = re.compile(r'^\s*Domain:\s*([A-Za-z0-9*][A-Za-z0-9.*-]*)', re.MULTILINE)
+    APPROVAL_WORKERS = 8
+
+    def __enter__(self):
+        return self
+
+    def __init__(self, source, parse_pool=None, leases=None, connect_timeout=None, read_timeout=None, deadline=None,
+                 form_templates=None):
+        """
+        :param source: mailsource.MailSource
+        :param parse_pool: optional ProcessPoolExecutor used to parse emails and confirmation pages
+        :param leases: optional lease.Leases shared with other workers reading the same mailbox
+        :param connect_timeout: HTTP connect timeout in seconds
+        :param read_timeout: HTTP read timeout in seconds
+        :param deadline: optional deadline.Deadline of the whole operation
+        :param form_templates: optional formtemplate.FormTemplates, by default the templates
+            are shared by all the mailboxes in the process
+        """
+        self._source = source
+        self._connect_timeout = connect_timeout or SourceConfirmCertificate.CONNECT_TIMEOUT
+        self._read_timeout = read_timeout or SourceConfirmCertificate.READ_TIMEOUT
+        self._deadline = deadline
+        self._parse_pool = parse_pool
+        self._leases = leases
+        self._leased_uids = set()
+        self._approved_uids = []
+        self._received_at = {}
+        self._session = None
+        self._form_templates = form_templates or formtemplate.shared_templates()
+        self._source.open()
+
+    def _timeout(self, timeout, stage):
+        return self._deadline.timeout(timeout, stage) if self._deadline else timeout
+
+    def _http(self, method, url, **kwargs):
+        stage = 'HTTP {}'.format(method.upper())
+        timeout = (self._timeout(self._connect_timeout, stage), self._timeout(self._read_timeout, stage))
+        with trace.span(stage, 'http', url=url):
+            try:
+                return getattr(self._session or requests, method)(url, headers=acmagent.UserHeaders, timeout=timeout,
+                                                                   **kwargs)
+            except requests.exceptions.Timeout as e:
+                raise acmagent.OperationTimeoutException('{} {} timed out'.format(stage, url), stage)
+
+    def _parse(self, parser, *args):
+        """
+        Run the HTML parser in the parse pool worker processes when the pool is provided
+
+        :param parser: module level parser function
+        :return: parser result
+        """
+        if self._parse_pool is None:
+            return parser(*args)
+
+        return self._parse_pool.submit(parser, *args).result()
+
     def _call_confirm_url(self, url):
+        # the form of an already seen approval page is posted without requesting the page
+        payload = self._form_templates.payload(url)
+        template_failed = payload is not None and not self._call_template_form(url, payload)
+        if template_failed:
+            logger.info('Form template of: {} was not accepted, requesting the approval page'.format(url))
+        elif payload is not None:
+            return True
+
         logger.info('Sending GET: {}'.format(url))
-        response = requests.get(url, headers=acmagent.UserHeaders)
+        response = self._http('get', url)
 
-        try:
-            confirm_body = BeautifulSoup(response.content, "html.parser")
-            confirm_form = confirm_body.body.find('form').find_all('input')
-            payload = {input.get('name'): input.get('value') for input in confirm_form}
-            logger.debug('Found confirmation form: {}'.format(json.dumps(payload)))
-            return self._call_confirm_form(payload)
-        except AttributeError as e:
-            logger.exception('Failed to extract confirmation form')
-            raise acmagent.ConfirmPageIsMissingFormException('The certificate has been confirmed or the confirmation link: "{}" has expired'.format(url))
+        # expired links are detected by the page without the form
+        payload = self._parse(extract_confirm_form, url, response.content)
+        confirmed = self._call_confirm_form(payload)
+        if template_failed:
+            # the page approved the url its template could not, the template is wrong
+            self._form_templates.reject(url)
+        else:
+            self._form_templates.learn(url, payload)
+        return confirmed
+
+    def _call_template_form(self, url, payload):
+        """
+        Post the form built from the template, unlike the form read from the page it is trusted
+        only when the approval site answers with its success page
+
+        :param url: approval url
+        :param payload: form payload built from the url query parameters
+        :return: True when the certificate has been confirmed
+        """
+        logger.info('Sending POST: {} built from the form template of: {}'.format(
+            SourceConfirmCertificate.APPROVAL_FORM_URL, url))
+        response = self._http('post', SourceConfirmCertificate.APPROVAL_FORM_URL, data=payload)
+        return bool(response.ok and SourceConfirmCertificate.APPROVAL_SUCCESS_PATTERN.search(response.content or ''))
 
     def _call_confirm_form(self, payload):
-        logger.info('Sending POST: {} PAYLOAD: {}'.format(ConfirmCertificate.APPROVAL_FORM_URL, json.dumps(payload)))
-        response = requests.post(ConfirmCertificate.APPROVAL_FORM_URL, headers=acmagent.UserHeaders, data=payload)
+        logger.info('Sending POST: {} PAYLOAD: {}'.format(SourceConfirmCertificate.APPROVAL_FORM_URL, json.dumps(payload)))
+        response = self._http('post', SourceConfirmCertificate.APPROVAL_FORM_URL, data=payload)
 
         if not response.ok:
             logger.exception('Failed to submit confirmation form')
-            raise acmagent.ACManagerException('An unknown error has occurred while requesting url:"{}"'.format(ConfirmCertificate.APPROVAL_FORM_URL))
+            raise acmagent.ConfirmFormRejectedException('An unknown error has occurred while requesting url:"{}"'.format(SourceConfirmCertificate.APPROVAL_FORM_URL))
 
         logger.info('Success! The certificate has been confirmed')
         return True
 
-    def _fetch_message(self, message_id):
-        type, response = self._mail.fetch(message_id,'(RFC822)')
-        email_message = email.message_from_string(response[0][1])
-        logger.debug('Opening email: {}'.format(email_message['subject']))
-        self._mail.store(message_id, '+FLAGS', '\\Seen')
-        logger.debug('Marking email: {} as read'.format(email_message['subject']))
-        email_body = ''
-        if email_message.is_multipart():
-            for multipart in email_message.get_payload():
-                if 'text/html' == multipart.get_content_type():
-                    email_body = multipart.get_payload(decode=True)
-                    break
-        if not email_body:
-            logger.exception('Email is missing HTML')
-            raise acmagent.EmailBodyUnknownContentType('Email "{}" is not in the text/html Content-Type'.format(message_id))
+    def _email_fetched(self, uid, raw_message):
+        # the Date header feeds the email_received stage of the lifecycle ledger
+        self._received_at[uid] = email_date(raw_message)
+
+    def _fetch_message(self, uid):
+        with trace.span('fetch_message', 'confirm', uid=uid):
+            messages = self._source.fetch([uid])
+            if not messages:
+                logger.info('Skipping email: {} which has been moved or deleted'.format(uid))
+                return None
+            self._email_fetched(uid, messages[0][1])
+            return extract_approval_url(uid, messages[0][1])
+
+    def _fetch_messages(self, uids):
+        """
+        Fetch several raw emails at once
+
+        :param uids: list of email keys
+        :return: list of (key, raw email) tuples in the order of given keys
+        """
+        with trace.span('fetch_messages', 'confirm', uids=','.join(uids)):
+            return self._source.fetch(uids)
+
+    def _approval_urls(self, chunks):
+        """
+        Yield approval urls of the candidate emails. With a parse pool every chunk is fetched
+        using a single command and its emails are parsed in parallel by the worker processes
+
+        :param chunks: candidate email UID chunks, newest first
+        :return: generator of (uid, approval url) tuples
+        """
+        for chunk in chunks:
+            chunk = [uid for uid in chunk if self._lease_email(uid)]
+            if not chunk:
+                continue
+
+            if self._parse_pool is None:
+                for uid in chunk:
+                    approval_url = self._fetch_message(uid)
+                    if approval_url is not None:
+                        yield uid, approval_url
+                continue
+
+            parsing = []
+            for uid, raw_message in self._fetch_messages(chunk):
+                self._email_fetched(uid, raw_message)
+                parsing.append((uid, self._parse_pool.submit(extract_approval_url, uid, raw_message)))
+            for uid, approval_url in parsing:
+                yield uid, approval_url.result()
+
+    def _email_lease_key(self, uid):
+        return 'email/{}/{}'.format(self._source.location, uid)
+
+    def _lease_email(self, uid):
+        """
+        Claim the email, emails leased by other workers are skipped
+
+        :param uid: email UID
+        :return: True when the email can be processed
+        """
+        if self._leases is None:
+            return True
+
+        if not self._leases.acquire(self._email_lease_key(uid)):
+            logger.debug('Skipping email: {} leased by another worker'.format(uid))
+            return False
+
+        self._leased_uids.add(uid)
+        return True
+
+    def _release_emails(self, uids):
+        for uid in uids:
+            self._leases.release(self._email_lease_key(uid))
+            self._leased_uids.discard(uid)
+            self._received_at.pop(uid, None)
+
+    def _release_fetched(self):
+        """
+        Release the emails which have not been approved, approved emails stay leased until
+        they are marked as read. Dates of the fetched emails are not needed once the call is over
+
+        :return: None
+        """
+        if self._leased_uids:
+            self._release_emails(self._leased_uids - set(self._approved_uids))
+        self._received_at.clear()
+
+    def confirm_certificate(self, certificate_id, cancelled=None):
+        """
+        Find the certificate email and submit its approval form
+
+        :param certificate_id: certificate id
+        :param cancelled: optional threading.Event, the scan stops once it is set
+        :return: True when the certificate has been confirmed
+        """
+        with trace.span('confirm_certificate', 'confirm', certificate_id=certificate_id,
+                        mailbox=self._source.location):
+            try:
+                return self._confirm_certificate(certificate_id, cancelled)
+            finally:
+                self._release_fetched()
+
+    def _confirm_certificate(self, certificate_id, cancelled):
+        chunks = self._source.search(certificate_id)
+        first_chunk = next(chunks, None)
+        if not first_chunk:
+            logger.info('Have not found email for requested certificate')
+            raise acmagent.NoEmailsFoundException('Failed to find email for certificate {} in {}'.format(
+                certificate_id, self._source.location))
+
+        return self._approve_newest(certificate_id, itertools.chain([first_chunk], chunks), cancelled)
+
+    def _find_certificates(self, certificate_ids):
+        """
+        Find emails of all the certificates with a single source query
+
+        :param certificate_ids: list of certificate ids
+        :return: dict of certificate id to list of email keys, newest first
+        """
+        found = self._source.list(certificate_ids)
+        return {certificate_id: found[certificate_id.lower()]
+                for certificate_id in certificate_ids if certificate_id.lower() in found}
+
+    def confirm_certificates(self, certificate_ids, cancelled=None, claims=None):
+        """
+        Confirm every certificate with an email in the folder, the emails of all the certificates
+        are found with a single query instead of a search per certificate
+
+        :param certificate_ids: list of certificate ids
+        :param cancelled: optional threading.Event, the scan stops once it is set
+        :param claims: optional ApprovalClaims shared with the other mailboxes, certificates
+            claimed by another mailbox are skipped
+        :return: dict of certificate id to True or the confirmation error, certificates
+            without emails or claimed by another mailbox are left out
+        """
+        results = {}
+        with trace.span('confirm_certificates', 'confirm', certificates=len(certificate_ids),
+                        mailbox=self._source.location):
+            try:
+                found = self._find_certificates(certificate_ids)
+                for certificate_id, uids in found.items():
+                    claim = certificate_id.lower()
+                    if claims is not None and not claims.claim(claim):
+                        logger.debug('Certificate {} is approved from another mailbox'.format(certificate_id))
+                        continue
+                    try:
+                        with trace.span('confirm_certificate', 'confirm', certificate_id=certificate_id):
+                            results[certificate_id] = self._approve_newest(certificate_id, iter([uids]), cancelled)
+                    except acmagent.ACManagerException as e:
+                        results[certificate_id] = e
+                    if claims is not None and results[certificate_id] is not True:
+                        claims.release(claim)
+            finally:
+                self._release_fetched()
+
+        return results
+
+    def _approve_newest(self, certificate_id, chunks, cancelled):
+        """
+        Try approval urls starting from the newest email, resent emails with an already
+        tried url are skipped and expired links fall through to the next email
+
+        :param certificate_id: certificate id
+        :param chunks: candidate email UID chunks, newest first
+        :param cancelled: optional threading.Event
+        :return: True when the certificate has been confirmed
+        """
+        uid = self._try_approval_urls(self._approval_urls(chunks), cancelled)
+        if uid is None:
+            return False
+
+        self._record_approval(certificate_id, [uid])
+        self._approved(certificate_id, [uid])
+        return True
+
+    def _try_approval_urls(self, approval_urls, cancelled):
+        """
+        :param approval_urls: (uid, approval url) tuples, newest first
+        :param cancelled: optional threading.Event
+        :return: UID of the approved email or None
+        """
+        requested_urls = set()
+        expired = None
+        for uid, approval_url in approval_urls:
+            if cancelled is not None and cancelled.is_set():
+                logger.debug('Scan of {} was cancelled'.format(self._source.location))
+                return None
+
+            if approval_url in requested_urls:
+                logger.debug('Skipping email: {} with already requested url'.format(uid))
+                continue
+            requested_urls.add(approval_url)
+
+            try:
+                with trace.span('approve_email', 'confirm', uid=uid):
+                    if self._call_confirm_url(approval_url):
+                        return uid
+            except acmagent.ConfirmPageIsMissingFormException as e:
+                logger.info('Confirmation link in email: {} has expired, trying the next email'.format(uid))
+                expired = e
+
+        if expired:
+            raise expired
+
+        return None
+
+    def _record_approval(self, certificate_id, uids):
+        # the certificate can be issued once the last of its validation emails has been approved
+        received_at = filter(None, [self._received_at.pop(uid, None) for uid in uids])
+        if received_at:
+            ledger.record(certificate_id, 'email_received', max(received_at))
+        ledger.record(certificate_id, 'approval_submitted')
+
+    def _approval_session(self):
+        """
+        HTTP session shared by the concurrent approvals, its connections to the approval
+        site are kept alive and reused
+
+        :return: requests.Session
+        """
+        if self._session is None:
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SourceConfirmCertificate.APPROVAL_WORKERS)
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+        return self._session
+
+    def _domain_candidates(self, uids):
+        """
+        Fetch the certificate emails and group them by the domain they approve
+
+        :param uids: list of UIDs, newest first
+        :return: OrderedDict of domain to list of (uid, raw email) tuples, newest first
+        """
+        uids = [uid for uid in uids if self._lease_email(uid)]
+        messages = dict(self._fetch_messages(uids)) if uids else {}
+        candidates = collections.OrderedDict()
+        for uid in uids:
+            if uid in messages:
+                self._email_fetched(uid, messages[uid])
+                candidates.setdefault(extract_domain(messages[uid]), []).append((uid, messages[uid]))
+        return candidates
+
+    def _approve_domain(self, certificate_id, domain, candidates, cancelled):
+        # runs on the approval threads, which do not inherit the span arguments of the caller
+        with trace.span('approve_domain', 'confirm', certificate_id=certificate_id, domain=domain):
+            approval_urls = ((uid, self._parse(extract_approval_url, uid, raw_message)) for uid, raw_message in candidates)
+            return self._try_approval_urls(approval_urls, cancelled)
+
+    def confirm_domains(self, certificate_id, cancelled=None, approved=None, claims=None):
+        """
+        Approve the validation email of every domain of the certificate in one pass, ACM sends
+        a separate email for each name of a multi-SAN certificate. The newest email of every
+        domain is approved concurrently over a pooled HTTP session
+
+        :param certificate_id: certificate id
+        :param cancelled: optional threading.Event, the approvals stop once it is set
+        :param approved: optional set of domains approved by an earlier pass, their emails
+            are not approved again
+        :param claims: optional ApprovalClaims shared with the other mailboxes, domains
+            claimed by another mailbox are skipped
+        :return: dict of domain to True, False or the approval error, emails without
+            the domain are reported under None
+        """
+        results = {}
+        with trace.span('confirm_domains', 'confirm', certificate_id=certificate_id,
+                        mailbox=self._source.location):
+            try:
+                uids = self._find_certificates([certificate_id]).get(certificate_id)
+                if not uids:
+                    logger.info('Have not found email for requested certificate')
+                    raise acmagent.NoEmailsFoundException('Failed to find email for certificate {} in {}'.format(
+                        certificate_id, self._source.location))
+
+                candidates = self._domain_candidates(uids)
+                for domain in approved or ():
+                    candidates.pop(domain, None)
+                for domain in list(candidates):
+                    if claims is not None and not claims.claim((certificate_id.lower(), domain)):
+                        logger.debug('Domain {} is approved from another mailbox'.format(domain))
+                        del candidates[domain]
+                self._approval_session()
+                with futures.ThreadPoolExecutor(
+                        max_workers=min(len(candidates) or 1, SourceConfirmCertificate.APPROVAL_WORKERS)) as executor:
+                    approving = {executor.submit(self._approve_domain, certificate_id, domain, domain_candidates,
+                                                 cancelled): domain
+                                 for domain, domain_candidates in candidates.items()}
+
+                approved_uids = []
+                for approval, domain in approving.items():
+                    try:
+                        uid = approval.result()
+                        results[domain] = uid is not None
+                        if uid is not None:
+                            approved_uids.append(uid)
+                    except acmagent.ACManagerException as e:
+                        logger.error('Failed to approve {} domain of {} certificate: {}'.format(domain, certificate_id, e))
+                        results[domain] = e
+
+                if approved_uids:
+                    self._record_approval(certificate_id, approved_uids)
+                    self._approved(certificate_id, approved_uids)
+                for domain, result in results.items():
+                    if claims is not None and result is not True:
+                        claims.release((certificate_id.lower(), domain))
+            finally:
+                self._release_fetched()
+
+        return results
+
+    def _approved(self, certificate_id, uids):
+        self._approved_uids.extend(uids)
+        self._source.forget(certificate_id)
+
+    def flush(self):
+        """
+        Mark the emails of the confirmed certificates as approved in the source, e.g. read and
+        moved to the approved folder, and release their leases. The emails stay pending when
+        the source fails to mark them
+
+        :return: None
+        """
+        if not self._approved_uids:
+            return
+
+        self._source.mark_approved(self._approved_uids)
+        if self._leases is not None:
+            self._release_emails(self._approved_uids)
+        self._approved_uids = []
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            logger.debug('Reading email: {} HTML body'.format(email_message['subject']))
-            html = BeautifulSoup(email_body, "html.parser")
-            approval_url = html.body.find('a', attrs={'id': ConfirmCertificate.APPROVAL_URL_ID}).get('href')
-            logger.debug('Found confirmation url: {}'.format(approval_url))
-            return self._call_confirm_url(approval_url)
-        except AttributeError as e:
-            logger.exception('Failed to parse email html')
-            raise acmagent.EmailBodyConfirmLinkIsMissingException('Url with "id={}" is not found in the email'.format(ConfirmCertificate.APPROVAL_URL_ID))
+            self.flush()
+        except acmagent.ACManagerException as e:
+            logger.exception('Failed to mark the approved emails')
+        finally:
+            if self._session is not None:
+                self._session.close()
+            self._source.close()
+
+
+
+class ConfirmCertificate(SourceConfirmCertificate):
+    """
+    Certificate confirmation class, tried to confirm certificate with given id by connecting to IMAP server
+    """
+    def __init__(self, imap_credentials, index_days=None, parse_pool=None, leases=None,
+                 connect_timeout=None, read_timeout=None, deadline=None, form_templates=None):
+        """
+        :param imap_credentials: single mailbox IMAP credentials
+        :param index_days: when set, certificate ids are looked up in a per-session index
+            of ACM emails received in the last index_days days instead of the full text search
+        :param parse_pool: optional ProcessPoolExecutor used to parse emails and confirmation pages
+        :param leases: optional lease.Leases shared with other workers reading the same mailbox
+        :param connect_timeout: IMAP and HTTP connect timeout in seconds
+        :param read_timeout: IMAP and HTTP read timeout in seconds
+        :param deadline: optional deadline.Deadline of the whole operation
+        :param form_templates: optional formtemplate.FormTemplates, by default the templates
+            are shared by all the mailboxes in the process
+        """
+        source = ImapSource(imap_credentials, index_days=index_days,
+                            connect_timeout=connect_timeout or SourceConfirmCertificate.CONNECT_TIMEOUT,
+                            read_timeout=read_timeout or SourceConfirmCertificate.READ_TIMEOUT, deadline=deadline)
+        super(ConfirmCertificate, self).__init__(source, parse_pool=parse_pool, leases=leases,
+                                                 connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                                 deadline=deadline, form_templates=form_templates)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # the clean up runs with the regular timeouts even when the deadline has passed
+        self._source.clear_deadline()
+        super(ConfirmCertificate, self).__exit__(exc_type, exc_val, exc_tb)
+
+
+class ApprovalClaims(object):
+    """
+    Certificates and domains claimed by the mailboxes scanned together, a certificate whose
+    emails are found in several mailboxes is approved from the first mailbox to claim it. The
+    claim is kept once the approval has succeeded and released otherwise
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._claimed = set()
+
+    def claim(self, key):
+        """
+        :param key: lower case certificate id or (certificate id, domain) tuple
+        :return: True when the key has not been claimed yet
+        """
+        with self._lock:
+            if key in self._claimed:
+                return False
+            self._claimed.add(key)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._claimed.discard(key)
+
+
+class MultiMailboxConfirmCertificate(object):
+    """
+    Scans several IMAP mailboxes concurrently, the first mailbox to confirm the certificate
+    cancels the outstanding scans. Certificates and domains approved from one mailbox are
+    skipped by the others
+    """
+    def __enter__(self):
+        return self
+
+    def __init__(self, mailboxes, **options):
+        self._executor = futures.ThreadPoolExecutor(max_workers=len(mailboxes))
+        connecting = [self._executor.submit(connect_mailbox, mailbox, **options) for mailbox in mailboxes]
+        futures.wait(connecting)
+
+        self._mailboxes = [future.result() for future in connecting if not future.exception()]
+        failed = [future.exception() for future in connecting if future.exception()]
+        if failed:
+            self.__exit__(None, None, None)
+            raise failed[0]
 
     def confirm_certificate(self, certificate_id):
-        try:
-            self._mail.select(ConfirmCertificate.EMAIL_FOLDER)
-            imap_search = ConfirmCertificate._search_query(certificate_id)
-            logger.debug('Scan {} folder with {} condition'.format(ConfirmCertificate.EMAIL_FOLDER, imap_search))
-            success, messages = self._mail.search(None, imap_search)
-            if success == 'OK':
-                message_ids = [message_id for message_id in messages[0].split(' ') if message_id]
-
-                if not message_ids:
-                    logger.info('Have not found email for requested certificate')
-                    raise acmagent.NoEmailsFoundException('Failed to find email for certificate {} in {} folder'.format(
-                        certificate_id, ConfirmCertificate.EMAIL_FOLDER))
+        cancelled = threading.Event()
+        scans = [self._executor.submit(mailbox.confirm_certificate, certificate_id, cancelled)
+                 for mailbox in self._mailboxes]
+        errors = []
 
-                logger.debug('Found {} email(s)'.format(len(message_ids)))
-                for message_id in message_ids:
-                    success = self._fetch_message(message_id)
-                    if success:
+        try:
+            for scan in futures.as_completed(scans):
+                try:
+                    if scan.result():
                         return True
-            else:
-                logger.exception('Unknown error')
-                raise acmagent.ACManagerException('An unknown error has occurred while reading emails, state={}'.format(success))
-        except imaplib.IMAP4.error as e:
-            if str(e).startswith('FETCH'):
-                raise acmagent.FailedToFetchEmailException('Failed to fetch emails')
-            elif str(e).startswith('command EXAMINE illegal'):
-                raise acmagent.SMTPConnectionFailedException('Can\'t establish connection with "{}" server'.format(self._server))
+                except acmagent.NoEmailsFoundException as e:
+                    continue
+                except acmagent.ACManagerException as e:
+                    errors.append(e)
+        finally:
+            cancelled.set()
+            for scan in scans:
+                scan.cancel()
+            futures.wait(scans)
+
+        if errors:
+            raise errors[0]
+
+        logger.info('Have not found email for requested certificate in any mailbox')
+        raise acmagent.NoEmailsFoundException('Failed to find email for certificate {} in {} mailboxes'.format(
+            certificate_id, len(self._mailboxes)))
+
+    def confirm_domains(self, certificate_id, approved=None):
+        """
+        Approve the domains found in every mailbox, the validation emails of a multi-SAN
+        certificate can be delivered to different mailboxes
+
+        :param certificate_id: certificate id
+        :param approved: optional set of domains approved by an earlier pass
+        :return: dict of domain to True, False or the approval error
+        """
+        results = {}
+        claims = ApprovalClaims()
+        scans = [self._executor.submit(mailbox.confirm_domains, certificate_id, approved=approved, claims=claims)
+                 for mailbox in self._mailboxes]
+        errors = []
+        for scan in futures.as_completed(scans):
+            try:
+                scan_results = scan.result()
+            except acmagent.NoEmailsFoundException as e:
+                continue
+            except acmagent.ACManagerException as e:
+                errors.append(e)
+                continue
+            for domain, result in scan_results.items():
+                if results.get(domain) is not True:
+                    results[domain] = result
+
+        if not results and errors:
+            raise errors[0]
+        if not results:
+            raise acmagent.NoEmailsFoundException('Failed to find email for certificate {} in {} mailboxes'.format(
+                certificate_id, len(self._mailboxes)))
+        return results
+
+    def confirm_certificates(self, certificate_ids):
+        """
+        Confirm the certificates found in every mailbox, every certificate is approved once
+
+        :param certificate_ids: list of certificate ids
+        :return: dict of certificate id to True or the confirmation error
+        """
+        results = {}
+        claims = ApprovalClaims()
+        scans = [self._executor.submit(mailbox.confirm_certificates, certificate_ids, claims=claims)
+                 for mailbox in self._mailboxes]
+        for scan in futures.as_completed(scans):
+            try:
+                scan_results = scan.result()
+            except acmagent.ACManagerException as e:
+                logger.error('Failed to scan mailbox: {}'.format(e))
+                continue
+            for certificate_id, result in scan_results.items():
+                if results.get(certificate_id) is not True:
+                    results[certificate_id] = result
+
+        return results
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        logger.info('Closing connection with {} server'.format(self._server))
-        self._mail.close()
+        for mailbox in self._mailboxes:
+            mailbox.__exit__(exc_type, exc_val, exc_tb)
+        self._executor.shutdown(wait=True)
+
+
+def connect_mailbox(mailbox, **options):
+    """
+    Open a single mailbox, mailboxes with a "maildir", "mbox" or "eml" path are read
+    from the local files and mailboxes with an "s3" prefix from S3 instead of the IMAP server
+
+    :param mailbox: single mailbox credentials
+    :param options: ConfirmCertificate options
+    :return: ConfirmCertificate
+    """
+    from acmagent import localmail
+    from acmagent import s3mail
+
+    if isinstance(mailbox, dict):
+        for source_class in localmail.SOURCES.values() + [s3mail.S3Source]:
+            if source_class.KEY in mailbox:
+                options = dict(options)
+                source = source_class(mailbox, index_days=options.pop('index_days', None))
+                return SourceConfirmCertificate(source, **options)
+
+    return ConfirmCertificate(mailbox, **options)
+
+
+def open_mailboxes(imap_credentials, **options):
+    """
+    Connect to every mailbox listed in the IMAP credentials
+
+    :param imap_credentials: parsed IMAP credentials file
+    :param options: ConfirmCertificate options
+    :return: ConfirmCertificate or MultiMailboxConfirmCertificate
+    """
+    mailboxes = acmagent.imap_mailboxes(imap_credentials)
+    if len(mailboxes) == 1:
+        return connect_mailbox(mailboxes[0], **options)
+
+    return MultiMailboxConfirmCertificate(mailboxes, **options)
+
+
+class ConfirmScheduler(object):
+    """
+    Confirms many pending certificates with one combined mailbox query per tick instead of
+    a polling loop per certificate
+    """
+    def __init__(self, mailbox, interval, clock=None, sleep=None):
+        """
+        :param mailbox: ConfirmCertificate or MultiMailboxConfirmCertificate
+        :param interval: seconds between the ticks
+        """
+        self._mailbox = mailbox
+        self._interval = interval
+        self._clock = clock or time.time
+        self._sleep = sleep or time.sleep
+        self._pending = collections.OrderedDict()
+
+    @property
+    def pending(self):
+        return list(self._pending)
+
+    def add(self, certificate_id, deadline):
+        """
+        :param certificate_id: certificate id
+        :param deadline: unix time after which the certificate is given up
+        :return: None
+        """
+        self._pending[certificate_id] = deadline
+
+    def _expired(self):
+        now = self._clock()
+        for certificate_id, deadline in list(self._pending.items()):
+            if deadline <= now:
+                del self._pending[certificate_id]
+                yield certificate_id, False, None
+
+    def run(self):
+        """
+        Poll the mailbox until every certificate is confirmed, failed or past its deadline
+
+        :return: generator of (certificate id, confirmed, error) tuples in completion order
+        """
+        while self._pending:
+            self._sleep(self._interval)
+            logger.debug('Checking {} pending certificate(s)'.format(len(self._pending)))
+            with trace.span('tick', 'confirm', certificates=len(self._pending)):
+                results = self._mailbox.confirm_certificates(list(self._pending))
+
+            for certificate_id, result in results.items():
+                if certificate_id not in self._pending or result is False:
+                    continue
+                del self._pending[certificate_id]
+                if result is True:
+                    yield certificate_id, True, None
+                else:
+                    yield certificate_id, False, str(result)
+
+            for expired in self._expired():
+                yield expired
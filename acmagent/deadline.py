@@ -0,0 +1,37 @@
+import time
+import acmagent
+
+
+class Deadline(object):
+    """
+    Time budget of the whole operation, every stage bounds its timeouts by the remaining time
+    """
+    def __init__(self, seconds, clock=None):
+        """
+        :param seconds: operation time budget
+        """
+        self._clock = clock or time.time
+        self._expires_at = self._clock() + seconds
+
+    def remaining(self):
+        return max(0, self._expires_at - self._clock())
+
+    def check(self, stage):
+        """
+        :param stage: name of the stage about to start, e.g. IMAP SEARCH
+        :return: None
+        """
+        if not self.remaining():
+            raise acmagent.OperationTimeoutException('Deadline exceeded before {}'.format(stage), stage)
+
+    def timeout(self, timeout, stage):
+        """
+        Bound the stage timeout by the remaining time
+
+        :param timeout: stage timeout in seconds or None
+        :param stage: stage name
+        :return: timeout in seconds
+        """
+        self.check(stage)
+        remaining = self.remaining()
+        return remaining if timeout is None else min(timeout, remaining)
@@ -0,0 +1,101 @@
+import logging
+import threading
+import urlparse
+
+logger = logging.getLogger('acmagent')
+
+_lock = threading.Lock()
+_templates = None
+
+
+def template_key(url):
+    """
+    Approval urls of the same page differ only in the values of their query parameters
+
+    :param url: approval url
+    :return: (scheme, host, path, sorted query parameter names) tuple
+    """
+    parsed = urlparse.urlparse(url)
+    return (parsed.scheme, parsed.netloc.lower(), parsed.path,
+            tuple(sorted(urlparse.parse_qs(parsed.query, keep_blank_values=True))))
+
+
+def _query(url):
+    return {name: values[0] for name, values in
+            urlparse.parse_qs(urlparse.urlparse(url).query, keep_blank_values=True).items()}
+
+
+class FormTemplates(object):
+    """
+    Approval form templates learned from the approval pages. Every form input is either copied
+    from a query parameter of the approval url or a constant, so the form of a new approval url
+    of an already seen page can be built without requesting the page. A template is rejected and
+    not learned again once its page has approved a url the template could not, e.g. when the
+    form has a per page token. Urls the page can not approve either, e.g. stale resent emails,
+    keep the template
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._rejected = set()
+
+    def learn(self, url, payload):
+        """
+        Remember the form of the approval page, pages without an input copied from the url
+        have nothing approval specific in the template and are not remembered
+
+        :param url: approval url
+        :param payload: form payload extracted from the approval page
+        :return: None
+        """
+        query = _query(url)
+        values = {value: name for name, value in sorted(query.items(), reverse=True) if value}
+        fields = {}
+        for name, value in payload.items():
+            fields[name] = ('query', values[value]) if value in values else ('constant', value)
+
+        if not any(source == 'query' for source, value in fields.values()):
+            return
+
+        key = template_key(url)
+        with self._lock:
+            if key not in self._rejected:
+                self._templates[key] = fields
+
+    def payload(self, url):
+        """
+        :param url: approval url
+        :return: form payload or None when the page of the url has no template
+        """
+        with self._lock:
+            fields = self._templates.get(template_key(url))
+        if fields is None:
+            return None
+
+        query = _query(url)
+        return {name: query[value] if source == 'query' else value for name, (source, value) in fields.items()}
+
+    def reject(self, url):
+        """
+        Forget the template of the url page and stop learning it, called when the page has
+        approved the url the template could not
+
+        :param url: approval url
+        :return: None
+        """
+        key = template_key(url)
+        logger.debug('Form template of {} has been rejected'.format(url))
+        with self._lock:
+            self._templates.pop(key, None)
+            self._rejected.add(key)
+
+
+def shared_templates():
+    """
+    :return: FormTemplates shared by all mailboxes in the process
+    """
+    global _templates
+    with _lock:
+        if _templates is None:
+            _templates = FormTemplates()
+        return _templates
@@ -0,0 +1,162 @@
+import imaplib
+import socket
+import ssl
+import threading
+import time
+import zlib
+from acmagent import metrics
+from acmagent import trace
+
+# RFC 4978, allowed once the client is authenticated
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def ssl_context():
+    """
+    Client SSL context shared by all IMAP connections of the process, it is created once
+    instead of configuring a new context for every connection
+
+    :return: ssl.SSLContext
+    """
+    global _context
+    with _context_lock:
+        if _context is None:
+            # same settings as ssl.wrap_socket used by imaplib, the server certificate is not verified
+            _context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            _context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        return _context
+
+
+class IMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    IMAP4 over SSL with connect and read timeouts, imaplib of Python 2 connects without a timeout.
+    Also supports COMPRESS=DEFLATE and pipelined UID commands for high latency links
+    """
+    # compressed bytes read from the socket at once
+    INFLATE_CHUNK_SIZE = 16384
+
+    def __init__(self, host, port=imaplib.IMAP4_SSL_PORT, connect_timeout=None, read_timeout=None):
+        """
+        :param host: IMAP server
+        :param port: IMAP server port
+        :param connect_timeout: seconds to establish the TCP connection
+        :param read_timeout: seconds to wait for the server on every socket operation, including the handshake
+        """
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._compressor = None
+        self._decompressor = None
+        self._inflated = ''
+        imaplib.IMAP4_SSL.__init__(self, host, port)
+
+    def open(self, host='', port=imaplib.IMAP4_SSL_PORT):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), self._connect_timeout)
+        self.sock.settimeout(self._read_timeout)
+
+        started = time.time()
+        with trace.span('TLS HANDSHAKE', 'imap', server=host):
+            self.sslobj = ssl_context().wrap_socket(self.sock, server_hostname=host)
+        metrics.observe('imap_tls_handshake_seconds', time.time() - started, server=host)
+
+        self.file = self.sslobj.makefile('rb')
+
+    def set_timeout(self, timeout):
+        """
+        Change the read timeout of the following commands
+
+        :param timeout: seconds or None
+        :return: None
+        """
+        self._read_timeout = timeout
+        self.sslobj.settimeout(timeout)
+
+    def login(self, user, password):
+        typ, dat = imaplib.IMAP4_SSL.login(self, user, password)
+        # servers advertise the capabilities of the authenticated state, e.g. COMPRESS, in the response code
+        if 'CAPABILITY' in self.untagged_responses:
+            self.capabilities = tuple(self.untagged_responses.pop('CAPABILITY')[-1].upper().split())
+        return typ, dat
+
+    def compress(self):
+        """
+        Enable COMPRESS=DEFLATE when the server supports it, all the following commands
+        and responses are compressed
+
+        :return: True when the connection is compressed
+        """
+        if self._decompressor is not None or 'COMPRESS=DEFLATE' not in self.capabilities:
+            return False
+
+        typ, dat = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+
+        # raw deflate without the zlib header
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        return True
+
+    def _inflate(self):
+        data = self.sslobj.recv(IMAP4_SSL.INFLATE_CHUNK_SIZE)
+        if not data:
+            raise self.abort('socket error: EOF')
+
+        inflated = self._decompressor.decompress(data)
+        metrics.increment('imap_compressed_bytes', len(data), server=self.host)
+        metrics.increment('imap_inflated_bytes', len(inflated), server=self.host)
+        self._inflated += inflated
+
+    def read(self, size):
+        if self._decompressor is None:
+            return imaplib.IMAP4_SSL.read(self, size)
+
+        while len(self._inflated) < size:
+            self._inflate()
+        data, self._inflated = self._inflated[:size], self._inflated[size:]
+        return data
+
+    def readline(self):
+        if self._decompressor is None:
+            return imaplib.IMAP4_SSL.readline(self)
+
+        end = self._inflated.find('\n')
+        while end < 0:
+            if len(self._inflated) > imaplib._MAXLINE:
+                raise self.error('got more than {} bytes'.format(imaplib._MAXLINE))
+            searched = len(self._inflated)
+            self._inflate()
+            end = self._inflated.find('\n', searched)
+        line, self._inflated = self._inflated[:end + 1], self._inflated[end + 1:]
+        return line
+
+    def send(self, data):
+        if self._compressor is None:
+            return imaplib.IMAP4_SSL.send(self, data)
+
+        self.sslobj.sendall(self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def uid_pipeline(self, *commands):
+        """
+        Send several UID commands without waiting for the responses, the server runs them in
+        order and the responses are read afterwards, saving a round trip per command. The
+        commands must be independent, a command runs even when the previous one has failed
+
+        :param commands: (command, arg1, ...) tuples as passed to uid()
+        :return: list of (type, data) tuples as returned by uid()
+        """
+        for command in commands:
+            if command[0].upper() not in imaplib.Commands:
+                raise self.error('Unknown IMAP4 UID command: {}'.format(command[0]))
+
+        tags = [self._command('UID', command[0].upper(), *command[1:]) for command in commands]
+        results = []
+        for command, tag in zip(commands, tags):
+            typ, dat = self._command_complete('UID', tag)
+            name = command[0].upper()
+            results.append(self._untagged_response(typ, dat, name if name in ('SEARCH', 'SORT', 'THREAD') else 'FETCH'))
+        return results
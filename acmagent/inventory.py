@@ -0,0 +1,274 @@
+import calendar
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent import futures
+
+logger = logging.getLogger('acmagent')
+
+
+COLUMNS = ('id', 'arn', 'status', 'domain_name', 'certificate', 'fetched_at', 'expires_at', 'not_after')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS certificates ('
+    'id TEXT PRIMARY KEY, arn TEXT, status TEXT, domain_name TEXT, '
+    'certificate TEXT, fetched_at REAL, expires_at REAL, not_after REAL)',
+    'CREATE TABLE IF NOT EXISTS names ('
+    'name TEXT, reversed_name TEXT, certificate_id TEXT, PRIMARY KEY (certificate_id, name))',
+    'CREATE INDEX IF NOT EXISTS names_name ON names (name)',
+    'CREATE INDEX IF NOT EXISTS names_reversed_name ON names (reversed_name)',
+    'CREATE INDEX IF NOT EXISTS certificates_not_after ON certificates (not_after)',
+)
+
+
+def parse_certificate_id(certificate_arn):
+    """
+    Extract certificate id, i.e. the last part of the certificate ARN
+
+    :param certificate_arn: certificate ARN or id
+    :return: certificate id
+    """
+    return certificate_arn.split('/')[-1]
+
+
+class InventoryStore(object):
+    """
+    Local sqlite cache of ACM certificate descriptions, every entry has its own TTL so
+    certificates in a terminal state are cached longer than the pending ones
+    """
+    FILENAME = '.acmagent.sqlite'
+    TERMINAL_STATUSES = ('ISSUED', 'FAILED', 'EXPIRED', 'REVOKED', 'INACTIVE', 'VALIDATION_TIMED_OUT')
+    TERMINAL_TTL = 24 * 60 * 60
+    PENDING_TTL = 60
+
+    def __enter__(self):
+        return self
+
+    def __init__(self, filename=None):
+        self._filename = filename or os.path.join(os.path.expanduser('~'), InventoryStore.FILENAME)
+        self._db = sqlite3.connect(self._filename)
+        self._db.row_factory = sqlite3.Row
+        InventoryStore._create_schema(self._db, 'main')
+
+    @staticmethod
+    def _create_schema(db, database):
+        columns = [row[1] for row in db.execute('PRAGMA {}.table_info(certificates)'.format(database))]
+        if columns and 'not_after' not in columns:
+            db.execute('ALTER TABLE {}.certificates ADD COLUMN not_after REAL'.format(database))
+
+        for statement in SCHEMA:
+            db.execute(statement.replace(' EXISTS ', ' EXISTS {}.'.format(database)))
+        db.commit()
+
+    @staticmethod
+    def _names(certificate):
+        return set([certificate.get('DomainName')] + (certificate.get('SubjectAlternativeNames') or [])) - set([None])
+
+    @staticmethod
+    def _entry(row):
+        if row is None:
+            return None
+
+        entry = dict(zip(row.keys(), row))
+        entry['certificate'] = json.loads(entry['certificate']) if entry['certificate'] else None
+        return entry
+
+    def get(self, certificate_id):
+        row = self._db.execute('SELECT * FROM certificates WHERE id = ?', (certificate_id,)).fetchone()
+        return InventoryStore._entry(row)
+
+    def entries(self):
+        for row in self._db.execute('SELECT * FROM certificates ORDER BY domain_name'):
+            yield InventoryStore._entry(row)
+
+    def put(self, certificate, fetched_at=None):
+        """
+        Store DescribeCertificate response, datetime values are stored as strings
+
+        :param certificate: DescribeCertificate Certificate structure
+        :param fetched_at: unix time of the describe call
+        :return: None
+        """
+        fetched_at = fetched_at or time.time()
+        certificate_id = parse_certificate_id(certificate['CertificateArn'])
+        status = certificate.get('Status')
+        ttl = InventoryStore.TERMINAL_TTL if status in InventoryStore.TERMINAL_STATUSES else InventoryStore.PENDING_TTL
+        not_after = certificate.get('NotAfter')
+        self._db.execute('INSERT OR REPLACE INTO certificates ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(
+            ', '.join(COLUMNS)), (
+            certificate_id,
+            certificate['CertificateArn'],
+            status,
+            certificate.get('DomainName'),
+            json.dumps(certificate, default=str, sort_keys=True),
+            fetched_at,
+            fetched_at + ttl,
+            calendar.timegm(not_after.utctimetuple()) if not_after else None
+        ))
+        self._db.execute('DELETE FROM names WHERE certificate_id = ?', (certificate_id,))
+        self._db.executemany('INSERT INTO names VALUES (?, ?, ?)', [
+            (name.lower(), name.lower()[::-1], certificate_id) for name in InventoryStore._names(certificate)])
+        self._db.commit()
+
+    def put_arn(self, certificate_arn):
+        """
+        Remember ARN of a certificate that has not been described yet
+
+        :param certificate_arn: certificate ARN
+        :return: None
+        """
+        self._db.execute('INSERT OR IGNORE INTO certificates (id, arn, expires_at) VALUES (?, ?, 0)', (
+            parse_certificate_id(certificate_arn), certificate_arn))
+        self._db.commit()
+
+    def _copy(self, filename, source, target):
+        self._db.execute('ATTACH DATABASE ? AS snapshot', (filename,))
+        try:
+            InventoryStore._create_schema(self._db, 'snapshot')
+            self._db.execute('DELETE FROM {}.names WHERE certificate_id IN (SELECT id FROM {}.certificates)'.format(
+                target, source))
+            self._db.execute('INSERT OR REPLACE INTO {}.certificates ({columns}) SELECT {columns} FROM {}.certificates'.format(
+                target, source, columns=', '.join(COLUMNS)))
+            self._db.execute('INSERT OR REPLACE INTO {}.names SELECT * FROM {}.names'.format(target, source))
+            self._db.commit()
+        finally:
+            self._db.execute('DETACH DATABASE snapshot')
+
+    def export(self, filename):
+        """
+        Write the inventory into a standalone sqlite snapshot, the snapshot can be queried
+        offline or imported into another inventory
+
+        :param filename: snapshot filename, existing file is replaced
+        :return: None
+        """
+        if os.path.exists(filename):
+            os.remove(filename)
+        self._copy(filename, 'main', 'snapshot')
+
+    def import_snapshot(self, filename):
+        """
+        Merge the sqlite snapshot into the inventory
+
+        :param filename: snapshot filename
+        :return: None
+        """
+        self._copy(filename, 'snapshot', 'main')
+
+    def query(self, covers=None, suffix=None, expiring_days=None, status=None):
+        """
+        Find certificates using the name and expiry indexes, without network access
+
+        :param covers: name the certificate is valid for, directly or using a wildcard
+        :param suffix: certificates with names under the domain, e.g. example.com
+        :param expiring_days: certificates expiring within the number of days
+        :param status: certificates with the status
+        :return: generator of entries
+        """
+        conditions = []
+        params = []
+        if covers:
+            names = [covers.lower()]
+            if '.' in covers and not covers.startswith('*.'):
+                names.append('*.' + covers.lower().split('.', 1)[1])
+            conditions.append('id IN (SELECT certificate_id FROM names WHERE name IN ({}))'.format(
+                ', '.join('?' * len(names))))
+            params.extend(names)
+        if suffix:
+            reversed_suffix = suffix.lower().lstrip('.')[::-1] + '.'
+            # range over the reversed names index instead of an unindexed LIKE '%suffix'
+            conditions.append('id IN (SELECT certificate_id FROM names '
+                              'WHERE (reversed_name >= ? AND reversed_name < ?) OR name = ?)')
+            params.extend([reversed_suffix, reversed_suffix[:-1] + '/', suffix.lower().lstrip('.')])
+        if expiring_days is not None:
+            conditions.append('not_after <= ?')
+            params.append(time.time() + expiring_days * 24 * 60 * 60)
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+
+        query = 'SELECT * FROM certificates WHERE certificate IS NOT NULL'
+        for condition in conditions:
+            query += ' AND ' + condition
+
+        for row in self._db.execute(query + ' ORDER BY not_after', params):
+            yield InventoryStore._entry(row)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.close()
+
+
+class CertificateInventory(object):
+    """
+    Answers certificate status queries from the inventory store, only missing and expired
+    entries are described using the ACM API
+    """
+    MAX_WORKERS = 8
+
+    def __init__(self, store, acm_certificate_request):
+        self._store = store
+        self._acm = acm_certificate_request
+
+    def _resolve_arns(self, certificate_ids):
+        """
+        Find ARNs of the certificates unknown to the store by listing account certificates
+
+        :param certificate_ids: set of certificate ids
+        :return: None
+        """
+        logger.debug('Listing certificates to resolve {} certificate id(s)'.format(len(certificate_ids)))
+        for certificate_summary in self._acm.list_certificates():
+            if parse_certificate_id(certificate_summary['CertificateArn']) in certificate_ids:
+                self._store.put_arn(certificate_summary['CertificateArn'])
+
+    def status(self, certificates=None, refresh=False):
+        """
+        Get certificate descriptions, stale entries are refreshed concurrently
+
+        :param certificates: certificate ids or ARNs, all stored certificates by default
+        :param refresh: describe certificates even if cached entries are fresh
+        :return: list of (certificate id, entry, error) tuples
+        """
+        if certificates is None:
+            certificates = [entry['arn'] for entry in self._store.entries()]
+
+        for certificate in certificates:
+            if certificate.startswith('arn:'):
+                self._store.put_arn(certificate)
+
+        certificate_ids = [parse_certificate_id(certificate) for certificate in certificates]
+        now = time.time()
+        stale = []
+        for certificate_id in certificate_ids:
+            entry = self._store.get(certificate_id)
+            if refresh or entry is None or entry['expires_at'] <= now:
+                stale.append(certificate_id)
+
+        unknown = set(certificate_id for certificate_id in stale if self._store.get(certificate_id) is None)
+        if unknown:
+            self._resolve_arns(unknown)
+
+        errors = {}
+        arns = [stored['arn'] for stored in map(self._store.get, stale) if stored]
+        if arns:
+            logger.debug('Describing {} certificate(s)'.format(len(arns)))
+            with futures.ThreadPoolExecutor(max_workers=min(len(arns), CertificateInventory.MAX_WORKERS)) as executor:
+                describing = {executor.submit(self._acm.describe_certificate, arn): arn for arn in arns}
+                for described in futures.as_completed(describing):
+                    try:
+                        self._store.put(described.result())
+                    except Exception as e:
+                        logger.exception('Failed to describe certificate')
+                        errors[parse_certificate_id(describing[described])] = str(e)
+
+        results = []
+        for certificate_id in certificate_ids:
+            entry = self._store.get(certificate_id)
+            if entry is None or entry['certificate'] is None:
+                results.append((certificate_id, None, errors.get(certificate_id, 'Certificate is not found')))
+            else:
+                results.append((certificate_id, entry, errors.get(certificate_id)))
+
+        return results
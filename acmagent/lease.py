@@ -0,0 +1,245 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import urlparse
+import acmagent
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger('acmagent')
+
+
+class SqliteLeaseBackend(object):
+    """
+    Leases stored in a sqlite database, e.g. on a shared volume
+    """
+    def __init__(self, filename):
+        # the connection is shared by the mailbox scanning threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)')
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM leases WHERE key = ? AND expires_at <= ?', (key, now))
+                self._db.execute('INSERT OR IGNORE INTO leases VALUES (?, ?, ?)', (key, owner, now + ttl))
+                row = self._db.execute('SELECT owner FROM leases WHERE key = ?', (key,)).fetchone()
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+        return row[0] == owner
+
+    def renew(self, key, owner, ttl):
+        with self._lock:
+            cursor = self._db.execute('UPDATE leases SET expires_at = ? WHERE key = ? AND owner = ?',
+                                      (time.time() + ttl, key, owner))
+        return cursor.rowcount == 1
+
+    def release(self, key, owner):
+        with self._lock:
+            self._db.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, owner))
+
+
+class FileLeaseBackend(object):
+    """
+    Leases stored as files in a shared directory. Every lease is read, compared and replaced
+    holding the exclusive lock of the directory, so a worker can never remove a lease another
+    worker has just taken over, and files are replaced atomically so readers never see a
+    partially written lease
+    """
+    LOCK_FILENAME = '.lock'
+
+    def __init__(self, directory):
+        self._directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # fcntl locks are held per process, threads of the process take turns on their own lock
+        self._thread_lock = threading.Lock()
+
+    def _filename(self, key):
+        return os.path.join(self._directory, '{}.lease'.format(hashlib.sha1(key).hexdigest()))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            with open(os.path.join(self._directory, FileLeaseBackend.LOCK_FILENAME), 'a') as lock_file:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, filename):
+        try:
+            with open(filename) as lease_file:
+                owner, expires_at = lease_file.read().rsplit(' ', 1)
+                return owner, float(expires_at)
+        except (IOError, ValueError):
+            return None, 0
+
+    def _write(self, filename, owner, ttl):
+        descriptor, temporary = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as lease_file:
+            lease_file.write('{} {}'.format(owner, time.time() + ttl))
+        os.rename(temporary, filename)
+
+    def acquire(self, key, owner, ttl):
+        filename = self._filename(key)
+        with self._locked():
+            lease_owner, expires_at = self._read(filename)
+            if expires_at > time.time():
+                return lease_owner == owner
+            if lease_owner and lease_owner != owner:
+                logger.debug('Replacing expired lease of {}'.format(lease_owner))
+            self._write(filename, owner, ttl)
+            return True
+
+    def renew(self, key, owner, ttl):
+        filename = self._filename(key)
+        with self._locked():
+            if self._read(filename)[0] != owner:
+                return False
+            self._write(filename, owner, ttl)
+            return True
+
+    def release(self, key, owner):
+        filename = self._filename(key)
+        with self._locked():
+            if self._read(filename)[0] == owner:
+                os.remove(filename)
+
+
+class RedisLeaseBackend(object):
+    """
+    Leases stored in Redis or any server speaking the Redis protocol, requires the redis package
+    """
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+
+    def __init__(self, url):
+        if redis is None:
+            raise acmagent.InvalidLeaseBackendException('Redis lease backend requires the redis package')
+        self._redis = redis.StrictRedis.from_url(url)
+
+    def acquire(self, key, owner, ttl):
+        if self._redis.set(key, owner, nx=True, px=int(ttl * 1000)):
+            return True
+
+        return self._redis.get(key) == owner
+
+    def renew(self, key, owner, ttl):
+        return bool(self._redis.eval(RedisLeaseBackend.RENEW_SCRIPT, 1, key, owner, int(ttl * 1000)))
+
+    def release(self, key, owner):
+        self._redis.eval(RedisLeaseBackend.RELEASE_SCRIPT, 1, key, owner)
+
+
+def open_backend(url):
+    """
+    Create lease backend from the url: sqlite:///path/leases.sqlite, file:///path/leases
+    or redis://host:6379/0
+
+    :param url: backend url
+    :return: lease backend
+    """
+    scheme = urlparse.urlparse(url).scheme
+    if scheme == 'sqlite':
+        return SqliteLeaseBackend(url[len('sqlite://'):])
+    if scheme == 'file':
+        return FileLeaseBackend(url[len('file://'):])
+    if scheme in ('redis', 'rediss'):
+        return RedisLeaseBackend(url)
+
+    raise acmagent.InvalidLeaseBackendException('Unknown lease backend "{}", use sqlite://, file:// or redis://'.format(url))
+
+
+class Leases(object):
+    """
+    Time limited exclusive claims on certificate ids and emails shared between confirm workers.
+    Held leases are renewed every third of the TTL while the worker is alive, so waiting for the
+    certificate emails or a long batch does not let them expire, the TTL only bounds how long
+    the leases of a crashed worker block the others
+    """
+    TTL = 300
+
+    def __init__(self, backend, owner=None, ttl=None):
+        self._backend = backend
+        self._owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._ttl = ttl or Leases.TTL
+        self._lock = threading.Lock()
+        self._held = set()
+        self._closed = threading.Event()
+        self._heartbeat = None
+
+    @property
+    def owner(self):
+        return self._owner
+
+    def acquire(self, key):
+        acquired = self._backend.acquire(key, self._owner, self._ttl)
+        logger.debug('{} lease {}'.format('Acquired' if acquired else 'Failed to acquire', key))
+        if acquired:
+            with self._lock:
+                self._held.add(key)
+                if self._heartbeat is None:
+                    self._heartbeat = threading.Thread(target=self._renew_periodically, name='lease-heartbeat')
+                    self._heartbeat.daemon = True
+                    self._heartbeat.start()
+        return acquired
+
+    def release(self, key):
+        with self._lock:
+            self._held.discard(key)
+        self._backend.release(key, self._owner)
+
+    def renew(self):
+        """
+        Extend every held lease by the TTL
+
+        :return: list of keys of the leases which have been lost, e.g. after the process was suspended
+        """
+        with self._lock:
+            keys = list(self._held)
+
+        lost = []
+        for key in keys:
+            try:
+                if not self._backend.renew(key, self._owner, self._ttl):
+                    lost.append(key)
+            except Exception:
+                logger.exception('Failed to renew lease {}'.format(key))
+
+        with self._lock:
+            # leases released during the renewal are not lost
+            lost = [key for key in lost if key in self._held]
+            self._held.difference_update(lost)
+        if lost:
+            logger.warning('Lost lease(s): {}'.format(', '.join(lost)))
+        return lost
+
+    def _renew_periodically(self):
+        while not self._closed.wait(self._ttl / 3.0):
+            self.renew()
+
+    def close(self):
+        """
+        Stop renewing the held leases, they expire after the TTL unless released
+
+        :return: None
+        """
+        self._closed.set()
@@ -0,0 +1,117 @@
+import logging
+import sqlite3
+import threading
+import time
+from acmagent import metrics
+
+logger = logging.getLogger('acmagent')
+
+# certificate lifecycle stages in their expected order
+STAGES = ('requested', 'email_received', 'approval_submitted', 'issued')
+INTERVALS = (
+    ('requested', 'email_received'),
+    ('email_received', 'approval_submitted'),
+    ('approval_submitted', 'issued'),
+    ('requested', 'issued'),
+)
+
+_ledger = None
+
+
+class Ledger(object):
+    """
+    Timestamps of the certificate lifecycle stages stored in a sqlite database, e.g. on a shared
+    volume so that hosts requesting and confirming certificates feed the same ledger. Only the
+    first timestamp of every stage is kept
+    """
+    def __init__(self, filename):
+        # the connection is shared by the mailbox scanning and describing threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS ledger '
+                         '(certificate_id TEXT, stage TEXT, at REAL, PRIMARY KEY (certificate_id, stage))')
+
+    def record(self, certificate_id, stage, at=None):
+        """
+        :param certificate_id: certificate id
+        :param stage: one of STAGES
+        :param at: unix time of the stage, now by default
+        :return: None
+        """
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO ledger VALUES (?, ?, ?)',
+                             (certificate_id.lower(), stage, time.time() if at is None else at))
+
+    def entries(self):
+        """
+        :return: dict of certificate id to {stage: unix time} dicts
+        """
+        entries = {}
+        with self._lock:
+            for certificate_id, stage, at in self._db.execute('SELECT certificate_id, stage, at FROM ledger'):
+                entries.setdefault(certificate_id, {})[stage] = at
+        return entries
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def start(filename):
+    """
+    Start recording the lifecycle stages into the given ledger file
+
+    :param filename: sqlite file name
+    :return: Ledger
+    """
+    global _ledger
+    _ledger = Ledger(filename)
+    return _ledger
+
+
+def stop():
+    global _ledger
+    if _ledger is not None:
+        _ledger.close()
+        _ledger = None
+
+
+def record(certificate_id, stage, at=None):
+    """
+    Record the stage of the certificate when a ledger has been started
+
+    :param certificate_id: certificate id
+    :param stage: one of STAGES
+    :param at: unix time of the stage, now by default
+    :return: None
+    """
+    ledger = _ledger
+    if ledger is None:
+        return
+
+    try:
+        ledger.record(certificate_id, stage, at)
+    except sqlite3.Error as e:
+        logger.exception('Failed to record {} stage of {} certificate'.format(stage, certificate_id))
+
+
+def report(entries):
+    """
+    Latency percentiles of every lifecycle interval, certificates which have not reached
+    both stages of the interval are left out
+
+    :param entries: Ledger.entries()
+    :return: list of {'stage': ..., 'count': ..., 'p50': ..., 'p95': ..., 'p99': ..., 'max': ...} dicts
+    """
+    results = []
+    for start_stage, end_stage in INTERVALS:
+        latencies = sorted(stages[end_stage] - stages[start_stage] for stages in entries.values()
+                           if start_stage in stages and end_stage in stages)
+        result = {'stage': '{}..{}'.format(start_stage, end_stage), 'count': len(latencies)}
+        for percent in (50, 95, 99):
+            value = metrics.percentile(latencies, percent)
+            result['p{}'.format(percent)] = round(value, 3) if value is not None else None
+        result['max'] = round(latencies[-1], 3) if latencies else None
+        results.append(result)
+
+    return results
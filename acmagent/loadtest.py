@@ -0,0 +1,164 @@
+import BaseHTTPServer
+import SocketServer
+import collections
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent import futures
+from acmagent.metrics import percentile
+
+logger = logging.getLogger('acmagent')
+
+
+class StubACMRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        operation = (self.headers.getheader('X-Amz-Target') or '').split('.')[-1]
+        status, response = self.server.respond(operation, json.loads(body or '{}'))
+
+        payload = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('x-amzn-RequestId', str(uuid.uuid4()))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug('Stub ACM: ' + format % args)
+
+
+class StubACMServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local endpoint speaking the ACM JSON protocol with configurable latency, error rate
+    and throttle rate, the responses are just good enough for the acmagent calls
+    """
+    daemon_threads = True
+    CERTIFICATE_ARN = 'arn:aws:acm:us-east-1:123456789012:certificate/{}'
+
+    def __init__(self, latency=0, error_rate=0, throttle_rate=0, seed=None):
+        """
+        :param latency: seconds every response is delayed by
+        :param error_rate: share of the requests failed with InternalFailure
+        :param throttle_rate: share of the requests failed with ThrottlingException
+        :param seed: random seed, makes the failures reproducible
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubACMRequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.requests = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def respond(self, operation, params):
+        with self._lock:
+            draw = self._random.random()
+            self.requests[operation] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if draw < self.throttle_rate:
+            self._count('ThrottlingException')
+            return 400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'}
+        if draw < self.throttle_rate + self.error_rate:
+            self._count('InternalFailure')
+            return 500, {'__type': 'InternalFailure', 'message': 'Stub failure'}
+
+        if operation == 'RequestCertificate':
+            return 200, {'CertificateArn': StubACMServer.CERTIFICATE_ARN.format(uuid.uuid4())}
+        if operation == 'DescribeCertificate':
+            return 200, {'Certificate': {
+                'CertificateArn': params.get('CertificateArn'),
+                'DomainName': 'stub.example.com',
+                'Status': 'PENDING_VALIDATION'
+            }}
+        if operation == 'ListCertificates':
+            return 200, {'CertificateSummaryList': []}
+
+        return 400, {'__type': 'InvalidRequestException', 'message': 'Operation {} is not stubbed'.format(operation)}
+
+    def _count(self, outcome):
+        with self._lock:
+            self.requests[outcome] += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
+
+
+def stub_client(endpoint_url, max_pool_connections=None):
+    """
+    Create ACM client pointed at the stub endpoint with dummy credentials
+
+    :param endpoint_url: StubACMServer url
+    :param max_pool_connections: HTTP connection pool size, should match the concurrency
+    :return: botocore ACM client
+    """
+    session = botocore.session.get_session()
+    return session.create_client('acm', region_name='us-east-1', endpoint_url=endpoint_url,
+                                 aws_access_key_id='stub', aws_secret_access_key='stub',
+                                 config=Config(max_pool_connections=max_pool_connections or 10))
+
+
+def run_workload(acm_certificate_request, certificates, concurrency):
+    """
+    Request the certificates using the given number of threads
+
+    :param acm_certificate_request: RequestCertificate
+    :param certificates: list of RequestCertificate parameters
+    :param concurrency: number of threads
+    :return: dict with throughput, latency percentiles, retries and errors
+    """
+    def call(certificate):
+        started = time.time()
+        error = None
+        try:
+            metadata = acm_certificate_request.request_certificate(certificate).get('ResponseMetadata', {})
+        except ClientError as e:
+            metadata = e.response.get('ResponseMetadata', {})
+            error = e.response.get('Error', {}).get('Code')
+        except Exception as e:
+            metadata = {}
+            error = e.__class__.__name__
+
+        return time.time() - started, metadata.get('RetryAttempts', 0), error
+
+    started = time.time()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, certificates))
+    elapsed = time.time() - started
+
+    latencies = sorted(round(latency, 4) for latency, retries, error in results)
+    errors = collections.Counter(error for latency, retries, error in results if error)
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 1) if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'retries': sum(retries for latency, retries, error in results),
+        'errors': dict(errors)
+    }
@@ -0,0 +1,202 @@
+import collections
+import contextlib
+import glob
+import logging
+import mmap
+import os
+import re
+import acmagent
+from acmagent import mailsource
+
+logger = logging.getLogger('acmagent')
+
+@contextlib.contextmanager
+def _mapped(filename):
+    with open(filename, 'rb') as mapped_file:
+        if not os.fstat(mapped_file.fileno()).st_size:
+            yield ''
+            return
+
+        buffer = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buffer
+        finally:
+            buffer.close()
+
+
+def scan_file(filename):
+    """
+    :param filename: raw email file
+    :return: lower case certificate id or None
+    """
+    with _mapped(filename) as buffer:
+        return mailsource.find_certificate_id(buffer)
+
+
+class LocalMailSource(mailsource.MailSource):
+    """
+    Emails delivered to local files, only emails of the requested certificates are parsed
+    """
+    def __init__(self, mailbox, index_days=None):
+        super(LocalMailSource, self).__init__(mailbox, index_days)
+        try:
+            self._path = os.path.expanduser(mailbox[self.KEY])
+        except (TypeError, AttributeError) as e:
+            logger.exception('IMAP credentials file is not well formatted')
+            raise acmagent.InvalidIMAPCredentailsFileException('IMAP credentials file is empty or not well formatted')
+
+        self._approved_folder = mailbox.get('approved_folder')
+
+    @property
+    def location(self):
+        return self._path
+
+    def open(self):
+        if not os.path.exists(self._path):
+            raise acmagent.FailedToFetchEmailException('{} "{}" does not exist'.format(self.KEY, self._path))
+
+    def _read(self, key):
+        raise NotImplementedError()
+
+    def fetch(self, keys):
+        messages = []
+        for key in keys:
+            try:
+                messages.append((key, self._read(key)))
+            except IOError as e:
+                # emails of a shared mailbox can be moved by another worker or mail client after the scan
+                logger.info('Email: {} has been moved or deleted, skipping it: {}'.format(key, e))
+                self._discard(key)
+        return messages
+
+
+class MaildirSource(LocalMailSource):
+    """
+    Maildir source, emails with the S flag are skipped and approved emails are flagged
+    as seen and optionally moved to the approved_folder Maildir++ subfolder
+    """
+    KEY = 'maildir'
+
+    def __init__(self, mailbox, index_days=None):
+        super(MaildirSource, self).__init__(mailbox, index_days)
+        self._scanned = set()
+
+    @staticmethod
+    def _flags(name):
+        return name.split(':2,', 1)[1] if ':2,' in name else ''
+
+    def _scan(self):
+        since = self._since()
+        for subdirectory in ('new', 'cur'):
+            directory = os.path.join(self._path, subdirectory)
+            for name in os.listdir(directory):
+                key = os.path.join(subdirectory, name)
+                if name.startswith('.') or key in self._scanned:
+                    continue
+                self._scanned.add(key)
+                if 'S' in MaildirSource._flags(name):
+                    continue
+
+                filename = os.path.join(directory, name)
+                modified = os.path.getmtime(filename)
+                if since and modified < since:
+                    continue
+                yield key, modified, scan_file(filename)
+
+    def _read(self, key):
+        with open(os.path.join(self._path, key), 'rb') as email_file:
+            return email_file.read()
+
+    def mark_approved(self, keys):
+        target = os.path.join(self._path, '.' + self._approved_folder) if self._approved_folder else self._path
+        try:
+            for subdirectory in ('cur', 'new', 'tmp'):
+                if not os.path.isdir(os.path.join(target, subdirectory)):
+                    os.makedirs(os.path.join(target, subdirectory))
+
+            for key in keys:
+                name = os.path.basename(key)
+                flags = ''.join(sorted(set(MaildirSource._flags(name) + 'S')))
+                approved_name = '{}:2,{}'.format(name.split(':2,', 1)[0], flags)
+                logger.debug('Marking email: {} as read in {}'.format(key, target))
+                os.rename(os.path.join(self._path, key), os.path.join(target, 'cur', approved_name))
+        except OSError as e:
+            raise acmagent.ACManagerException('Failed to mark the approved emails in {}: {}'.format(target, e))
+
+
+class MboxSource(LocalMailSource):
+    """
+    Read only mbox source, emails with the R status are skipped. The file is memory-mapped and
+    scanned incrementally, emails appended during the session are picked up by the next lookup
+    """
+    KEY = 'mbox'
+    STATUS_PATTERN = re.compile(r'^Status:[^\n]*R', re.MULTILINE)
+
+    def __init__(self, mailbox, index_days=None):
+        super(MboxSource, self).__init__(mailbox, index_days)
+        self._scanned_size = 0
+        self._offsets = {}
+
+    def _scan(self):
+        size = os.path.getsize(self._path)
+        if size <= self._scanned_size:
+            return
+
+        with _mapped(self._path) as buffer:
+            start = self._scanned_size
+            while start < size:
+                end = buffer.find('\nFrom ', start)
+                end = size if end < 0 else end + 1
+                headers_end = buffer.find('\n\n', start, end)
+                headers = buffer[start:end if headers_end < 0 else headers_end]
+                if not MboxSource.STATUS_PATTERN.search(headers):
+                    key = str(start)
+                    self._offsets[key] = (start, end)
+                    yield key, start, mailsource.find_certificate_id(buffer, start, end)
+                start = end
+
+        self._scanned_size = size
+
+    def _read(self, key):
+        start, end = self._offsets[key]
+        with open(self._path, 'rb') as mbox_file:
+            mbox_file.seek(start)
+            raw_message = mbox_file.read(end - start)
+
+        # drop the "From " separator line
+        return raw_message.split('\n', 1)[1] if raw_message.startswith('From ') else raw_message
+
+
+class EmlSource(LocalMailSource):
+    """
+    Read only source of a single .eml file or a directory of .eml files
+    """
+    KEY = 'eml'
+
+    def __init__(self, mailbox, index_days=None):
+        super(EmlSource, self).__init__(mailbox, index_days)
+        self._scanned = set()
+
+    def _scan(self):
+        since = self._since()
+        filenames = glob.glob(os.path.join(self._path, '*.eml')) if os.path.isdir(self._path) else [self._path]
+        for filename in filenames:
+            if filename in self._scanned:
+                continue
+            self._scanned.add(filename)
+
+            modified = os.path.getmtime(filename)
+            if since and modified < since:
+                continue
+            yield filename, modified, scan_file(filename)
+
+    def _read(self, key):
+        with open(key, 'rb') as email_file:
+            return email_file.read()
+
+
+SOURCES = collections.OrderedDict([
+    (MaildirSource.KEY, MaildirSource),
+    (MboxSource.KEY, MboxSource),
+    (EmlSource.KEY, EmlSource),
+])
@@ -0,0 +1,126 @@
+import logging
+import re
+import time
+import acmagent
+from acmagent import trace
+
+logger = logging.getLogger('acmagent')
+
+CERTIFICATE_MARKER = 'Certificate identifier:'
+# the marker, whitespace, the id and a few quoted-printable soft line breaks
+CERTIFICATE_WINDOW = 128
+CERTIFICATE_ID_PATTERN = re.compile(r'Certificate identifier:\s*([0-9a-fA-F-]{36})')
+
+
+def find_certificate_id(buffer, start=0, end=None):
+    """
+    Find the certificate id in the raw email without parsing it, the buffer can be
+    a string or a memory-mapped file
+
+    :param buffer: raw email or mbox
+    :param start: offset of the email in the buffer
+    :param end: end of the email in the buffer
+    :return: lower case certificate id or None
+    """
+    position = buffer.find(CERTIFICATE_MARKER, start, len(buffer) if end is None else end)
+    if position < 0:
+        return None
+
+    window = buffer[position:position + CERTIFICATE_WINDOW]
+    # quoted-printable soft line breaks can split the certificate identifier
+    match = CERTIFICATE_ID_PATTERN.match(window.replace('=\r\n', '').replace('=\n', ''))
+    return match.group(1).lower() if match else None
+
+
+class MailSource(object):
+    """
+    Source of the certificate emails, e.g. an IMAP folder, a maildir or an S3 prefix. Emails are
+    listed for many certificates at once and fetched in batches, local sources scan every new
+    email once per session for the certificate identifier and keep an index of them
+    """
+    # mailbox property holding the source location, e.g. maildir
+    KEY = None
+
+    def __init__(self, mailbox, index_days=None):
+        """
+        :param mailbox: single mailbox credentials
+        :param index_days: scan only the emails received in the last index_days days
+        """
+        self._index_days = index_days
+        self._index = {}
+        self._order = {}
+
+    @property
+    def location(self):
+        raise NotImplementedError()
+
+    def open(self):
+        pass
+
+    def _since(self):
+        return time.time() - self._index_days * 24 * 60 * 60 if self._index_days else None
+
+    def _scan(self):
+        """
+        :return: generator of (key, order, certificate id) tuples of the emails not scanned yet
+        """
+        raise NotImplementedError()
+
+    def list(self, certificate_ids):
+        """
+        Find the emails of the certificates
+
+        :param certificate_ids: list of certificate ids
+        :return: dict of lower case certificate id to list of email keys, newest first
+        """
+        scanned = 0
+        with trace.span('scan', 'mail', source=self.KEY):
+            for key, order, certificate_id in self._scan():
+                scanned += 1
+                self._order[key] = order
+                if certificate_id:
+                    self._index.setdefault(certificate_id, []).append(key)
+
+        logger.debug('Scanned {} email(s) in {}, {} certificate(s) in total'.format(
+            scanned, self.location, len(self._index)))
+        return {certificate_id.lower(): sorted(self._index[certificate_id.lower()], key=self._order.get, reverse=True)
+                for certificate_id in certificate_ids if self._index.get(certificate_id.lower())}
+
+    def search(self, certificate_id):
+        """
+        Find the emails of a single certificate
+
+        :param certificate_id: certificate id
+        :return: iterator of email key chunks, newest first
+        """
+        keys = self.list([certificate_id]).get(certificate_id.lower())
+        return iter([keys] if keys else [])
+
+    def fetch(self, keys):
+        """
+        :param keys: list of email keys
+        :return: list of (key, raw email) tuples, emails moved or deleted since the scan are left out
+        """
+        raise NotImplementedError()
+
+    def forget(self, certificate_id):
+        self._index.pop(certificate_id.lower(), None)
+
+    def _discard(self, key):
+        """
+        Forget the email moved or deleted since the scan, e.g. by another worker or mail client
+
+        :param key: email key
+        :return: None
+        """
+        self._order.pop(key, None)
+        for keys in self._index.values():
+            if key in keys:
+                keys.remove(key)
+
+    def mark_approved(self, keys):
+        logger.debug('{} source is read only, emails: {} are left as they are'.format(self.KEY, ', '.join(keys)))
+
+    def close(self):
+        pass
+
@@ -0,0 +1,98 @@
+import json
+import math
+import threading
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set the current value of the metric, e.g. the ACM request rate
+
+    :param name: metric name
+    :param value: metric value
+    :param labels: metric labels, e.g. region
+    :return: None
+    """
+    with _lock:
+        _metrics[_key(name, labels)] = value
+
+
+def increment(name, value=1, **labels):
+    """
+    Add the value to the counter
+
+    :param name: metric name
+    :param value: increment
+    :param labels: metric labels
+    :return: None
+    """
+    key = _key(name, labels)
+    with _lock:
+        _metrics[key] = _metrics.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """
+    Add the value to the summary of the metric, e.g. handshake time
+
+    :param name: metric name
+    :param value: observed value
+    :param labels: metric labels
+    :return: None
+    """
+    key = _key(name, labels)
+    with _lock:
+        summary = _metrics.setdefault(key, {'count': 0, 'sum': 0, 'max': 0})
+        summary['count'] += 1
+        summary['sum'] += value
+        summary['max'] = max(summary['max'], value)
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile
+
+    :param values: sorted list of values
+    :param percent: percentile, e.g. 95
+    :return: value or None for an empty list
+    """
+    if not values:
+        return None
+
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def get(name, **labels):
+    with _lock:
+        return _metrics.get(_key(name, labels))
+
+
+def snapshot():
+    """
+    :return: list of {'name': ..., 'labels': {...}, 'value': ...} dicts sorted by name
+    """
+    with _lock:
+        return [{'name': name, 'labels': dict(labels), 'value': dict(value) if isinstance(value, dict) else value}
+                for (name, labels), value in sorted(_metrics.items())]
+
+
+def write(filename):
+    """
+    Write the metrics snapshot to the file as JSON
+
+    :param filename: metrics file name
+    :return: None
+    """
+    with open(filename, 'w') as metrics_file:
+        json.dump(snapshot(), metrics_file, indent=2, sort_keys=True)
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
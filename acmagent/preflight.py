@@ -0,0 +1,100 @@
+import re
+import acmagent
+
+# ACM default quota of domain names per certificate, including the DomainName
+MAX_DOMAIN_NAMES = 10
+MAX_DOMAIN_NAME_LENGTH = 253
+# the DomainName becomes the subject common name which is limited to 64 characters
+MAX_FIRST_DOMAIN_NAME_LENGTH = 64
+NAME_PATTERN = re.compile(r'^(\*\.)?((?!-)[a-z0-9-]{1,63}(?<!-)\.)+(?!-)(?=[a-z0-9-]*[a-z])[a-z0-9-]{2,63}(?<!-)$',
+                          re.IGNORECASE)
+
+
+class Validator(object):
+    """
+    Checks certificate specs locally before they are requested, so bad input does not cost
+    ACM calls. The validator keeps no state between the specs, so it can check an unbounded
+    stream of specs in constant memory
+    """
+    def __init__(self, max_domain_names=None):
+        """
+        :param max_domain_names: domain names allowed per certificate, MAX_DOMAIN_NAMES by default
+        """
+        self._max_domain_names = max_domain_names or MAX_DOMAIN_NAMES
+
+    @staticmethod
+    def _name_error(name):
+        if not name or not isinstance(name, basestring):
+            return 'Domain name is missing'
+        if len(name) > MAX_DOMAIN_NAME_LENGTH:
+            return '{} is longer than {} characters'.format(name, MAX_DOMAIN_NAME_LENGTH)
+        if not NAME_PATTERN.match(name):
+            return '{} is not a fully qualified domain name'.format(name)
+        return None
+
+    @staticmethod
+    def _covers(validation_domain, name):
+        name = name.lower()[2:] if name.startswith('*.') else name.lower()
+        return name == validation_domain or name.endswith('.' + validation_domain)
+
+    def errors(self, certificate):
+        """
+        :param certificate: request.Certificate
+        :return: list of error messages, empty when the certificate can be requested
+        """
+        errors = []
+        domain_name = certificate.domain_name
+        alternative_names = certificate.subject_alternative_names or []
+        if isinstance(alternative_names, basestring):
+            alternative_names = [alternative_names]
+
+        for name in [domain_name] + list(alternative_names):
+            error = Validator._name_error(name)
+            if error and error not in errors:
+                errors.append(error)
+        if errors:
+            return errors
+
+        if len(domain_name) > MAX_FIRST_DOMAIN_NAME_LENGTH:
+            errors.append('{} is longer than {} characters, use it as an alternative name'.format(
+                domain_name, MAX_FIRST_DOMAIN_NAME_LENGTH))
+
+        seen = set()
+        duplicates = []
+        for name in alternative_names:
+            if name.lower() in seen and name.lower() not in duplicates:
+                duplicates.append(name.lower())
+            seen.add(name.lower())
+        if duplicates:
+            errors.append('Duplicate alternative names: {}'.format(', '.join(duplicates)))
+
+        names = set([domain_name.lower()]) | seen
+        if len(names) > self._max_domain_names:
+            errors.append('Certificate has {} domain names, at most {} are allowed'.format(
+                len(names), self._max_domain_names))
+
+        # the setter expands the validation domain into an option of every name
+        validation_domains = set(option['ValidationDomain'].lower()
+                                 for option in certificate.domain_validation_options or [])
+        for validation_domain in sorted(validation_domains):
+            error = Validator._name_error(validation_domain)
+            if error:
+                errors.append('Validation domain {}'.format(error))
+                continue
+            uncovered = sorted(name for name in names if not Validator._covers(validation_domain, name))
+            if uncovered:
+                errors.append('Validation domain {} is not a suffix of {}'.format(
+                    validation_domain, ', '.join(uncovered)))
+
+        return errors
+
+    def check(self, certificate):
+        """
+        :param certificate: request.Certificate
+        :return: certificate
+        :raise acmagent.InvalidCertificateSpecException: when the certificate fails any check
+        """
+        errors = self.errors(certificate)
+        if errors:
+            raise acmagent.InvalidCertificateSpecException('; '.join(errors))
+        return certificate
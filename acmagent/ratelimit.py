@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+from acmagent import metrics
+
+logger = logging.getLogger('acmagent')
+
+THROTTLING_ERRORS = ('ThrottlingException', 'LimitExceededException', 'Throttling', 'TooManyRequestsException')
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Paces API calls of all threads sharing the limiter. The rate is halved when a call is
+    throttled and grows back by INCREASE calls per second after every successful call
+    """
+    INITIAL_RATE = 5.0
+    MIN_RATE = 0.5
+    MAX_RATE = 50.0
+    INCREASE = 0.1
+    DECREASE = 0.5
+
+    def __init__(self, rate=None, min_rate=None, max_rate=None, labels=None, clock=None, sleep=None):
+        """
+        :param rate: initial calls per second
+        :param labels: metric labels, e.g. region and account
+        """
+        self._rate = rate or AdaptiveRateLimiter.INITIAL_RATE
+        self._min_rate = min_rate or AdaptiveRateLimiter.MIN_RATE
+        self._max_rate = max_rate or AdaptiveRateLimiter.MAX_RATE
+        self._labels = labels or {}
+        self._clock = clock or time.time
+        self._sleep = sleep or time.sleep
+        self._lock = threading.Lock()
+        self._next_call = 0
+        self._last_decrease = 0
+        self._publish()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def _publish(self):
+        metrics.set_gauge('acm_rate_limit', round(self._rate, 3), **self._labels)
+
+    def acquire(self):
+        """
+        Wait for the next call slot
+
+        :return: None
+        """
+        with self._lock:
+            now = self._clock()
+            call_at = max(now, self._next_call)
+            self._next_call = call_at + 1.0 / self._rate
+
+        if call_at > now:
+            self._sleep(call_at - now)
+
+    def throttled(self):
+        with self._lock:
+            now = self._clock()
+            # calls sent at the old rate are throttled together, slow down once for all of them
+            if now - self._last_decrease >= 1.0 / self._rate:
+                self._rate = max(self._min_rate, self._rate * AdaptiveRateLimiter.DECREASE)
+                self._last_decrease = now
+                logger.debug('Throttled, slowing down to {:.2f} calls/s'.format(self._rate))
+            self._publish()
+        metrics.increment('acm_throttled', **self._labels)
+
+    def succeeded(self):
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + AdaptiveRateLimiter.INCREASE)
+            self._publish()
+
+    def register(self, client):
+        """
+        Pace every attempt of the botocore client calls including the retries
+
+        :param client: botocore client
+        :return: None
+        """
+        prefix = client.meta.service_model.endpoint_prefix
+        client.meta.events.register_first('request-created.{}'.format(prefix), self._on_request_created)
+        client.meta.events.register('needs-retry.{}'.format(prefix), self._on_needs_retry)
+
+    def _on_request_created(self, **kwargs):
+        self.acquire()
+
+    def _on_needs_retry(self, response=None, **kwargs):
+        if response is None:
+            return None
+
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code in THROTTLING_ERRORS:
+            self.throttled()
+        elif not error_code:
+            self.succeeded()
+        return None
+
+
+def shared_limiter(region, account):
+    """
+    Get the limiter shared by all clients of the region and account in the process
+
+    :param region: AWS region
+    :param account: account identifier, e.g. the access key id
+    :return: AdaptiveRateLimiter
+    """
+    with _lock:
+        key = (region, account)
+        if key not in _limiters:
+            # only the end of the access key id is exposed in the metrics
+            _limiters[key] = AdaptiveRateLimiter(labels={
+                'region': region or 'default',
+                'account': '*{}'.format(account[-4:]) if account else 'default'
+            })
+        return _limiters[key]
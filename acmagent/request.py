@@ -1,11 +1,33 @@
+import calendar
 import json
+import itertools
 import acmagent
 import logging
+import socket
 import botocore
 import botocore.session
+from botocore.config import Config
+from acmagent import ledger
+from acmagent import ratelimit
+from acmagent import trace
 
 logger = logging.getLogger('acmagent')
 
+# botocore connect and read timeout default
+ACM_TIMEOUT = 60
+TIMEOUT_ERRORS = (socket.timeout,)
+try:
+    # botocore 1.11 and later raise its own timeout errors
+    from botocore.exceptions import ConnectTimeoutError, ReadTimeoutError
+    TIMEOUT_ERRORS += (ConnectTimeoutError, ReadTimeoutError)
+except ImportError:
+    pass
+try:
+    from botocore.vendored.requests.exceptions import Timeout
+    TIMEOUT_ERRORS += (Timeout,)
+except ImportError:
+    pass
+
 
 class Certificate(object):
     """
@@ -32,6 +54,44 @@ class Certificate(object):
             logger.exception('Unknown certificate property')
             raise acmagent.InvalidCertificateJsonFileException('Unknown property {} in the specified json file'.format(e.args[0]))
 
+    @staticmethod
+    def _expand(value, substitutions):
+        # only strings have placeholders, e.g. null or numbers are passed as they are
+        return value.format(**substitutions) if isinstance(value, basestring) else value
+
+    @classmethod
+    def from_template(cls, template):
+        """
+        Lazily expand a certificate template into certificates, every combination of the
+        "Dimensions" values is substituted into the {placeholders} of the other properties, e.g.
+
+        {"DomainName": "{svc}.{env}.example.com", "Dimensions": {"svc": ["api", "web"], "env": ["dev", "prod"]}}
+
+        :param template: cli input json with the additional Dimensions property
+        :return: generator of Certificate objects
+        """
+        cli_input_json = {k: v for k, v in template.items() if k != 'Dimensions'}
+        dimensions = template.get('Dimensions') or {}
+        if not isinstance(dimensions, dict):
+            raise acmagent.InvalidCertificateJsonFileException('Dimensions of the specified template must be an object')
+        names = sorted(dimensions.keys())
+        for name in names:
+            if not isinstance(dimensions[name], list):
+                raise acmagent.InvalidCertificateJsonFileException(
+                    'Dimension {} in the specified template must be a list'.format(name))
+
+        for values in itertools.product(*[dimensions[name] for name in names]):
+            substitutions = dict(zip(names, values))
+            try:
+                yield cls.from_json_input({
+                    k: [Certificate._expand(value, substitutions) for value in v] if isinstance(v, list)
+                    else Certificate._expand(v, substitutions)
+                    for k, v in cli_input_json.items()
+                })
+            except KeyError as e:
+                logger.exception('Unknown template dimension')
+                raise acmagent.InvalidCertificateJsonFileException('Unknown dimension {} in the specified template'.format(e.args[0]))
+
     @property
     def domain_name(self):
         return self._domain_name
@@ -112,12 +172,97 @@ class RequestCertificate(object):
     """
     Sends actual request to AWS
     """
-    def __init__(self):
-        self._acm_client = self._setup_acm_client()
+    def __init__(self, acm_client=None, rate_limiter=None, connect_timeout=None, read_timeout=None, deadline=None):
+        """
+        :param acm_client: optional botocore ACM client, e.g. pointed at a stub endpoint
+        :param rate_limiter: optional ratelimit.AdaptiveRateLimiter, by default the limiter
+            is shared by all the clients of the region and account in the process
+        :param connect_timeout: ACM connect timeout in seconds, botocore default when not set
+        :param read_timeout: ACM read timeout in seconds, botocore default when not set
+        :param deadline: optional deadline.Deadline of the whole operation
+        """
+        self._account = None
+        self._deadline = deadline
+        self._acm_client = acm_client or self._setup_acm_client(connect_timeout, read_timeout)
+        self._rate_limiter = rate_limiter or ratelimit.shared_limiter(self._acm_client.meta.region_name, self._account)
+        self._rate_limiter.register(self._acm_client)
+        if self._deadline:
+            self._register_deadline()
+
+    @property
+    def rate_limiter(self):
+        return self._rate_limiter
+
+    def _register_deadline(self):
+        """
+        Check the deadline before every attempt of the client calls, no attempt including
+        the retries starts once it has passed
+
+        :return: None
+        """
+        prefix = self._acm_client.meta.service_model.endpoint_prefix
+        self._acm_client.meta.events.register('request-created.{}'.format(prefix), self._on_request_created)
+
+    def _on_request_created(self, operation_name=None, **kwargs):
+        self._deadline.check('ACM {}'.format(operation_name))
+
+    def _call(self, operation, method, *args, **kwargs):
+        stage = 'ACM {}'.format(operation)
+        if self._deadline:
+            self._deadline.check(stage)
+        try:
+            return method(*args, **kwargs)
+        except TIMEOUT_ERRORS as e:
+            raise acmagent.OperationTimeoutException('{} timed out'.format(stage), stage)
 
     def request_certificate(self, certificate):
-        return self._acm_client.request_certificate(**certificate)
+        with trace.span('RequestCertificate', 'acm', domain_name=certificate.get('DomainName')):
+            response = self._call('RequestCertificate', self._acm_client.request_certificate, **certificate)
+
+        ledger.record(response['CertificateArn'].split('/')[-1], 'requested')
+        return response
+
+    def describe_certificate(self, certificate_arn):
+        with trace.span('DescribeCertificate', 'acm', certificate_arn=certificate_arn):
+            certificate = self._call('DescribeCertificate', self._acm_client.describe_certificate,
+                                     CertificateArn=certificate_arn)['Certificate']
+
+        # certificates requested by other tools enter the ledger with their creation time
+        certificate_id = certificate_arn.split('/')[-1]
+        if certificate.get('CreatedAt'):
+            ledger.record(certificate_id, 'requested', calendar.timegm(certificate['CreatedAt'].utctimetuple()))
+        if certificate.get('Status') == 'ISSUED' and certificate.get('IssuedAt'):
+            ledger.record(certificate_id, 'issued', calendar.timegm(certificate['IssuedAt'].utctimetuple()))
+        return certificate
+
+    def get_certificate(self, certificate_arn):
+        with trace.span('GetCertificate', 'acm', certificate_arn=certificate_arn):
+            return self._call('GetCertificate', self._acm_client.get_certificate, CertificateArn=certificate_arn)
+
+    def list_certificates(self):
+        """
+        Iterate over certificate summaries of the account, one page is requested at a time
+
+        :return: generator of {'CertificateArn': ..., 'DomainName': ...} dicts
+        """
+        pages = iter(self._acm_client.get_paginator('list_certificates').paginate())
+        while True:
+            with trace.span('ListCertificates', 'acm'):
+                page = self._call('ListCertificates', next, pages, None)
+            if page is None:
+                return
+            for certificate_summary in page['CertificateSummaryList']:
+                yield certificate_summary
 
-    def _setup_acm_client(self):
+    def _setup_acm_client(self, connect_timeout=None, read_timeout=None):
+        if self._deadline:
+            # the client timeouts can not outlast the deadline
+            connect_timeout = self._deadline.timeout(connect_timeout or ACM_TIMEOUT, 'ACM CONNECT')
+            read_timeout = self._deadline.timeout(read_timeout or ACM_TIMEOUT, 'ACM CONNECT')
+        timeouts = {name: value for name, value in (('connect_timeout', connect_timeout), ('read_timeout', read_timeout))
+                    if value is not None}
         session = botocore.session.get_session()
-        return session.create_client('acm')
+        credentials = session.get_credentials()
+        # the access key id identifies the account without an extra STS call
+        self._account = credentials.access_key if credentials else None
+        return session.create_client('acm', config=Config(**timeouts))
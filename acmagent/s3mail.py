@@ -0,0 +1,104 @@
+import calendar
+import contextlib
+import logging
+import urlparse
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent import futures
+import acmagent
+from acmagent import mailsource
+
+logger = logging.getLogger('acmagent')
+
+
+class S3Source(mailsource.MailSource):
+    """
+    Emails stored under an S3 prefix by the SES receipt rule S3 action. New objects are listed
+    once per session and only their first SCAN_BYTES are read to find the certificate identifier,
+    approved emails are moved under approved_prefix when it is set
+    """
+    KEY = 's3'
+    # the identifier is in the text part following the headers of the approval email
+    SCAN_BYTES = 64 * 1024
+    MAX_WORKERS = 8
+
+    def __init__(self, mailbox, index_days=None):
+        super(S3Source, self).__init__(mailbox, index_days)
+        url = urlparse.urlparse(mailbox[self.KEY])
+        if url.scheme != 's3' or not url.netloc:
+            raise acmagent.InvalidIMAPCredentailsFileException(
+                'S3 source must be s3://bucket/prefix, got "{}"'.format(mailbox[self.KEY]))
+
+        self._bucket = url.netloc
+        self._prefix = url.path.lstrip('/')
+        self._approved_prefix = mailbox.get('approved_prefix')
+        self._region = mailbox.get('region')
+        self._endpoint_url = mailbox.get('endpoint_url')
+        self._client = None
+        self._executor = None
+        self._scanned = set()
+
+    @property
+    def location(self):
+        return 's3://{}/{}'.format(self._bucket, self._prefix)
+
+    def open(self):
+        # custom endpoints, e.g. S3 compatible storage, are addressed by path
+        config = Config(max_pool_connections=S3Source.MAX_WORKERS,
+                        s3={'addressing_style': 'path'} if self._endpoint_url else None)
+        self._client = botocore.session.get_session().create_client(
+            's3', region_name=self._region, endpoint_url=self._endpoint_url, config=config)
+        self._executor = futures.ThreadPoolExecutor(S3Source.MAX_WORKERS)
+
+    def _list_keys(self):
+        since = self._since()
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=self._prefix):
+            for summary in page.get('Contents', []):
+                key = summary['Key']
+                if key in self._scanned or (self._approved_prefix and key.startswith(self._approved_prefix)):
+                    continue
+                self._scanned.add(key)
+
+                modified = calendar.timegm(summary['LastModified'].utctimetuple())
+                if since and modified < since:
+                    continue
+                yield key, modified
+
+    def _get(self, key, length=None):
+        options = {'Range': 'bytes=0-{}'.format(length - 1)} if length else {}
+        response = self._client.get_object(Bucket=self._bucket, Key=key, **options)
+        with contextlib.closing(response['Body']) as body:
+            return body.read()
+
+    def _scan_object(self, key):
+        return mailsource.find_certificate_id(self._get(key, S3Source.SCAN_BYTES))
+
+    def _scan(self):
+        keys = list(self._list_keys())
+        certificate_ids = self._executor.map(self._scan_object, [key for key, modified in keys])
+        for (key, modified), certificate_id in zip(keys, certificate_ids):
+            yield key, modified, certificate_id
+
+    def fetch(self, keys):
+        return zip(keys, self._executor.map(self._get, keys))
+
+    def mark_approved(self, keys):
+        if not self._approved_prefix:
+            return super(S3Source, self).mark_approved(keys)
+
+        try:
+            for key in keys:
+                approved_key = self._approved_prefix + key[len(self._prefix):].lstrip('/')
+                logger.debug('Moving email: {} to {}'.format(key, approved_key))
+                self._client.copy_object(Bucket=self._bucket, Key=approved_key,
+                                         CopySource={'Bucket': self._bucket, 'Key': key})
+                self._client.delete_object(Bucket=self._bucket, Key=key)
+        except (BotoCoreError, ClientError) as e:
+            raise acmagent.ACManagerException('Failed to move the approved emails to {}: {}'.format(
+                self._approved_prefix, e))
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
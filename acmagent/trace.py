@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_tracer = None
+_context = threading.local()
+
+
+class Tracer(object):
+    """
+    Writes span begin/end records in the Chrome trace event format, the output
+    can be loaded into chrome://tracing or https://ui.perfetto.dev
+    """
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._first = True
+        self._file = open(filename, 'w')
+        self._file.write('[')
+
+    def event(self, phase, name, category, args):
+        record = {
+            'name': name,
+            'cat': category,
+            'ph': phase,
+            'ts': int(time.time() * 1000000),
+            'pid': self._pid,
+            'tid': threading.current_thread().ident,
+            'args': args
+        }
+
+        with self._lock:
+            self._file.write('\n' if self._first else ',\n')
+            self._file.write(json.dumps(record, sort_keys=True))
+            self._first = False
+
+    def close(self):
+        with self._lock:
+            self._file.write('\n]\n')
+            self._file.close()
+
+
+def start(filename):
+    """
+    Start writing trace records to the given file
+
+    :param filename: trace file name
+    :return: Tracer
+    """
+    global _tracer
+    _tracer = Tracer(filename)
+    return _tracer
+
+
+def stop():
+    """
+    Flush and close the active trace file
+
+    :return: None
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+@contextmanager
+def span(name, category, **args):
+    """
+    Record a span around the enclosed block, nested spans inherit the
+    arguments of the outer spans, e.g. certificate_id
+
+    :param name: span name
+    :param category: span category, e.g. imap, http or acm
+    :param args: span arguments
+    :return: None
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+
+    outer_args = getattr(_context, 'args', {})
+    span_args = dict(outer_args)
+    span_args.update(args)
+    _context.args = span_args
+    tracer.event('B', name, category, span_args)
+    try:
+        yield
+    finally:
+        tracer.event('E', name, category, span_args)
+        _context.args = outer_args
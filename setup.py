@@ -37,6 +37,7 @@ setup(
         'beautifulsoup4>=4.5.3',
         'PyYAML>=3.12',
         'requests>=2.13.0',
+        'futures>=3.0.5; python_version < "3"',
     ],
     package_data={
         'acmagent': ['*.json']
@@ -0,0 +1,80 @@
+import unittest
+import os
+import shutil
+import tempfile
+import mock
+from acmagent import chains
+
+CHAIN_PEM = '-----BEGIN CERTIFICATE-----\nintermediate\n-----END CERTIFICATE-----\n'
+
+
+def certificate_pem(name):
+    return '-----BEGIN CERTIFICATE-----\n{}\n-----END CERTIFICATE-----\n'.format(name)
+
+
+class TestCertificateChains(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = chains.ChainCache(self.tmpdir)
+        self.first_arn = 'arn:aws:acm:us-east-1:123456789012:certificate/12345678-1234-1234-1234-123456789012'
+        self.second_arn = 'arn:aws:acm:us-east-1:123456789012:certificate/87654321-1234-1234-1234-123456789012'
+        self.acm = mock.MagicMock()
+        self.acm.get_certificate.side_effect = lambda arn: {'Certificate': certificate_pem(arn),
+                                                            'CertificateChain': CHAIN_PEM}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, certificate_arn, name):
+        with open(os.path.join(self.cache.path(certificate_arn), name)) as pem_file:
+            return pem_file.read()
+
+    def test_certificates_and_chains_are_stored_under_certificate_directory(self):
+        certificate_chains = chains.CertificateChains(self.cache, self.acm)
+        results = list(certificate_chains.fetch([(self.first_arn, '0A:01'), (self.second_arn, '0b:02')]))
+
+        self.assertEqual(set([(self.first_arn, 'fetched', None), (self.second_arn, 'fetched', None)]),
+                         set((certificate_arn, status, error) for certificate_arn, status, entry, error in results))
+        self.assertEqual(certificate_pem(self.first_arn), self.read(self.first_arn, 'certificate.pem'))
+        self.assertEqual(CHAIN_PEM, self.read(self.first_arn, 'chain.pem'))
+        self.assertEqual(certificate_pem(self.second_arn) + CHAIN_PEM, self.read(self.second_arn, 'fullchain.pem'))
+
+        # the shared chain is stored once
+        objects = os.listdir(os.path.join(self.tmpdir, 'objects'))
+        self.assertEqual(5, len(objects))
+
+    def test_cached_serial_numbers_are_not_fetched_again(self):
+        certificate_chains = chains.CertificateChains(self.cache, self.acm)
+        list(certificate_chains.fetch([(self.first_arn, '0a:01')]))
+        self.acm.get_certificate.reset_mock()
+
+        results = list(certificate_chains.fetch([(self.first_arn, '0A:01'), (self.second_arn, '0b:02')]))
+
+        self.assertEqual([(self.first_arn, 'unchanged'), (self.second_arn, 'fetched')],
+                         [(certificate_arn, status) for certificate_arn, status, entry, error in results])
+        self.acm.get_certificate.assert_called_once_with(self.second_arn)
+
+    def test_renewed_certificate_replaces_the_links(self):
+        certificate_chains = chains.CertificateChains(self.cache, self.acm)
+        list(certificate_chains.fetch([(self.first_arn, '0a:01')]))
+        self.acm.get_certificate.side_effect = lambda arn: {'Certificate': certificate_pem('renewed'),
+                                                            'CertificateChain': CHAIN_PEM}
+
+        results = list(certificate_chains.fetch([(self.first_arn, '0a:02')]))
+
+        self.assertEqual('fetched', results[0][1])
+        self.assertEqual(certificate_pem('renewed'), self.read(self.first_arn, 'certificate.pem'))
+        self.assertIsNotNone(self.cache.get(self.first_arn, '0a:01'))
+
+    def test_failed_certificate_is_reported_with_error(self):
+        self.acm.get_certificate.side_effect = Exception('RequestInProgressException')
+        certificate_chains = chains.CertificateChains(self.cache, self.acm)
+
+        results = list(certificate_chains.fetch([(self.first_arn, '0a:01')]))
+
+        self.assertEqual([(self.first_arn, 'failed', None, 'RequestInProgressException')], results)
+        self.assertIsNone(self.cache.get(self.first_arn, '0a:01'))
+
+
+if __name__ == '__main__':
+    unittest.main()
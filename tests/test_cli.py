@@ -6,6 +6,8 @@ import urllib2
 import argparse
 import json
 import yaml
+import StringIO
+import time
 import acmagent
 from acmagent import confirm
 from acmagent import request
@@ -23,6 +25,10 @@ class NamespaceStub(object):
     """
     argprase namespace stub
     """
+    connect_timeout = None
+    read_timeout = None
+    deadline = None
+    all_domains = False
 
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
@@ -182,7 +188,13 @@ class TestConfirmCert(unittest.TestCase):
         args = NamespaceStub(certificate_id=self.certificate_id,
             credentials=self.credentials,
             attempts=self.attempts,
-            wait=self.wait)
+            wait=self.wait,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=None,
+            output='text')
 
         parser_mock = MagicMock()
 
@@ -190,6 +202,34 @@ class TestConfirmCert(unittest.TestCase):
         cli._confirm_cert(args, parser_mock)
         parser_mock.error.assert_called_once_with('exception')
 
+    @patch("acmagent.cli.confirm.ConfirmCertificate")
+    @patch("acmagent.load_imap_credentials")
+    @patch("time.sleep")
+    def test_confirm_cert_pauses_never_extend_past_the_deadline(self, sleep_mock, load_imap_credentials_mock, confirm_certificate_mock):
+        args = NamespaceStub(certificate_id=self.certificate_id,
+            credentials=self.credentials,
+            attempts=3,
+            wait=self.wait,
+            deadline=2,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=None,
+            output='text')
+
+        parser_mock = MagicMock()
+        now = [100]
+        sleep_mock.side_effect = lambda seconds: now.__setitem__(0, now[0] + seconds)
+        confirm_certificate_mock.return_value.__enter__.return_value.confirm_certificate.side_effect = \
+            acmagent.NoEmailsFoundException('not found')
+
+        with patch("acmagent.deadline.time.time", side_effect=lambda: now[0]):
+            cli._confirm_cert(args, parser_mock)
+
+        self.assertEqual([2], [call[0][0] for call in sleep_mock.call_args_list])
+        parser_mock.error.assert_called_once_with('Deadline exceeded before pause between mailbox queries')
+
     @patch("acmagent.cli.confirm.ConfirmCertificate")
     @patch("acmagent.load_imap_credentials")
     @patch("time.sleep")
@@ -198,7 +238,13 @@ class TestConfirmCert(unittest.TestCase):
         args = NamespaceStub(certificate_id=self.certificate_id,
             credentials=self.credentials,
             attempts=self.attempts,
-            wait=self.wait)
+            wait=self.wait,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=None,
+            output='text')
 
         parser_mock = MagicMock()
 
@@ -229,6 +275,175 @@ class TestConfirmCert(unittest.TestCase):
         # __exit__ method is called
         confirm_certificate_mock.return_value.__exit__.assert_called_once()
 
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.confirm.ConfirmCertificate")
+    @patch("acmagent.load_imap_credentials")
+    @patch("time.sleep")
+    def test_confirm_cert_streams_ndjson_result_per_input_id(self, sleep_mock, load_imap_credentials_mock, confirm_certificate_mock, stdout_mock):
+        args = NamespaceStub(certificate_id=None,
+            credentials=self.credentials,
+            attempts=self.attempts,
+            wait=self.wait,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=StringIO.StringIO('first\n{"id": "second", "status": "requested"}\n\nthird\n'),
+            schedule=False,
+            output='ndjson')
+
+        parser_mock = MagicMock()
+        confirm_certificate_mock.return_value.__enter__.return_value.confirm_certificate.side_effect = [
+            True, True, acmagent.NoEmailsFoundException('exception')]
+        cli._confirm_cert(args, parser_mock)
+
+        results = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+        self.assertEqual(['first', 'second', 'third'], [result['id'] for result in results])
+        self.assertEqual(['confirmed', 'confirmed', 'failed'], [result['status'] for result in results])
+        self.assertEqual('exception', results[2]['error'])
+
+        # single IMAP session is used for every certificate
+        confirm_certificate_mock.assert_called_once()
+        parser_mock.exit.assert_called_once_with(1)
+
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.confirm.ConfirmCertificate")
+    @patch("acmagent.load_imap_credentials")
+    @patch("time.sleep")
+    def test_confirm_cert_reports_unconfirmed_certificate_as_pending(self, sleep_mock, load_imap_credentials_mock, confirm_certificate_mock, stdout_mock):
+        args = NamespaceStub(certificate_id=self.certificate_id,
+            credentials=self.credentials,
+            attempts=self.attempts,
+            wait=self.wait,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=None,
+            output='ndjson')
+
+        parser_mock = MagicMock()
+        # e.g. every candidate email is leased by another worker
+        confirm_certificate_mock.return_value.__enter__.return_value.confirm_certificate.return_value = False
+        cli._confirm_cert(args, parser_mock)
+
+        result = json.loads(stdout_mock.getvalue())
+        self.assertEqual((self.certificate_id, 'pending'), (result['id'], result['status']))
+        parser_mock.exit.assert_called_once_with(1)
+
+    def certificate_domains(self, request_certificate_mock, *domains):
+        certificate_arn = 'arn:aws:acm:us-east-1:123456789012:certificate/{}'.format(self.certificate_id)
+        request_certificate_mock.return_value.list_certificates.return_value = [
+            {'CertificateArn': 'arn:aws:acm:us-east-1:123456789012:certificate/other'},
+            {'CertificateArn': certificate_arn}]
+        request_certificate_mock.return_value.describe_certificate.return_value = {
+            'CertificateArn': certificate_arn, 'DomainName': domains[0],
+            'DomainValidationOptions': [{'DomainName': domain, 'ValidationDomain': domains[0]} for domain in domains]}
+
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.request.RequestCertificate")
+    @patch("acmagent.cli.confirm.ConfirmCertificate")
+    @patch("acmagent.load_imap_credentials")
+    @patch("time.sleep")
+    def test_confirm_cert_reports_status_of_every_domain(self, sleep_mock, load_imap_credentials_mock, confirm_certificate_mock, request_certificate_mock, stdout_mock):
+        self.certificate_domains(request_certificate_mock, 'example.com', 'www.example.com')
+        args = NamespaceStub(certificate_id=self.certificate_id,
+            credentials=self.credentials,
+            attempts=self.attempts,
+            wait=self.wait,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=None,
+            schedule=False,
+            all_domains=True,
+            output='ndjson')
+
+        parser_mock = MagicMock()
+        confirm_certificate_mock.return_value.__enter__.return_value.confirm_domains.return_value = {
+            'example.com': True,
+            'www.example.com': acmagent.ConfirmPageIsMissingFormException('expired')
+        }
+        cli._confirm_cert(args, parser_mock)
+
+        result = json.loads(stdout_mock.getvalue())
+        self.assertEqual('failed', result['status'])
+        self.assertEqual({'example.com': {'status': 'confirmed', 'error': None},
+                          'www.example.com': {'status': 'failed', 'error': 'expired'}}, result['domains'])
+        confirm_certificate_mock.return_value.__enter__.return_value.confirm_certificate.assert_not_called()
+        request_certificate_mock.return_value.describe_certificate.assert_called_once_with(
+            'arn:aws:acm:us-east-1:123456789012:certificate/test')
+        parser_mock.exit.assert_called_once_with(1)
+
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.request.RequestCertificate")
+    @patch("acmagent.cli.confirm.ConfirmCertificate")
+    @patch("acmagent.load_imap_credentials")
+    @patch("time.sleep")
+    def test_confirm_cert_queries_until_every_domain_is_approved(self, sleep_mock, load_imap_credentials_mock, confirm_certificate_mock, request_certificate_mock, stdout_mock):
+        self.certificate_domains(request_certificate_mock, 'example.com', 'www.example.com', 'api.example.com')
+        args = NamespaceStub(certificate_id=self.certificate_id,
+            credentials=self.credentials,
+            attempts=3,
+            wait=self.wait,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=None,
+            schedule=False,
+            all_domains=True,
+            output='ndjson')
+
+        parser_mock = MagicMock()
+        confirm_domains_mock = confirm_certificate_mock.return_value.__enter__.return_value.confirm_domains
+        confirm_domains_mock.side_effect = [
+            {'example.com': True},
+            acmagent.NoEmailsFoundException('not found'),
+            {'www.example.com': True}
+        ]
+        cli._confirm_cert(args, parser_mock)
+
+        result = json.loads(stdout_mock.getvalue())
+        self.assertEqual('pending', result['status'])
+        self.assertEqual({'example.com': {'status': 'confirmed', 'error': None},
+                          'www.example.com': {'status': 'confirmed', 'error': None},
+                          'api.example.com': {'status': 'pending', 'error': None}}, result['domains'])
+        # the approved domains are not approved again
+        confirm_domains_mock.assert_called_with(self.certificate_id, approved=set(['example.com']))
+        self.assertEqual(3, confirm_domains_mock.call_count)
+        parser_mock.exit.assert_called_once_with(1)
+
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.confirm.ConfirmCertificate")
+    @patch("acmagent.load_imap_credentials")
+    @patch("time.sleep")
+    def test_confirm_cert_schedules_all_input_ids_together(self, sleep_mock, load_imap_credentials_mock, confirm_certificate_mock, stdout_mock):
+        args = NamespaceStub(certificate_id=None,
+            credentials=self.credentials,
+            attempts=3,
+            wait=self.wait,
+            index_days=None,
+            parse_workers=None,
+            lease=None,
+            lease_ttl=None,
+            input=StringIO.StringIO('first\nsecond\n'),
+            schedule=True,
+            output='ndjson')
+
+        parser_mock = MagicMock()
+        confirm_certificates_mock = confirm_certificate_mock.return_value.__enter__.return_value.confirm_certificates
+        confirm_certificates_mock.side_effect = [{'second': True}, {'first': True}]
+        cli._confirm_cert(args, parser_mock)
+
+        results = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+        self.assertEqual([('second', 'confirmed'), ('first', 'confirmed')],
+                         [(result['id'], result['status']) for result in results])
+        confirm_certificates_mock.assert_any_call(['first', 'second'])
+        confirm_certificates_mock.assert_called_with(['first'])
+        parser_mock.exit.assert_called_once_with(0)
+
 
 class TestRequestCert(unittest.TestCase):
     """
@@ -259,7 +474,10 @@ class TestRequestCert(unittest.TestCase):
             subject_alternative_names=self.subject_alternative_names,
             domain_validation_options=self.domain_validation_options,
             generate_cli_skeleton=False,
-            cli_input_json=False
+            cli_input_json=False,
+            cli_input_template=None,
+            input=None,
+            output='text'
         )
         parser_mock = MagicMock()
 
@@ -275,6 +493,99 @@ class TestRequestCert(unittest.TestCase):
         parser_mock.exit.assert_called_once_with(0, "{}\n".format(certificate_id))
 
 
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.request.RequestCertificate")
+    def test_request_cert_streams_ndjson_result_per_input_spec(self, request_certificate_mock, stdout_mock):
+        specs = [
+            {'DomainName': self.domain_name, 'ValidationDomain': '', 'SubjectAlternativeNames': []},
+            {'DomainName': self.domain_name, 'Unknown': ''}
+        ]
+        args = NamespaceStub(generate_cli_skeleton=False,
+            input=StringIO.StringIO('\n'.join(json.dumps(spec) for spec in specs)),
+            output='ndjson'
+        )
+        parser_mock = MagicMock()
+        request_certificate_mock.return_value.request_certificate.return_value = {
+            'CertificateArn': self.certificate_arn
+        }
+        cli._request_cert(args, parser_mock)
+
+        results = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+        self.assertEqual(self.certificate_arn.split('/')[-1], results[0]['id'])
+        self.assertEqual(['requested', 'failed'], [result['status'] for result in results])
+        parser_mock.exit.assert_called_once_with(1)
+
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.request.RequestCertificate")
+    def test_request_cert_rejects_invalid_specs_before_requesting(self, request_certificate_mock, stdout_mock):
+        specs = [
+            {'DomainName': self.domain_name, 'ValidationDomain': 'example.org', 'SubjectAlternativeNames': []},
+            {'DomainName': self.domain_name, 'ValidationDomain': '', 'SubjectAlternativeNames': []}
+        ]
+        args = NamespaceStub(generate_cli_skeleton=False,
+            input=StringIO.StringIO('\n'.join(json.dumps(spec) for spec in specs)),
+            output='ndjson'
+        )
+        parser_mock = MagicMock()
+        request_certificate_mock.return_value.request_certificate.return_value = {
+            'CertificateArn': self.certificate_arn
+        }
+        cli._request_cert(args, parser_mock)
+
+        results = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+        self.assertEqual(['invalid', 'requested'], [result['status'] for result in results])
+        self.assertEqual('Validation domain example.org is not a suffix of www.example.com', results[0]['error'])
+        request_certificate_mock.return_value.request_certificate.assert_called_once_with(
+            {'DomainName': self.domain_name})
+        parser_mock.exit.assert_called_once_with(1)
+
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.os.path.exists", return_value=True)
+    @patch("acmagent.cli.ledger.Ledger")
+    def test_report_prints_percentiles_per_stage(self, ledger_mock, exists_mock, stdout_mock):
+        ledger_mock.return_value.entries.return_value = {
+            'old': {'requested': 0, 'email_received': 1000},
+            'new': {'requested': time.time() - 100, 'email_received': time.time() - 40}
+        }
+        parser_mock = MagicMock()
+        cli._report(NamespaceStub(ledger='ledger.sqlite', days=1, output='ndjson'), parser_mock)
+
+        results = {result['stage']: result for result in map(json.loads, stdout_mock.getvalue().splitlines())}
+        self.assertEqual(1, results['requested..email_received']['count'])
+        self.assertTrue(59 < results['requested..email_received']['p50'] < 61)
+        parser_mock.exit.assert_called_once_with(0)
+
+
+    @patch("sys.stdout", new_callable=StringIO.StringIO)
+    @patch("acmagent.cli.chains.ChainCache")
+    @patch("acmagent.cli.chains.CertificateChains")
+    @patch("acmagent.cli.inventory.InventoryStore")
+    @patch("acmagent.cli.inventory.CertificateInventory")
+    @patch("acmagent.cli.request.RequestCertificate")
+    def test_fetch_chains_fetches_issued_certificates_only(self, request_certificate_mock, certificate_inventory_mock,
+                                                           store_mock, certificate_chains_mock, cache_mock, stdout_mock):
+        issued_arn = 'arn:aws:acm:us-east-1:123456789012:certificate/issued'
+        certificate_inventory_mock.return_value.status.return_value = [
+            ('issued', {'arn': issued_arn, 'status': 'ISSUED', 'certificate': {'Serial': '0a:01'}}, None),
+            ('pending', {'arn': 'pending-arn', 'status': 'PENDING_VALIDATION', 'certificate': {}}, None)
+        ]
+        certificate_chains_mock.return_value.fetch.return_value = iter([
+            (issued_arn, 'unchanged', {'serial': '0a:01'}, None)])
+        cache_mock.return_value.path.return_value = '/cache/issued'
+        parser_mock = MagicMock()
+
+        cli._fetch_chains(NamespaceStub(certificate_arns=[issued_arn], input=StringIO.StringIO('pending\n'),
+                                        inventory=None, refresh=False, cache_dir='/cache', workers=4,
+                                        output='ndjson'), parser_mock)
+
+        certificate_inventory_mock.return_value.status.assert_called_once_with([issued_arn, 'pending'], refresh=False)
+        certificate_chains_mock.return_value.fetch.assert_called_once_with([(issued_arn, '0a:01')], 4)
+        results = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+        self.assertEqual([('pending', 'failed', None), ('issued', 'unchanged', '/cache/issued')],
+                         [(result['id'], result['status'], result['path']) for result in results])
+        parser_mock.exit.assert_called_once_with(1)
+
+
 class TestArguments(unittest.TestCase):
     @patch("acmagent.cli.argparse.ArgumentParser.exit")
     def test_version_argument_uses_setup_file_value(self, argparse_mock):
@@ -282,6 +593,13 @@ class TestArguments(unittest.TestCase):
         parser.parse_args(['--version'])
         argparse_mock.assert_any_call(message=acmagent.VERSION+'\n')
 
+    def test_profile_and_trace_file_arguments_are_global(self):
+        parser = cli._setup_argparser()
+        args = parser.parse_args(['--profile', 'acmagent.pstats', '--trace-file', 'trace.json',
+                                  'confirm-certificate', '--certificate-id', 'test'])
+        self.assertEqual('acmagent.pstats', args.profile)
+        self.assertEqual('trace.json', args.trace_file)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -3,23 +3,34 @@ import json
 import acmagent
 import imaplib
 import requests
+import socket
+import os
+import shutil
+import tempfile
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from acmagent import confirm
+from acmagent import deadline
+from acmagent import imap
+from acmagent import metrics
+from acmagent import trace
 from mock import patch
 import mock
+from concurrent import futures
+
+HTTP_TIMEOUT = (confirm.ConfirmCertificate.CONNECT_TIMEOUT, confirm.ConfirmCertificate.READ_TIMEOUT)
 
 
 class CertificateFailedApprovalFormStub(object):
-    def __init__(self, url, headers, data):
+    def __init__(self, url, headers, data, timeout=None):
         self.ok = False
 
 class CertificateApprovalFormStub(object):
-    def __init__(self, url, headers, data):
+    def __init__(self, url, headers, data, timeout=None):
         self.ok = True
 
 class CertificateExpiredApprovalPageStub(object):
-    def __init__(self, url, headers):
+    def __init__(self, url, headers, timeout=None):
         self.content = """\
         <html>
             <body>
@@ -29,7 +40,7 @@ class CertificateExpiredApprovalPageStub(object):
         """
 
 class CertificateApprovalPageStub(object):
-    def __init__(self, url, headers):
+    def __init__(self, url, headers, timeout=None):
         self.content = """\
         <html>
             <body>
@@ -41,6 +52,14 @@ class CertificateApprovalPageStub(object):
         """
 
 
+def uid_responses(confirm_certificate, search, fetch=None):
+    """
+    Stub IMAP UID command responses
+    """
+    responses = {'SEARCH': search, 'FETCH': fetch, 'STORE': ('OK', [None]), 'MOVE': ('OK', [None])}
+    confirm_certificate._source._mail.uid.side_effect = lambda command, *args: responses[command]
+
+
 class TestConfirmCertificate(unittest.TestCase):
     def setUp(self):
         self.server = 'imap.example.com'
@@ -66,62 +85,80 @@ class TestConfirmCertificate(unittest.TestCase):
 
         self.email_body = str(msg)
 
-    @patch("imaplib.IMAP4_SSL")
+    @patch("acmagent.imap.IMAP4_SSL")
     def test_confirm_certificate_connects_to_imap_using_provided_credentials(self, imap_mock):
         confirm_certificate = confirm.ConfirmCertificate({
             'server': self.server,
             'username': self.username,
             'password': self.password
         })
-        confirm_certificate._mail.login.assert_called_once_with(self.username, self.password)
+        confirm_certificate._source._mail.login.assert_called_once_with(self.username, self.password)
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_folder_is_selected_once_per_session(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        })
+        uid_responses(confirm_certificate, ('OK', ['']))
+
+        for attempt in range(3):
+            with self.assertRaises(acmagent.NoEmailsFoundException):
+                confirm_certificate.confirm_certificate(self.certificate_id)
+        self.assertEqual({}, confirm_certificate.confirm_certificates([self.certificate_id]))
+
+        confirm_certificate._source._mail.select.assert_called_once_with(confirm.ImapSource.EMAIL_FOLDER)
+        self.assertEqual(4, confirm_certificate._source._mail.uid.call_count)
 
     @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
     @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
-    @patch("imaplib.IMAP4_SSL")
+    @patch("acmagent.imap.IMAP4_SSL")
     def test_confirm_certificate_happy_path(self, imap_mock, post_mock, get_mock):
         confirm_certificate = confirm.ConfirmCertificate({
             'server': self.server,
             'username': self.username,
             'password': self.password
         })
-        confirm_certificate._mail.search.return_value = ('OK', [self.email_id])
-        confirm_certificate._mail.fetch.return_value = ('OK', [['', self.email_body]])
+        uid_responses(confirm_certificate, ('OK', [self.email_id]), ('OK', [('1 (BODY[] {10}', self.email_body), ')']))
 
         # successful request returns True
         self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
 
         # specific IMAP folder was selected
-        confirm_certificate._mail.select.assert_called_once_with(confirm.ConfirmCertificate.EMAIL_FOLDER)
+        confirm_certificate._source._mail.select.assert_called_once_with(confirm.ImapSource.EMAIL_FOLDER)
 
         # message were searched using expected search query
-        confirm_certificate._mail.search.assert_called_once_with(None, confirm.ConfirmCertificate._search_query(self.certificate_id))
+        confirm_certificate._source._mail.uid.assert_any_call('SEARCH', None, confirm.ImapSource._search_query(self.certificate_id))
 
         # message was fetched
-        confirm_certificate._mail.fetch.assert_called_once_with(self.email_id, '(RFC822)')
+        confirm_certificate._source._mail.uid.assert_any_call('FETCH', self.email_id, '(BODY.PEEK[])')
 
-        # message was marked as read
-        confirm_certificate._mail.store.assert_called_once_with(self.email_id, '+FLAGS', '\\Seen')
+        # message is marked as read at the end of the batch
+        self.assertNotIn('STORE', [call[0][0] for call in confirm_certificate._source._mail.uid.call_args_list])
+        confirm_certificate.__exit__(None, None, None)
+        confirm_certificate._source._mail.uid.assert_any_call('STORE', self.email_id, '+FLAGS', '(\\Seen)')
 
         # confirm url was requested using GET
-        get_mock.assert_called_once_with(self.approval_url, headers=acmagent.UserHeaders)
+        get_mock.assert_called_once_with(self.approval_url, headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
 
         # confirm form was requested using POST
-        post_mock.assert_called_once_with(confirm.ConfirmCertificate.APPROVAL_FORM_URL, headers=acmagent.UserHeaders, data={
+        post_mock.assert_called_once_with(confirm.ConfirmCertificate.APPROVAL_FORM_URL, headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT, data={
             'test_input': 'test_value'
         })
 
-    @patch("imaplib.IMAP4_SSL")
+    @patch("acmagent.imap.IMAP4_SSL")
     def test_confirm_certificate_raises_exception_if_email_is_not_found(self, imap_mock):
         confirm_certificate = confirm.ConfirmCertificate({
             'server': self.server,
             'username': self.username,
             'password': self.password
         })
-        confirm_certificate._mail.search.return_value = ('OK', [''])
+        uid_responses(confirm_certificate, ('OK', ['']))
         with self.assertRaises(acmagent.NoEmailsFoundException):
             confirm_certificate.confirm_certificate(self.certificate_id)    \
 
-    @patch("imaplib.IMAP4_SSL")
+    @patch("acmagent.imap.IMAP4_SSL")
     def test_confirm_certificate_raises_exception_if_email_is_not_html(self, imap_mock):
         confirm_certificate = confirm.ConfirmCertificate({
             'server': self.server,
@@ -129,13 +166,12 @@ class TestConfirmCertificate(unittest.TestCase):
             'password': self.password
         })
 
-        confirm_certificate._mail.search.return_value = ('OK', [self.email_id])
-        confirm_certificate._mail.fetch.return_value = ('OK', [['', '']])
+        uid_responses(confirm_certificate, ('OK', [self.email_id]), ('OK', [('1 (BODY[] {10}', ''), ')']))
 
         with self.assertRaises(acmagent.EmailBodyUnknownContentType):
             confirm_certificate.confirm_certificate(self.certificate_id)
 
-    @patch("imaplib.IMAP4_SSL")
+    @patch("acmagent.imap.IMAP4_SSL")
     def test_confirm_certificate_raises_exception_if_email_is_missing_confirmation_url(self, imap_mock):
         confirm_certificate = confirm.ConfirmCertificate({
             'server': self.server,
@@ -157,14 +193,13 @@ class TestConfirmCertificate(unittest.TestCase):
 
         email_with_missing_approval_url = str(msg)
 
-        confirm_certificate._mail.search.return_value = ('OK', [self.email_id])
-        confirm_certificate._mail.fetch.return_value = ('OK', [['', email_with_missing_approval_url]])
+        uid_responses(confirm_certificate, ('OK', [self.email_id]), ('OK', [('1 (BODY[] {10}', email_with_missing_approval_url), ')']))
 
         with self.assertRaises(acmagent.EmailBodyConfirmLinkIsMissingException):
             confirm_certificate.confirm_certificate(self.certificate_id)
 
     @patch("acmagent.confirm.requests.get", side_effect=CertificateExpiredApprovalPageStub)
-    @patch("imaplib.IMAP4_SSL")
+    @patch("acmagent.imap.IMAP4_SSL")
     def test_confirm_certificate_raises_exception_if_confirmation_page_is_missing_form(self, imap_mock, get_mock):
         confirm_certificate = confirm.ConfirmCertificate({
             'server': self.server,
@@ -172,8 +207,7 @@ class TestConfirmCertificate(unittest.TestCase):
             'password': self.password
         })
 
-        confirm_certificate._mail.search.return_value = ('OK', [self.email_id])
-        confirm_certificate._mail.fetch.return_value = ('OK', [['', self.email_body]])
+        uid_responses(confirm_certificate, ('OK', [self.email_id]), ('OK', [('1 (BODY[] {10}', self.email_body), ')']))
 
         with self.assertRaises(acmagent.ConfirmPageIsMissingFormException):
             confirm_certificate.confirm_certificate(self.certificate_id)
@@ -181,7 +215,7 @@ class TestConfirmCertificate(unittest.TestCase):
 
     @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
     @patch("acmagent.confirm.requests.post", side_effect=CertificateFailedApprovalFormStub)
-    @patch("imaplib.IMAP4_SSL")
+    @patch("acmagent.imap.IMAP4_SSL")
     def test_confirm_certificate_raises_exception_if_form_submission_failed(self, imap_mock, post_mock, get_mock):
         confirm_certificate = confirm.ConfirmCertificate({
             'server': self.server,
@@ -189,11 +223,664 @@ class TestConfirmCertificate(unittest.TestCase):
             'password': self.password
         })
 
-        confirm_certificate._mail.search.return_value = ('OK', [self.email_id])
-        confirm_certificate._mail.fetch.return_value = ('OK', [['', self.email_body]])
+        uid_responses(confirm_certificate, ('OK', [self.email_id]), ('OK', [('1 (BODY[] {10}', self.email_body), ')']))
 
         with self.assertRaises(acmagent.ACManagerException):
             confirm_certificate.confirm_certificate(self.certificate_id)
 
+        # failed approval is left unread for the next search
+        confirm_certificate.__exit__(None, None, None)
+        self.assertNotIn('STORE', [call[0][0] for call in confirm_certificate._source._mail.uid.call_args_list])
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_confirmed_emails_are_flagged_and_moved_with_a_command_each(self, imap_mock, post_mock, get_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password,
+            'approved_folder': 'Approved'
+        })
+        confirm_certificate._source._mail.capabilities = ('IMAP4REV1', 'MOVE')
+
+        for uid in ['1', '2', '3', '7']:
+            uid_responses(confirm_certificate, ('OK', [uid]), ('OK', [('1 (BODY[] {10}', self.email_body), ')']))
+            confirm_certificate.confirm_certificate(self.certificate_id)
+
+        confirm_certificate._source._mail.uid.reset_mock()
+        confirm_certificate.flush()
+        self.assertEqual([mock.call('STORE', '1:3,7', '+FLAGS', '(\\Seen)'), mock.call('MOVE', '1:3,7', 'Approved')],
+                         confirm_certificate._source._mail.uid.call_args_list)
+        confirm_certificate._source._mail.uid_pipeline.assert_not_called()
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_emails_are_not_deleted_when_copy_fails(self, imap_mock, post_mock, get_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password,
+            'approved_folder': 'Approved'
+        })
+        confirm_certificate._source._mail.capabilities = ('IMAP4REV1',)
+        uid_responses(confirm_certificate, ('OK', ['3']), ('OK', [('1 (BODY[] {10}', self.email_body), ')']))
+        self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
+
+        responses = {'STORE': ('OK', [None]), 'COPY': ('NO', ['[TRYCREATE] Mailbox does not exist'])}
+        confirm_certificate._source._mail.uid.side_effect = lambda command, *args: responses[command]
+        confirm_certificate._source._mail.uid.reset_mock()
+        confirm_certificate.__exit__(None, None, None)
+
+        self.assertEqual([mock.call('STORE', '3', '+FLAGS', '(\\Seen)'), mock.call('COPY', '3', 'Approved')],
+                         confirm_certificate._source._mail.uid.call_args_list)
+        self.assertEqual(['3'], confirm_certificate._approved_uids)
+
+        # emails are deleted once the copy succeeds
+        responses['COPY'] = ('OK', [None])
+        confirm_certificate.flush()
+        confirm_certificate._source._mail.uid.assert_called_with('STORE', '3', '+FLAGS', '(\\Deleted)')
+        self.assertEqual([], confirm_certificate._approved_uids)
+
+
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_newest_email_is_tried_first_and_resent_duplicates_are_skipped(self, imap_mock, post_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        })
+        approval_urls = {'2': 'expired.com', '5': 'expired.com', '10': self.approval_url}
+        pages = {'expired.com': CertificateExpiredApprovalPageStub, self.approval_url: CertificateApprovalPageStub}
+        confirm_certificate._fetch_message = mock.MagicMock(side_effect=lambda uid: approval_urls[uid])
+        uid_responses(confirm_certificate, ('OK', ['2 5 10']))
+
+        with patch("acmagent.confirm.requests.get", side_effect=lambda url, headers, timeout: pages[url](url, headers)) as get_mock:
+            self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
+            get_mock.assert_called_once_with(self.approval_url, headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+
+        self.assertEqual([mock.call('10')], confirm_certificate._fetch_message.call_args_list)
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateExpiredApprovalPageStub)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_expired_links_fall_through_to_older_emails(self, imap_mock, get_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        })
+        approval_urls = {'2': 'first.com', '5': 'second.com', '7': 'second.com'}
+        confirm_certificate._fetch_message = mock.MagicMock(side_effect=lambda uid: approval_urls[uid])
+        uid_responses(confirm_certificate, ('OK', ['2 5 7']))
+
+        with self.assertRaises(acmagent.ConfirmPageIsMissingFormException):
+            confirm_certificate.confirm_certificate(self.certificate_id)
+
+        # every email was read newest first, the duplicate url was requested once
+        self.assertEqual([mock.call('7'), mock.call('5'), mock.call('2')], confirm_certificate._fetch_message.call_args_list)
+        self.assertEqual(2, get_mock.call_count)
+
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_search_yields_uid_chunks_newest_first(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        })
+        uids = [str(uid) for uid in range(1, 121)]
+        uid_responses(confirm_certificate, ('OK', [' '.join(uids)]))
+
+        chunks = list(confirm_certificate._source._search(self.certificate_id))
+
+        self.assertEqual([50, 50, 20], [len(chunk) for chunk in chunks])
+        self.assertEqual(list(reversed(uids)), [uid for chunk in chunks for uid in chunk])
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_search_walks_esearch_uid_range_in_windows(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        })
+        confirm_certificate._source._mail.capabilities = ('IMAP4REV1', 'ESEARCH')
+        confirm_certificate._source._mail.response.return_value = ('ESEARCH', ['(TAG "A4") UID MIN 1 MAX 200 COUNT 120'])
+        windows = {'118:200': '150 180', '35:117': '', '1:34': '1 2'}
+        confirm_certificate._source._mail.uid.side_effect = lambda command, charset, *criteria: (
+            'OK', [windows[criteria[1]] if criteria[0] == 'UID' else None])
+
+        chunks = list(confirm_certificate._source._search(self.certificate_id))
+
+        self.assertEqual([['180', '150'], ['2', '1']], chunks)
+        confirm_certificate._source._mail.uid.assert_any_call(
+            'SEARCH', None, 'RETURN', '(MIN MAX COUNT)', confirm.ImapSource._search_query(self.certificate_id))
+
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_chunk_is_fetched_once_and_parsed_in_process_pool(self, imap_mock, post_mock, get_mock):
+        parse_pool = futures.ProcessPoolExecutor(max_workers=2)
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        }, parse_pool=parse_pool)
+        fetch_response = ('OK', [
+            ('2 (UID 5 BODY[] {10}', self.email_body), ')',
+            ('1 (BODY[] {10}', self.email_body), ' UID 3)'
+        ])
+        uid_responses(confirm_certificate, ('OK', ['3 5']), fetch_response)
+
+        try:
+            self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
+        finally:
+            parse_pool.shutdown()
+
+        confirm_certificate._source._mail.uid.assert_any_call('FETCH', '5,3', '(UID BODY.PEEK[])')
+        get_mock.assert_called_once_with(self.approval_url, headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+        post_mock.assert_called_once_with(confirm.ConfirmCertificate.APPROVAL_FORM_URL, headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT, data={
+            'test_input': 'test_value'
+        })
+
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_emails_leased_by_other_workers_are_skipped(self, imap_mock, post_mock, get_mock):
+        leases = mock.MagicMock()
+        leases.acquire.side_effect = lambda key: not key.endswith('/7')
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        }, leases=leases)
+        uid_responses(confirm_certificate, ('OK', ['3 7']), ('OK', [('1 (BODY[] {10}', self.email_body), ')']))
+
+        self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
+        confirm_certificate._source._mail.uid.assert_any_call('FETCH', '3', '(BODY.PEEK[])')
+
+        # approved email lease is released once the email is marked as read
+        leases.release.assert_not_called()
+        confirm_certificate.flush()
+        leases.release.assert_called_once_with('email/{}/{}/Inbox/3'.format(self.server, self.username))
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_emails_moved_by_other_workers_are_skipped(self, imap_mock, post_mock, get_mock):
+        confirm_certificate = confirm.ConfirmCertificate({
+            'server': self.server,
+            'username': self.username,
+            'password': self.password
+        })
+        fetches = {'7': ('OK', [None]), '3': ('OK', [('1 (BODY[] {10}', self.email_body), ')'])}
+        confirm_certificate._source._mail.uid.side_effect = lambda command, *args: \
+            ('OK', ['3 7']) if command == 'SEARCH' else fetches[args[0]]
+
+        # the newest email has been moved to the approved folder by another worker
+        self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
+        self.assertEqual(['3'], confirm_certificate._approved_uids)
+
+
+class TestConfirmCertificateTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.credentials = {
+            'server': 'imap.example.com',
+            'username': 'test@example.com',
+            'password': 'my_imap_password'
+        }
+        self.certificate_id = '12345678-1234-1234-1234-123456789012'
+
+    @patch("acmagent.imap.ssl_context")
+    @patch("socket.create_connection")
+    def test_imap_connection_is_opened_with_connect_and_read_timeouts(self, create_connection_mock, ssl_context_mock):
+        wrap_socket_mock = ssl_context_mock.return_value.wrap_socket
+        # skip the greeting and CAPABILITY exchange, only the socket setup is tested
+        def init(connection, host, port):
+            connection.keyfile = connection.certfile = None
+            connection.open(host, port)
+
+        with patch("imaplib.IMAP4_SSL.__init__", init):
+            connection = imap.IMAP4_SSL('imap.example.com', connect_timeout=3, read_timeout=7)
+
+        create_connection_mock.assert_called_once_with(('imap.example.com', imaplib.IMAP4_SSL_PORT), 3)
+        create_connection_mock.return_value.settimeout.assert_called_once_with(7)
+
+        connection.set_timeout(2)
+        wrap_socket_mock.return_value.settimeout.assert_called_once_with(2)
+
+    @patch("acmagent.imap.ssl_context")
+    @patch("socket.create_connection")
+    def test_connections_share_ssl_context_and_record_handshake_time(self, create_connection_mock, ssl_context_mock):
+        metrics.reset()
+
+        def init(connection, host, port):
+            connection.keyfile = connection.certfile = None
+            connection.open(host, port)
+
+        with patch("imaplib.IMAP4_SSL.__init__", init):
+            imap.IMAP4_SSL('imap.example.com')
+            imap.IMAP4_SSL('imap.example.com')
+
+        ssl_context_mock.return_value.wrap_socket.assert_called_with(
+            create_connection_mock.return_value, server_hostname='imap.example.com')
+        self.assertEqual(2, metrics.get('imap_tls_handshake_seconds', server='imap.example.com')['count'])
+
+    def test_ssl_context_is_created_once(self):
+        self.assertIs(imap.ssl_context(), imap.ssl_context())
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_stuck_imap_command_reports_the_stage(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials)
+        confirm_certificate._source._mail.uid.side_effect = socket.timeout('timed out')
+
+        with self.assertRaises(acmagent.OperationTimeoutException) as context:
+            confirm_certificate.confirm_certificate(self.certificate_id)
+
+        self.assertEqual('IMAP UID SEARCH', context.exception.stage)
+
+    @patch("acmagent.confirm.requests.get", side_effect=requests.exceptions.ReadTimeout('timed out'))
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_stuck_approval_page_reports_the_stage(self, imap_mock, get_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials, connect_timeout=2, read_timeout=5)
+
+        with self.assertRaises(acmagent.OperationTimeoutException) as context:
+            confirm_certificate._call_confirm_url('test.com')
+
+        self.assertEqual('HTTP GET', context.exception.stage)
+        get_mock.assert_called_once_with('test.com', headers=acmagent.UserHeaders, timeout=(2, 5))
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_read_timeouts_are_bounded_by_the_deadline(self, imap_mock):
+        now = [0]
+        operation_deadline = deadline.Deadline(30, clock=lambda: now[0])
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials, deadline=operation_deadline)
+        uid_responses(confirm_certificate, ('OK', ['']))
+
+        now[0] = 25
+        with self.assertRaises(acmagent.NoEmailsFoundException):
+            confirm_certificate.confirm_certificate(self.certificate_id)
+        confirm_certificate._source._mail.set_timeout.assert_called_with(5)
+
+        now[0] = 30
+        with self.assertRaises(acmagent.OperationTimeoutException) as context:
+            confirm_certificate.confirm_certificate(self.certificate_id)
+        self.assertEqual('IMAP UID SEARCH', context.exception.stage)
+
+        # emails are still flagged and the connection is closed after the deadline
+        confirm_certificate.__exit__(None, None, None)
+        confirm_certificate._source._mail.close.assert_called_once_with()
+
+
+class TestConfirmCertificateIndex(unittest.TestCase):
+    def setUp(self):
+        self.credentials = {
+            'server': 'imap.example.com',
+            'username': 'test@example.com',
+            'password': 'my_imap_password'
+        }
+        self.certificate_id = '12345678-1234-1234-1234-123456789012'
+        self.other_certificate_id = '87654321-1234-1234-1234-123456789012'
+
+    def index_response(self, *messages):
+        response = []
+        for uid, certificate_id in messages:
+            response.append(('{} (UID {} BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {{10}}'.format(uid, uid),
+                             'From: Amazon Certificates\r\n'))
+            response.append((' BODY[TEXT]<0> {40}', 'Certificate identifier: {}\r\n'.format(certificate_id)))
+            response.append(')')
+        return ('OK', response)
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_index_answers_lookups_without_full_text_search(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials, index_days=7)
+        uid_responses(confirm_certificate, ('OK', ['3 4']), self.index_response(
+            ('3', self.certificate_id), ('4', self.other_certificate_id)))
+
+        self.assertEqual(['3'], confirm_certificate._source._search_index(self.certificate_id))
+        self.assertEqual(['4'], confirm_certificate._source._search_index(self.other_certificate_id))
+
+        # single search and fetch were used to build the index
+        self.assertEqual(2, confirm_certificate._source._mail.uid.call_count)
+        search_query = confirm_certificate._source._mail.uid.call_args_list[0][0][2]
+        self.assertIn('UID 1:*', search_query)
+        self.assertNotIn('BODY', search_query)
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_index_maps_uids_returned_after_the_literals(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials, index_days=7)
+        response = [
+            ('3 (UID 5 BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {10}', 'From: Amazon Certificates\r\n'),
+            (' BODY[TEXT]<0> {40}', 'Certificate identifier: {}\r\n'.format(self.certificate_id)),
+            ')',
+            ('4 (BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {10}', 'From: Amazon Certificates\r\n'),
+            (' BODY[TEXT]<0> {40}', 'Certificate identifier: {}\r\n'.format(self.other_certificate_id)),
+            ' UID 6)',
+            ('5 (BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {10}', 'From: Amazon Certificates\r\n'),
+            (' BODY[TEXT]<0> {40}', 'Certificate identifier: 11111111-1234-1234-1234-123456789012\r\n'),
+            ')'
+        ]
+        uid_responses(confirm_certificate, ('OK', ['5 6 7']), ('OK', response))
+
+        # the email without UID is not mapped to the UID of the previous email
+        self.assertEqual({self.certificate_id: ['5'], self.other_certificate_id: ['6']},
+                         confirm_certificate._source._certificate_ids(['5', '6', '7']))
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_index_is_updated_with_new_emails_when_certificate_is_missing(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials, index_days=7)
+        uid_responses(confirm_certificate, ('OK', ['3']), self.index_response(('3', self.other_certificate_id)))
+        self.assertEqual([], confirm_certificate._source._search_index(self.certificate_id))
+
+        uid_responses(confirm_certificate, ('OK', ['3 5']), self.index_response(('5', self.certificate_id)))
+        self.assertEqual(['5'], confirm_certificate._source._search_index(self.certificate_id))
+
+        # only emails newer than the indexed ones were fetched
+        confirm_certificate._source._mail.uid.assert_any_call('FETCH', '5', mock.ANY)
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_confirm_certificates_finds_all_certificates_with_single_search(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials)
+        uid_responses(confirm_certificate, ('OK', ['3 4 6']), self.index_response(
+            ('3', self.certificate_id), ('4', self.other_certificate_id), ('6', self.certificate_id)))
+
+        missing_certificate_id = '11111111-1234-1234-1234-123456789012'
+        with patch.object(confirm_certificate, '_approve_newest', return_value=True) as approve_mock:
+            results = confirm_certificate.confirm_certificates(
+                [self.certificate_id, self.other_certificate_id, missing_certificate_id])
+
+        # certificates without emails are left out
+        self.assertEqual({self.certificate_id: True, self.other_certificate_id: True}, results)
+
+        # emails of every certificate were found with a single search
+        searches = [call for call in confirm_certificate._source._mail.uid.call_args_list if call[0][0] == 'SEARCH']
+        self.assertEqual(1, len(searches))
+        self.assertEqual(2, searches[0][0][2].count('OR BODY'))
+
+        # newest email of the certificate is tried first
+        approve_mock.assert_any_call(self.certificate_id, mock.ANY, None)
+        chunks = [call[0][1] for call in approve_mock.call_args_list if call[0][0] == self.certificate_id][0]
+        self.assertEqual([['6', '3']], list(chunks))
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_searches_of_certificate_id_chunks_are_pipelined(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials)
+        confirm_certificate._source._mail.uid_pipeline.return_value = [('OK', ['3']), ('OK', ['4'])]
+        uid_responses(confirm_certificate, None, self.index_response(
+            ('3', self.certificate_id), ('4', self.other_certificate_id)))
+
+        certificate_ids = ['{:08d}-1234-1234-1234-123456789012'.format(index) for index in range(58)]
+        found = confirm_certificate._find_certificates(certificate_ids + [self.certificate_id, self.other_certificate_id])
+
+        self.assertEqual({self.certificate_id: ['3'], self.other_certificate_id: ['4']}, found)
+        searches = confirm_certificate._source._mail.uid_pipeline.call_args[0]
+        self.assertEqual(['SEARCH', 'SEARCH'], [search[0] for search in searches])
+        confirm_certificate._source._mail.uid.assert_called_once_with('FETCH', '3,4', mock.ANY)
+
+
+def validation_email(certificate_id, domain, approval_url):
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = 'Certificate approval for {}'.format(domain)
+    msg.attach(MIMEText('Domain: {}\nCertificate identifier: {}\n'.format(domain, certificate_id), 'plain'))
+    msg.attach(MIMEText('<html><body><a href="{}" id="approval_url"></a></body></html>'.format(approval_url), 'html'))
+    return str(msg)
+
+
+class TestConfirmDomains(unittest.TestCase):
+    def setUp(self):
+        self.credentials = {
+            'server': 'imap.example.com',
+            'username': 'test@example.com',
+            'password': 'my_imap_password'
+        }
+        self.certificate_id = '12345678-1234-1234-1234-123456789012'
+        self.emails = {
+            '1': validation_email(self.certificate_id, 'example.com', 'example.com/old'),
+            '2': validation_email(self.certificate_id, 'www.example.com', 'www.example.com/expired'),
+            '3': validation_email(self.certificate_id, 'example.com', 'example.com/new'),
+            '4': validation_email(self.certificate_id, 'www.example.com', 'www.example.com/new'),
+            '5': validation_email(self.certificate_id, 'api.example.com', 'api.example.com/expired'),
+        }
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            return 'OK', [' '.join(sorted(self.emails))]
+        if 'BODY.PEEK[]' in args[-1]:
+            uids = args[0].split(',')
+        else:
+            uids = sorted(self.emails)
+        response = []
+        for uid in uids:
+            response.append(('{} (UID {} BODY[] {{100}}'.format(uid, uid), self.emails[uid]))
+            response.append(')')
+        return 'OK', response
+
+    def test_extract_domain_reads_the_domain_line(self):
+        self.assertEqual('www.example.com', confirm.extract_domain(self.emails['4']))
+        self.assertIsNone(confirm.extract_domain('Subject: test\r\n\r\nNo domain'))
+
+    @patch("acmagent.confirm.requests.Session")
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_newest_email_of_every_domain_is_approved_over_pooled_session(self, imap_mock, session_mock):
+        session = session_mock.return_value
+        session.get.side_effect = lambda url, **kwargs: CertificateExpiredApprovalPageStub(url, None) \
+            if url.endswith('expired') else CertificateApprovalPageStub(url, None)
+        session.post.side_effect = lambda url, **kwargs: CertificateApprovalFormStub(url, None, None)
+
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials)
+        confirm_certificate._source._mail.uid.side_effect = self.uid
+        results = confirm_certificate.confirm_domains(self.certificate_id)
+
+        self.assertEqual([True, True], [results['example.com'], results['www.example.com']])
+        self.assertIsInstance(results['api.example.com'], acmagent.ConfirmPageIsMissingFormException)
+        requested = sorted(call[0][0] for call in session.get.call_args_list)
+        self.assertEqual(['api.example.com/expired', 'example.com/new', 'www.example.com/new'], requested)
+        self.assertEqual(['3', '4'], sorted(confirm_certificate._approved_uids))
+
+        # all approval emails were fetched with a single command
+        fetches = [call for call in confirm_certificate._source._mail.uid.call_args_list if 'BODY.PEEK[]' in call[0][-1]]
+        self.assertEqual(1, len(fetches))
+
+    @patch("acmagent.confirm.requests.Session")
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_http_spans_of_every_domain_carry_the_certificate_and_email(self, imap_mock, session_mock):
+        session = session_mock.return_value
+        session.get.side_effect = lambda url, **kwargs: CertificateApprovalPageStub(url, None)
+        session.post.side_effect = lambda url, **kwargs: CertificateApprovalFormStub(url, None, None)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            trace.start(os.path.join(tmpdir, 'trace.json'))
+            confirm_certificate = confirm.ConfirmCertificate(self.credentials)
+            confirm_certificate._source._mail.uid.side_effect = self.uid
+            confirm_certificate.confirm_domains(self.certificate_id)
+            trace.stop()
+            with open(os.path.join(tmpdir, 'trace.json')) as f:
+                records = json.load(f)
+        finally:
+            trace.stop()
+            shutil.rmtree(tmpdir)
+
+        http_spans = [record['args'] for record in records if record['cat'] == 'http' and record['ph'] == 'B']
+        self.assertEqual(6, len(http_spans))
+        for args in http_spans:
+            self.assertEqual(self.certificate_id, args['certificate_id'])
+            self.assertIn(args['uid'], self.emails)
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_certificate_without_emails_is_reported(self, imap_mock):
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials)
+        uid_responses(confirm_certificate, ('OK', ['']))
+
+        with self.assertRaises(acmagent.NoEmailsFoundException):
+            confirm_certificate.confirm_domains(self.certificate_id)
+
+    @patch("acmagent.confirm.requests.Session")
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_domains_approved_by_an_earlier_pass_are_skipped(self, imap_mock, session_mock):
+        session = session_mock.return_value
+        session.get.side_effect = lambda url, **kwargs: CertificateApprovalPageStub(url, None)
+        session.post.side_effect = lambda url, **kwargs: CertificateApprovalFormStub(url, None, None)
+
+        confirm_certificate = confirm.ConfirmCertificate(self.credentials)
+        confirm_certificate._source._mail.uid.side_effect = self.uid
+        results = confirm_certificate.confirm_domains(self.certificate_id,
+                                                      approved=set(['example.com', 'api.example.com']))
+
+        self.assertEqual({'www.example.com': True}, results)
+        self.assertEqual(['www.example.com/new'], [call[0][0] for call in session.get.call_args_list])
+        self.assertEqual(['4'], confirm_certificate._approved_uids)
+
+
+class ConfirmCertificateStub(object):
+    def __init__(self, mailbox, **options):
+        self.folder = mailbox['folder']
+        self.closed = False
+
+    def confirm_certificate(self, certificate_id, cancelled):
+        if self.folder == 'Empty':
+            raise acmagent.NoEmailsFoundException('not found')
+        if self.folder == 'Slow':
+            cancelled.wait(5)
+            return False
+        return True
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.closed = True
+
+
+class TestMultiMailboxConfirmCertificate(unittest.TestCase):
+    def setUp(self):
+        self.credentials = {
+            'accounts': [
+                {
+                    'server': 'imap.example.com',
+                    'username': 'admin@example.com',
+                    'password': 'my_imap_password',
+                    'folders': ['Inbox', 'Empty']
+                },
+                {
+                    'server': 'imap.example.com',
+                    'username': 'hostmaster@example.com',
+                    'password': 'my_imap_password',
+                    'folder': 'Slow'
+                }
+            ]
+        }
+
+    def test_imap_mailboxes_expands_accounts_and_folders(self):
+        mailboxes = acmagent.imap_mailboxes(self.credentials)
+
+        self.assertEqual(['Inbox', 'Empty', 'Slow'], [mailbox['folder'] for mailbox in mailboxes])
+        self.assertEqual('admin@example.com', mailboxes[1]['username'])
+        self.assertNotIn('folders', mailboxes[0])
+
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_open_mailboxes_returns_single_mailbox_for_single_account(self, imap_mock):
+        mailbox = confirm.open_mailboxes({
+            'server': 'imap.example.com',
+            'username': 'admin@example.com',
+            'password': 'my_imap_password'
+        })
+
+        self.assertIsInstance(mailbox, confirm.ConfirmCertificate)
+
+    @patch("acmagent.confirm.ConfirmCertificate", side_effect=ConfirmCertificateStub)
+    def test_first_success_cancels_outstanding_scans(self, confirm_certificate_mock):
+        with confirm.open_mailboxes(self.credentials) as mailboxes:
+            self.assertTrue(mailboxes.confirm_certificate('12345678-1234-1234-1234-123456789012'))
+
+        self.assertEqual(3, confirm_certificate_mock.call_count)
+        self.assertTrue(all(mailbox.closed for mailbox in mailboxes._mailboxes))
+
+    @patch("acmagent.confirm.ConfirmCertificate", side_effect=ConfirmCertificateStub)
+    def test_raises_exception_if_email_is_not_found_in_any_mailbox(self, confirm_certificate_mock):
+        self.credentials['accounts'][0]['folders'] = ['Empty']
+        self.credentials['accounts'][1]['folder'] = 'Empty'
+
+        with confirm.open_mailboxes(self.credentials) as mailboxes:
+            with self.assertRaises(acmagent.NoEmailsFoundException):
+                mailboxes.confirm_certificate('12345678-1234-1234-1234-123456789012')
+
+    def uid(self, command, *args):
+        certificate_id = '12345678-1234-1234-1234-123456789012'
+        emails = {'3': validation_email(certificate_id, 'example.com', 'example.com/new'),
+                  '4': validation_email(certificate_id, 'www.example.com', 'www.example.com/new')}
+        if command == 'SEARCH':
+            return 'OK', ['3 4']
+        response = []
+        for uid in sorted(emails):
+            response.append(('{} (UID {} BODY[] {{100}}'.format(uid, uid), emails[uid]))
+            response.append(')')
+        return 'OK', response
+
+    @patch.object(confirm.ConfirmCertificate, '_approve_newest', return_value=True)
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_certificate_found_in_every_mailbox_is_approved_once(self, imap_mock, approve_mock):
+        imap_mock.return_value.uid.side_effect = self.uid
+        with confirm.open_mailboxes(self.credentials) as mailboxes:
+            results = mailboxes.confirm_certificates(['12345678-1234-1234-1234-123456789012'])
+
+        self.assertEqual({'12345678-1234-1234-1234-123456789012': True}, results)
+        approve_mock.assert_called_once()
+
+    @patch.object(confirm.ConfirmCertificate, '_approve_domain', side_effect=lambda certificate_id, domain, candidates,
+                  cancelled: candidates[0][0])
+    @patch("acmagent.imap.IMAP4_SSL")
+    def test_domain_found_in_every_mailbox_is_approved_once(self, imap_mock, approve_mock):
+        imap_mock.return_value.uid.side_effect = self.uid
+        with confirm.open_mailboxes(self.credentials) as mailboxes:
+            results = mailboxes.confirm_domains('12345678-1234-1234-1234-123456789012')
+
+        self.assertEqual({'example.com': True, 'www.example.com': True}, results)
+        self.assertEqual(['example.com', 'www.example.com'],
+                         sorted(call[0][1] for call in approve_mock.call_args_list))
+
+    def test_failed_approval_releases_the_claim(self):
+        claims = confirm.ApprovalClaims()
+
+        self.assertTrue(claims.claim('first'))
+        self.assertFalse(claims.claim('first'))
+        claims.release('first')
+        self.assertTrue(claims.claim('first'))
+
+
+class ScheduledMailboxStub(object):
+    def __init__(self, ticks):
+        self.ticks = ticks
+        self.queries = []
+
+    def confirm_certificates(self, certificate_ids):
+        self.queries.append(certificate_ids)
+        return self.ticks.pop(0) if self.ticks else {}
+
+
+class TestConfirmScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = [0]
+
+    def sleep(self, seconds):
+        self.now[0] += seconds
+
+    def test_pending_certificates_are_checked_together_until_done_or_expired(self):
+        mailbox = ScheduledMailboxStub([
+            {'first': True},
+            {'second': acmagent.ConfirmPageIsMissingFormException('expired'), 'third': False},
+        ])
+        scheduler = confirm.ConfirmScheduler(mailbox, 5, clock=lambda: self.now[0], sleep=self.sleep)
+        for certificate_id in ('first', 'second', 'third'):
+            scheduler.add(certificate_id, 15)
+
+        results = list(scheduler.run())
+
+        self.assertEqual([('first', True, None), ('second', False, 'expired'), ('third', False, None)], results)
+
+        # single query per tick with the certificates still pending
+        self.assertEqual([['first', 'second', 'third'], ['second', 'third'], ['third']], mailbox.queries)
+        self.assertEqual([], scheduler.pending)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import unittest
+import acmagent
+from acmagent import deadline
+from acmagent import loadtest
+from acmagent import ratelimit
+from acmagent import request
+
+
+class TestDeadline(unittest.TestCase):
+    def setUp(self):
+        self.now = [100]
+        self.deadline = deadline.Deadline(10, clock=lambda: self.now[0])
+
+    def test_stage_timeout_is_bounded_by_the_remaining_time(self):
+        self.assertEqual(5, self.deadline.timeout(5, 'IMAP SEARCH'))
+        self.now[0] = 107
+        self.assertEqual(3, self.deadline.timeout(5, 'IMAP SEARCH'))
+        self.assertEqual(3, self.deadline.timeout(None, 'IMAP SEARCH'))
+
+    def test_exceeded_deadline_reports_the_stage(self):
+        self.now[0] = 110
+
+        with self.assertRaises(acmagent.OperationTimeoutException) as context:
+            self.deadline.check('HTTP POST')
+
+        self.assertEqual('HTTP POST', context.exception.stage)
+        self.assertIn('HTTP POST', str(context.exception))
+
+    def test_acm_calls_are_not_sent_after_the_deadline(self):
+        self.now[0] = 110
+        with loadtest.StubACMServer() as server:
+            acm_certificate_request = request.RequestCertificate(loadtest.stub_client(server.url),
+                                                                 ratelimit.AdaptiveRateLimiter(rate=1000),
+                                                                 deadline=self.deadline)
+            with self.assertRaises(acmagent.OperationTimeoutException) as context:
+                acm_certificate_request.request_certificate({'DomainName': 'www.example.com'})
+
+        self.assertEqual('ACM RequestCertificate', context.exception.stage)
+        self.assertEqual(0, server.requests['RequestCertificate'])
+
+    def test_acm_retries_are_not_sent_after_the_deadline(self):
+        with loadtest.StubACMServer(error_rate=1) as server:
+            acm_certificate_request = request.RequestCertificate(loadtest.stub_client(server.url),
+                                                                 ratelimit.AdaptiveRateLimiter(rate=1000),
+                                                                 deadline=self.deadline)
+            # the deadline passes while the first attempt fails
+            acm_certificate_request._acm_client.meta.events.register(
+                'needs-retry.acm', lambda **kwargs: self.now.__setitem__(0, 110))
+            with self.assertRaises(acmagent.OperationTimeoutException) as context:
+                acm_certificate_request.request_certificate({'DomainName': 'www.example.com'})
+            acm_certificate_request._acm_client._endpoint.http_session.close()
+
+        self.assertEqual('ACM RequestCertificate', context.exception.stage)
+        self.assertEqual(1, server.requests['RequestCertificate'])
+
+    def test_acm_timeouts_are_bounded_by_the_remaining_time(self):
+        self.now[0] = 108
+        acm_certificate_request = request.RequestCertificate(rate_limiter=ratelimit.AdaptiveRateLimiter(rate=1000),
+                                                             connect_timeout=5, deadline=self.deadline)
+
+        self.assertEqual(2, acm_certificate_request._acm_client.meta.config.connect_timeout)
+        self.assertEqual(2, acm_certificate_request._acm_client.meta.config.read_timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
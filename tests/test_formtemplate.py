@@ -0,0 +1,122 @@
+import unittest
+import acmagent
+from acmagent import confirm
+from acmagent import formtemplate
+from mock import patch
+from tests.test_confirm import CertificateApprovalFormStub, CertificateFailedApprovalFormStub, \
+    CertificateExpiredApprovalPageStub, HTTP_TIMEOUT
+
+FIRST_URL = 'https://certificates.amazon.com/approvals?code=first-code&context=first-context'
+SECOND_URL = 'https://certificates.amazon.com/approvals?context=second-context&code=second-code'
+
+
+class ApprovalPageStub(object):
+    def __init__(self, url, headers, timeout=None):
+        query = formtemplate._query(url)
+        self.content = """\
+        <html>
+            <body>
+                <form>
+                    <input type="hidden" name="validation_token" value="{code}" />
+                    <input type="hidden" name="context" value="{context}" />
+                    <input type="submit" name="commit" value="I Approve" />
+                </form>
+            </body>
+        </html>
+        """.format(**query)
+
+
+class ApprovalSuccessStub(object):
+    def __init__(self, url, headers, data, timeout=None):
+        self.ok = True
+        self.content = '<html><body><h1>Success!</h1></body></html>'
+
+
+class ApprovalErrorPageStub(object):
+    def __init__(self, url, headers, data, timeout=None):
+        self.ok = True
+        self.content = '<html><body><h1>This approval link has expired</h1></body></html>'
+
+
+class TestFormTemplates(unittest.TestCase):
+    def setUp(self):
+        self.templates = formtemplate.FormTemplates()
+
+    def test_form_of_a_new_url_is_built_from_its_query_parameters(self):
+        self.templates.learn(FIRST_URL, {'validation_token': 'first-code', 'context': 'first-context',
+                                         'commit': 'I Approve'})
+
+        self.assertEqual({'validation_token': 'second-code', 'context': 'second-context', 'commit': 'I Approve'},
+                         self.templates.payload(SECOND_URL))
+        self.assertIsNone(self.templates.payload('https://certificates.amazon.com/approvals?code=other-code'))
+
+    def test_form_without_url_inputs_is_not_learned(self):
+        self.templates.learn('test.com', {'test_input': 'test_value'})
+
+        self.assertIsNone(self.templates.payload('test.com'))
+
+    def test_rejected_template_is_not_learned_again(self):
+        self.templates.learn(FIRST_URL, {'validation_token': 'first-code'})
+        self.templates.reject(SECOND_URL)
+        self.templates.learn(FIRST_URL, {'validation_token': 'first-code'})
+
+        self.assertIsNone(self.templates.payload(SECOND_URL))
+
+
+@patch("acmagent.imap.IMAP4_SSL")
+@patch("acmagent.confirm.requests.get", side_effect=ApprovalPageStub)
+class TestConfirmFormTemplates(unittest.TestCase):
+    def setUp(self):
+        self.credentials = {'server': 'imap.example.com', 'username': 'test@example.com',
+                            'password': 'my_imap_password'}
+
+    def confirm_certificate(self):
+        return confirm.ConfirmCertificate(self.credentials, form_templates=formtemplate.FormTemplates())
+
+    @patch("acmagent.confirm.requests.post", side_effect=ApprovalSuccessStub)
+    def test_approval_page_is_requested_once_per_template(self, post_mock, get_mock, imap_mock):
+        confirm_certificate = self.confirm_certificate()
+
+        self.assertTrue(confirm_certificate._call_confirm_url(FIRST_URL))
+        self.assertTrue(confirm_certificate._call_confirm_url(SECOND_URL))
+
+        get_mock.assert_called_once_with(FIRST_URL, headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+        post_mock.assert_called_with(confirm.ConfirmCertificate.APPROVAL_FORM_URL, headers=acmagent.UserHeaders,
+                                     timeout=HTTP_TIMEOUT, data={'validation_token': 'second-code',
+                                                                 'context': 'second-context', 'commit': 'I Approve'})
+
+    def test_rejected_post_falls_back_to_the_approval_page(self, get_mock, imap_mock):
+        confirm_certificate = self.confirm_certificate()
+        responses = [CertificateApprovalFormStub, CertificateFailedApprovalFormStub, CertificateApprovalFormStub,
+                     CertificateApprovalFormStub]
+        with patch("acmagent.confirm.requests.post", side_effect=lambda *args, **kwargs: responses.pop(0)(
+                *args, **kwargs)) as post_mock:
+            confirm_certificate._call_confirm_url(FIRST_URL)
+            self.assertTrue(confirm_certificate._call_confirm_url(SECOND_URL))
+            # the rejected template is not used again
+            confirm_certificate._call_confirm_url(FIRST_URL)
+
+        self.assertEqual([FIRST_URL, SECOND_URL, FIRST_URL], [call[0][0] for call in get_mock.call_args_list])
+        self.assertEqual(4, post_mock.call_count)
+
+    def test_answer_without_success_page_is_checked_on_the_approval_page(self, get_mock, imap_mock):
+        third_url = 'https://certificates.amazon.com/approvals?code=third-code&context=third-context'
+        confirm_certificate = self.confirm_certificate()
+        responses = [CertificateApprovalFormStub, ApprovalErrorPageStub, ApprovalSuccessStub]
+        get_mock.side_effect = lambda url, **kwargs: (CertificateExpiredApprovalPageStub if url == SECOND_URL
+                                                      else ApprovalPageStub)(url, **kwargs)
+        with patch("acmagent.confirm.requests.post", side_effect=lambda *args, **kwargs: responses.pop(0)(
+                *args, **kwargs)) as post_mock:
+            confirm_certificate._call_confirm_url(FIRST_URL)
+            # the expired link is detected by the approval page
+            with self.assertRaises(acmagent.ConfirmPageIsMissingFormException):
+                confirm_certificate._call_confirm_url(SECOND_URL)
+            # the template approving nothing of an expired link is kept
+            self.assertTrue(confirm_certificate._call_confirm_url(third_url))
+
+        self.assertEqual([FIRST_URL, SECOND_URL], [call[0][0] for call in get_mock.call_args_list])
+        self.assertEqual(3, post_mock.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
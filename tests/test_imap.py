@@ -0,0 +1,129 @@
+import unittest
+import re
+import zlib
+from acmagent import imap
+from acmagent import metrics
+from mock import patch
+
+
+class ScriptedIMAPSocket(object):
+    """
+    Server side of an IMAP session over a wrapped socket, every command line is answered
+    from the script as soon as it is sent, the traffic is deflated after COMPRESS
+    """
+    def __init__(self, capabilities, message):
+        self.capabilities = capabilities
+        self.message = message
+        self.log = []
+        self._outgoing = '* OK IMAP4rev1 ready\r\n'
+        self._incoming = ''
+        self._deflate = None
+        self._inflate = None
+
+    def settimeout(self, timeout):
+        pass
+
+    def makefile(self, mode):
+        return self
+
+    def _reply(self, data):
+        if self._deflate:
+            data = self._deflate.compress(data) + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+        self._outgoing += data
+
+    def _take(self, size):
+        self.log.append('read')
+        data, self._outgoing = self._outgoing[:size], self._outgoing[size:]
+        return data
+
+    def read(self, size):
+        return self._take(size)
+
+    def readline(self, size=None):
+        return self._take(self._outgoing.find('\n') + 1)
+
+    def recv(self, size):
+        return self._take(size)
+
+    def sendall(self, data):
+        self._incoming += self._inflate.decompress(data) if self._inflate else data
+        while '\r\n' in self._incoming:
+            line, self._incoming = self._incoming.split('\r\n', 1)
+            self._command(*line.split(' ', 2))
+
+    def write(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def _command(self, tag, name, arguments=''):
+        self.log.append(' '.join([name] + arguments.split(' ')[:1]) if name == 'UID' else name)
+        if name == 'CAPABILITY':
+            self._reply('* CAPABILITY IMAP4rev1\r\n{} OK done\r\n'.format(tag))
+        elif name == 'LOGIN':
+            self._reply('{} OK [CAPABILITY {}] logged in\r\n'.format(tag, ' '.join(self.capabilities)))
+        elif name == 'COMPRESS':
+            self._reply('{} OK DEFLATE active\r\n'.format(tag))
+            self._deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            self._inflate = zlib.decompressobj(-15)
+        elif name == 'SELECT':
+            self._reply('* 2 EXISTS\r\n{} OK [READ-WRITE] selected\r\n'.format(tag))
+        elif arguments.startswith('SEARCH'):
+            uids = re.search(r'UID ([\d,:]+)', arguments).group(1)
+            self._reply('* SEARCH {}\r\n{} OK done\r\n'.format(uids.replace(',', ' '), tag))
+        elif arguments.startswith('FETCH'):
+            uid = arguments.split(' ')[1]
+            self._reply('* {0} FETCH (UID {0} RFC822 {{{1}}}\r\n{2})\r\n{3} OK done\r\n'.format(
+                uid, len(self.message), self.message, tag))
+        else:
+            self._reply('{} OK done\r\n'.format(tag))
+
+
+class TestIMAP4SSL(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.message = 'Subject: test\r\n\r\n' + 'Certificate identifier: 12345678\r\n' * 100
+
+    def connect(self, capabilities):
+        server = ScriptedIMAPSocket(capabilities, self.message)
+        with patch("socket.create_connection"), patch("acmagent.imap.ssl_context") as ssl_context_mock:
+            ssl_context_mock.return_value.wrap_socket.return_value = server
+            connection = imap.IMAP4_SSL('imap.example.com')
+        connection.login('test@example.com', 'my_imap_password')
+        return connection, server
+
+    def test_traffic_is_deflated_when_server_supports_compression(self):
+        connection, server = self.connect(['IMAP4rev1', 'COMPRESS=DEFLATE'])
+
+        self.assertTrue(connection.compress())
+        self.assertFalse(connection.compress())
+        connection.select('INBOX')
+        typ, response = connection.uid('FETCH', '7', '(UID RFC822)')
+
+        self.assertEqual('OK', typ)
+        self.assertEqual(self.message, response[0][1])
+        compressed = metrics.get('imap_compressed_bytes', server='imap.example.com')
+        self.assertTrue(compressed < metrics.get('imap_inflated_bytes', server='imap.example.com'))
+        self.assertEqual(['CAPABILITY', 'LOGIN', 'COMPRESS', 'SELECT', 'UID FETCH'],
+                         [entry for entry in server.log if entry != 'read'])
+
+    def test_compression_is_not_requested_without_server_support(self):
+        connection, server = self.connect(['IMAP4rev1'])
+
+        self.assertFalse(connection.compress())
+        self.assertNotIn('COMPRESS', server.log)
+
+    def test_pipelined_commands_are_sent_before_the_responses_are_read(self):
+        connection, server = self.connect(['IMAP4rev1', 'COMPRESS=DEFLATE'])
+        connection.compress()
+        connection.select('INBOX')
+        del server.log[:]
+
+        results = connection.uid_pipeline(('SEARCH', None, 'UID 1,2'), ('SEARCH', None, 'UID 3'),
+                                          ('STORE', '1', '+FLAGS', '(\\Seen)'))
+
+        self.assertEqual([('OK', ['1 2']), ('OK', ['3']), ('OK', [None])], results)
+        self.assertEqual(['UID SEARCH', 'UID SEARCH', 'UID STORE'], server.log[:3])
+
+
+if __name__ == '__main__':
+    unittest.main()
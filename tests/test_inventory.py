@@ -0,0 +1,124 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import datetime
+import mock
+from acmagent import inventory
+
+
+class TestCertificateInventory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = inventory.InventoryStore(os.path.join(self.tmpdir, 'inventory.sqlite'))
+        self.issued_arn = 'arn:aws:acm:us-east-1:123456789012:certificate/12345678-1234-1234-1234-123456789012'
+        self.pending_arn = 'arn:aws:acm:us-east-1:123456789012:certificate/87654321-1234-1234-1234-123456789012'
+        self.certificates = {
+            self.issued_arn: {'CertificateArn': self.issued_arn, 'DomainName': 'www.example.com', 'Status': 'ISSUED'},
+            self.pending_arn: {'CertificateArn': self.pending_arn, 'DomainName': 'ftp.example.com',
+                               'Status': 'PENDING_VALIDATION'}
+        }
+        self.acm = mock.MagicMock()
+        self.acm.describe_certificate.side_effect = lambda arn: self.certificates[arn]
+        self.acm.list_certificates.side_effect = lambda: iter([
+            {'CertificateArn': arn, 'DomainName': certificate['DomainName']}
+            for arn, certificate in self.certificates.items()])
+
+    def tearDown(self):
+        self.store.__exit__(None, None, None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_unknown_certificate_ids_are_resolved_and_described(self):
+        certificate_inventory = inventory.CertificateInventory(self.store, self.acm)
+        results = certificate_inventory.status(['12345678-1234-1234-1234-123456789012'])
+
+        self.assertEqual([('12345678-1234-1234-1234-123456789012', 'ISSUED', None)],
+                         [(certificate_id, entry['status'], error) for certificate_id, entry, error in results])
+        self.acm.list_certificates.assert_called_once_with()
+        self.acm.describe_certificate.assert_called_once_with(self.issued_arn)
+
+    def test_fresh_entries_are_answered_from_the_store(self):
+        certificate_inventory = inventory.CertificateInventory(self.store, self.acm)
+        certificate_inventory.status([self.issued_arn, self.pending_arn])
+        self.acm.describe_certificate.reset_mock()
+
+        # pending certificate expires earlier than the issued one
+        with mock.patch('time.time', return_value=time.time() + inventory.InventoryStore.PENDING_TTL + 1):
+            results = certificate_inventory.status()
+
+        self.assertEqual(2, len(results))
+        self.acm.describe_certificate.assert_called_once_with(self.pending_arn)
+        self.acm.list_certificates.assert_not_called()
+
+    def test_refresh_describes_every_certificate(self):
+        certificate_inventory = inventory.CertificateInventory(self.store, self.acm)
+        certificate_inventory.status([self.issued_arn, self.pending_arn])
+        certificate_inventory.status(refresh=True)
+
+        self.assertEqual(4, self.acm.describe_certificate.call_count)
+
+    def test_missing_certificate_is_reported_with_error(self):
+        certificate_inventory = inventory.CertificateInventory(self.store, self.acm)
+        results = certificate_inventory.status(['missing'])
+
+        self.assertEqual([('missing', None, 'Certificate is not found')], results)
+
+
+class TestInventorySnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = inventory.InventoryStore(os.path.join(self.tmpdir, 'inventory.sqlite'))
+        now = datetime.datetime.utcnow()
+        self.store.put({
+            'CertificateArn': 'arn:aws:acm:us-east-1:123456789012:certificate/wildcard',
+            'DomainName': '*.foo.example.com',
+            'SubjectAlternativeNames': ['*.foo.example.com', 'foo.example.com'],
+            'Status': 'ISSUED',
+            'NotAfter': now + datetime.timedelta(days=10)
+        })
+        self.store.put({
+            'CertificateArn': 'arn:aws:acm:us-east-1:123456789012:certificate/www',
+            'DomainName': 'www.example.com',
+            'SubjectAlternativeNames': ['www.example.com'],
+            'Status': 'ISSUED',
+            'NotAfter': now + datetime.timedelta(days=100)
+        })
+        self.store.put({
+            'CertificateArn': 'arn:aws:acm:us-east-1:123456789012:certificate/pending',
+            'DomainName': 'api.example.org',
+            'Status': 'PENDING_VALIDATION'
+        })
+
+    def tearDown(self):
+        self.store.__exit__(None, None, None)
+        shutil.rmtree(self.tmpdir)
+
+    def query(self, store, **kwargs):
+        return [entry['id'] for entry in store.query(**kwargs)]
+
+    def test_query_certificates_covering_name(self):
+        self.assertEqual(['wildcard'], self.query(self.store, covers='bar.foo.example.com'))
+        self.assertEqual(['wildcard'], self.query(self.store, covers='*.foo.example.com'))
+        self.assertEqual(['www'], self.query(self.store, covers='WWW.example.com'))
+
+    def test_query_certificates_by_domain_suffix(self):
+        self.assertEqual(['wildcard', 'www'], self.query(self.store, suffix='example.com'))
+        self.assertEqual(['pending'], self.query(self.store, suffix='example.org'))
+
+    def test_query_certificates_expiring_in_days(self):
+        self.assertEqual(['wildcard'], self.query(self.store, expiring_days=30))
+        self.assertEqual(['pending'], self.query(self.store, status='PENDING_VALIDATION'))
+
+    def test_exported_snapshot_is_imported_into_another_inventory(self):
+        snapshot = os.path.join(self.tmpdir, 'snapshot.sqlite')
+        self.store.export(snapshot)
+
+        with inventory.InventoryStore(os.path.join(self.tmpdir, 'other.sqlite')) as other:
+            other.import_snapshot(snapshot)
+            self.assertEqual('ISSUED', other.get('www')['status'])
+            self.assertEqual(['wildcard'], self.query(other, covers='bar.foo.example.com', expiring_days=30))
+
+
+if __name__ == '__main__':
+    unittest.main()
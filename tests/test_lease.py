@@ -0,0 +1,170 @@
+import unittest
+import shutil
+import threading
+import tempfile
+import time
+import mock
+import acmagent
+from acmagent import lease
+
+
+class LeaseBackendTests(object):
+    """
+    Tests shared by the lease backends
+    """
+    def leases(self, owner, ttl=None):
+        leases = lease.Leases(self.backend, owner=owner, ttl=ttl)
+        self.addCleanup(leases.close)
+        return leases
+
+    def test_lease_is_exclusive_until_released(self):
+        first = self.leases('first')
+        second = self.leases('second')
+
+        self.assertTrue(first.acquire('certificate/12345'))
+        self.assertTrue(first.acquire('certificate/12345'))
+        self.assertFalse(second.acquire('certificate/12345'))
+        self.assertTrue(second.acquire('certificate/67890'))
+
+        second.release('certificate/12345')
+        self.assertFalse(second.acquire('certificate/12345'))
+
+        first.release('certificate/12345')
+        self.assertTrue(second.acquire('certificate/12345'))
+
+    def test_expired_lease_can_be_acquired_by_another_worker(self):
+        first = self.leases('first', ttl=60)
+        second = self.leases('second', ttl=60)
+        self.assertTrue(first.acquire('email/1'))
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertTrue(second.acquire('email/1'))
+        self.assertFalse(first.acquire('email/1'))
+
+
+    def test_renewed_lease_outlives_the_ttl(self):
+        first = self.leases('first', ttl=60)
+        second = self.leases('second', ttl=60)
+        self.assertTrue(first.acquire('certificate/12345'))
+        started = time.time()
+
+        with mock.patch('time.time', return_value=started + 50):
+            self.assertEqual([], first.renew())
+        with mock.patch('time.time', return_value=started + 100):
+            self.assertFalse(second.acquire('certificate/12345'))
+        with mock.patch('time.time', return_value=started + 120):
+            self.assertTrue(second.acquire('certificate/12345'))
+            self.assertEqual(['certificate/12345'], first.renew())
+
+    def test_expired_lease_is_taken_over_by_a_single_worker(self):
+        self.leases('crashed', ttl=60).acquire('email/1')
+        workers = [self.leases('worker-{}'.format(number), ttl=60) for number in range(8)]
+        acquired = []
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            threads = [threading.Thread(target=lambda worker=worker: acquired.append(worker.acquire('email/1')))
+                       for worker in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(1, acquired.count(True))
+            self.assertEqual(1, [worker.acquire('email/1') for worker in workers].count(True))
+
+
+class TestSqliteLeaseBackend(LeaseBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backend = lease.open_backend('sqlite://{}/leases.sqlite'.format(self.tmpdir))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestFileLeaseBackend(LeaseBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backend = lease.open_backend('file://{}/leases'.format(self.tmpdir))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class RedisStandIn(object):
+    """
+    In-memory stand-in of the redis.StrictRedis commands used by the lease backend
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @classmethod
+    def from_url(cls, url):
+        return cls()
+
+    def _get(self, key):
+        value, expires_at = self._values.get(key, (None, 0))
+        return value if expires_at > time.time() else None
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        with self._lock:
+            if nx and self._get(key) is not None:
+                return None
+            self._values[key] = (value, time.time() + px / 1000.0)
+            return True
+
+    def eval(self, script, numkeys, key, owner, *args):
+        with self._lock:
+            if self._get(key) != owner:
+                return 0
+            if script == lease.RedisLeaseBackend.RENEW_SCRIPT:
+                self._values[key] = (owner, time.time() + args[0] / 1000.0)
+            else:
+                del self._values[key]
+            return 1
+
+
+class TestRedisLeaseBackend(LeaseBackendTests, unittest.TestCase):
+    def setUp(self):
+        redis_module = mock.MagicMock()
+        redis_module.StrictRedis = RedisStandIn
+        with mock.patch('acmagent.lease.redis', redis_module):
+            self.backend = lease.open_backend('redis://localhost:6379/0')
+
+    def test_redis_package_is_required(self):
+        with mock.patch('acmagent.lease.redis', None):
+            with self.assertRaises(acmagent.InvalidLeaseBackendException):
+                lease.open_backend('redis://localhost:6379/0')
+
+
+class TestLeases(unittest.TestCase):
+    def test_held_leases_are_renewed_until_released(self):
+        backend = mock.MagicMock()
+        leases = lease.Leases(backend, owner='worker', ttl=0.03)
+        leases.acquire('certificate/12345')
+        leases.acquire('email/1')
+        leases.release('email/1')
+
+        for attempt in range(100):
+            if backend.renew.called:
+                break
+            time.sleep(0.01)
+        leases.close()
+
+        backend.renew.assert_called_with('certificate/12345', 'worker', 0.03)
+        self.assertNotIn(mock.call('email/1', 'worker', 0.03), backend.renew.call_args_list)
+
+
+class TestOpenBackend(unittest.TestCase):
+    def test_unknown_backend_raises_exception(self):
+        with self.assertRaises(acmagent.InvalidLeaseBackendException):
+            lease.open_backend('zookeeper://localhost')
+
+
+if __name__ == '__main__':
+    unittest.main()
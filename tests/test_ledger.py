@@ -0,0 +1,97 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+from dateutil.tz import tzutc
+from acmagent import confirm
+from acmagent import ledger
+from acmagent import request
+from mock import MagicMock, patch
+from tests.test_confirm import CertificateApprovalPageStub, CertificateApprovalFormStub
+from tests.test_localmail import certificate_email
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'ledger.sqlite')
+        self.certificate_id = '12345678-1234-1234-1234-123456789012'
+
+    def tearDown(self):
+        ledger.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_first_timestamp_of_every_stage_is_kept(self):
+        certificate_ledger = ledger.Ledger(self.filename)
+        certificate_ledger.record(self.certificate_id.upper(), 'requested', 100)
+        certificate_ledger.record(self.certificate_id, 'requested', 200)
+        certificate_ledger.record(self.certificate_id, 'issued', 400)
+
+        self.assertEqual({self.certificate_id: {'requested': 100, 'issued': 400}}, certificate_ledger.entries())
+
+    def test_report_has_percentiles_of_every_interval(self):
+        entries = {str(number): {'requested': 0, 'email_received': number, 'approval_submitted': number + 5}
+                   for number in range(1, 101)}
+        entries['pending'] = {'requested': 0}
+
+        report = {result['stage']: result for result in ledger.report(entries)}
+
+        self.assertEqual({'stage': 'requested..email_received', 'count': 100, 'p50': 50, 'p95': 95, 'p99': 99,
+                          'max': 100}, report['requested..email_received'])
+        self.assertEqual(5, report['email_received..approval_submitted']['p99'])
+        self.assertEqual(0, report['requested..issued']['count'])
+        self.assertIsNone(report['requested..issued']['p50'])
+
+    def test_stages_are_not_recorded_without_started_ledger(self):
+        ledger.record(self.certificate_id, 'requested')
+
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_request_and_issued_status_are_recorded(self):
+        certificate_arn = 'arn:aws:acm:us-east-1:123456789012:certificate/{}'.format(self.certificate_id)
+        acm_client = MagicMock()
+        acm_client.request_certificate.return_value = {'CertificateArn': certificate_arn}
+        acm_client.describe_certificate.return_value = {'Certificate': {
+            'CertificateArn': certificate_arn,
+            'Status': 'ISSUED',
+            'CreatedAt': datetime.datetime(2018, 1, 1, 0, 0, 0, tzinfo=tzutc()),
+            'IssuedAt': datetime.datetime(2018, 1, 1, 0, 10, 0, tzinfo=tzutc())
+        }}
+
+        certificate_ledger = ledger.start(self.filename)
+        acm_certificate_request = request.RequestCertificate(acm_client, MagicMock())
+        with patch('acmagent.ledger.time.time', return_value=1514764790):
+            acm_certificate_request.request_certificate({'DomainName': 'example.com'})
+        acm_certificate_request.describe_certificate(certificate_arn)
+
+        # the request time is kept, the creation time of the description is ignored
+        self.assertEqual({'requested': 1514764790, 'issued': 1514765400},
+                         certificate_ledger.entries()[self.certificate_id])
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    def test_email_date_and_approval_are_recorded(self, post_mock, get_mock):
+        with open(os.path.join(self.tmpdir, 'approval.eml'), 'w') as eml_file:
+            eml_file.write(certificate_email(self.certificate_id, 'test.com').replace(
+                '\n', '\nDate: Mon, 01 Jan 2018 00:05:00 +0000\n', 1))
+
+        certificate_ledger = ledger.start(self.filename)
+        with patch('acmagent.ledger.time.time', return_value=1514765000):
+            with confirm.open_mailboxes({'eml': self.tmpdir}) as confirm_certificate:
+                self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
+                # dates of the fetched emails are not kept after the call
+                self.assertEqual({}, confirm_certificate._received_at)
+
+        self.assertEqual({'email_received': 1514765100, 'approval_submitted': 1514765000},
+                         certificate_ledger.entries()[self.certificate_id])
+
+    def test_email_date_is_read_from_the_headers_only(self):
+        self.assertEqual(1514765100, confirm.email_date(
+            'Subject: test\r\ndate: Mon, 01 Jan 2018 01:05:00 +0100\r\n\r\nDate: Tue, 02 Jan 2018 00:00:00 +0000\r\n'))
+        self.assertIsNone(confirm.email_date('Subject: test\n\nDate: Tue, 02 Jan 2018 00:00:00 +0000\n'))
+        self.assertIsNone(confirm.email_date('Date: yesterday\n\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
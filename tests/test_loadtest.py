@@ -0,0 +1,46 @@
+import unittest
+from acmagent import loadtest
+from acmagent import ratelimit
+from acmagent import request
+from mock import patch
+
+
+class TestLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.certificates = [{'DomainName': 'load-{}.example.com'.format(number)} for number in range(20)]
+
+    def test_percentile_uses_nearest_rank(self):
+        values = range(1, 101)
+
+        self.assertEqual(50, loadtest.percentile(values, 50))
+        self.assertEqual(99, loadtest.percentile(values, 99))
+        self.assertEqual(1, loadtest.percentile([1], 95))
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_workload_reports_throughput_and_latency_percentiles(self):
+        with loadtest.StubACMServer(latency=0.01) as server:
+            acm_certificate_request = request.RequestCertificate(loadtest.stub_client(server.url, 4),
+                                                                 ratelimit.AdaptiveRateLimiter(rate=1000, max_rate=1000))
+            result = loadtest.run_workload(acm_certificate_request, self.certificates, 4)
+
+        self.assertEqual(20, result['requests'])
+        self.assertEqual(20, server.requests['RequestCertificate'])
+        self.assertEqual({}, result['errors'])
+        self.assertEqual(0, result['retries'])
+        self.assertTrue(0.01 <= result['p50'] <= result['p95'] <= result['p99'])
+        self.assertTrue(result['throughput'] > 0)
+
+    @patch("botocore.endpoint.time.sleep")
+    def test_throttled_requests_are_retried_and_reported(self, sleep_mock):
+        with loadtest.StubACMServer(throttle_rate=1) as server:
+            acm_certificate_request = request.RequestCertificate(loadtest.stub_client(server.url),
+                                                                 ratelimit.AdaptiveRateLimiter(rate=1000, max_rate=1000))
+            result = loadtest.run_workload(acm_certificate_request, self.certificates[:2], 2)
+
+        self.assertEqual({'ThrottlingException': 2}, result['errors'])
+        self.assertEqual(server.requests['RequestCertificate'] - 2, result['retries'])
+        self.assertTrue(result['retries'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
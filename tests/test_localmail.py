@@ -0,0 +1,134 @@
+import unittest
+import os
+import shutil
+import tempfile
+import acmagent
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from acmagent import confirm
+from acmagent import localmail
+from acmagent import mailsource
+from mock import patch
+from tests.test_confirm import CertificateApprovalPageStub, CertificateApprovalFormStub, HTTP_TIMEOUT
+
+
+def certificate_email(certificate_id, approval_url):
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = 'Certificate approval'
+    msg['From'] = 'Amazon Certificates <no-reply@certificates.amazon.com>'
+    msg.attach(MIMEText('Certificate identifier: {}\n'.format(certificate_id), 'plain'))
+    msg.attach(MIMEText('<html><body><a href="{}" id="approval_url"></a></body></html>'.format(approval_url), 'html'))
+    return str(msg)
+
+
+class TestLocalMail(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.certificate_id = '12345678-1234-1234-1234-123456789012'
+        self.other_certificate_id = '87654321-1234-1234-1234-123456789012'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, content, modified=None):
+        filename = os.path.join(self.tmpdir, filename)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(content)
+        if modified:
+            os.utime(filename, (modified, modified))
+        return filename
+
+    def test_find_certificate_id_joins_quoted_printable_soft_line_breaks(self):
+        raw_message = 'Subject: test\r\n\r\nCertificate identifier: 12345678-1234-=\r\n1234-1234-123456789012\r\n'
+
+        self.assertEqual(self.certificate_id, mailsource.find_certificate_id(raw_message))
+        self.assertIsNone(mailsource.find_certificate_id('Subject: test\r\n\r\nNo identifier'))
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    def test_maildir_newest_unseen_email_is_approved_and_flagged(self, post_mock, get_mock):
+        self.write('cur/1:2,S', certificate_email(self.certificate_id, 'seen.com'), 3000)
+        self.write('cur/2:2,', certificate_email(self.certificate_id, 'old.com'), 1000)
+        self.write('new/3', certificate_email(self.certificate_id, 'new.com'), 2000)
+        self.write('new/4', certificate_email(self.other_certificate_id, 'other.com'), 4000)
+
+        with confirm.open_mailboxes({'maildir': self.tmpdir, 'approved_folder': 'Approved'}) as mailbox:
+            self.assertIsInstance(mailbox._source, localmail.MaildirSource)
+            self.assertTrue(mailbox.confirm_certificate(self.certificate_id))
+
+        get_mock.assert_called_once_with('new.com', headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+        self.assertEqual(['3:2,S'], os.listdir(os.path.join(self.tmpdir, '.Approved', 'cur')))
+        self.assertEqual(['4'], os.listdir(os.path.join(self.tmpdir, 'new')))
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    def test_maildir_email_moved_after_the_scan_is_skipped(self, post_mock, get_mock):
+        self.write('new/3', certificate_email(self.certificate_id, 'new.com'), 2000)
+        self.write('cur/2:2,', certificate_email(self.certificate_id, 'old.com'), 1000)
+
+        with confirm.open_mailboxes({'maildir': self.tmpdir}) as mailbox:
+            self.assertEqual(['new/3', 'cur/2:2,'], mailbox._source.list([self.certificate_id])[self.certificate_id])
+            # another mail client has moved the email since the scan
+            os.rename(os.path.join(self.tmpdir, 'new', '3'), os.path.join(self.tmpdir, 'cur', '3:2,'))
+            os.utime(os.path.join(self.tmpdir, 'cur', '3:2,'), (500, 500))
+            self.assertTrue(mailbox.confirm_certificate(self.certificate_id))
+
+        get_mock.assert_called_once_with('old.com', headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    def test_maildir_failing_to_move_approved_emails_is_closed(self, post_mock, get_mock):
+        self.write('new/3', certificate_email(self.certificate_id, 'new.com'))
+        os.makedirs(os.path.join(self.tmpdir, 'cur'))
+        # the approved folder can not be created over a file
+        self.write('.Approved', '')
+
+        with patch.object(localmail.MaildirSource, 'close') as close_mock:
+            with confirm.open_mailboxes({'maildir': self.tmpdir, 'approved_folder': 'Approved'}) as mailbox:
+                self.assertTrue(mailbox.confirm_certificate(self.certificate_id))
+
+        close_mock.assert_called_once_with()
+        self.assertEqual(['3'], os.listdir(os.path.join(self.tmpdir, 'new')))
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    def test_mbox_read_emails_are_skipped_and_appended_emails_are_found(self, post_mock, get_mock):
+        filename = self.write('mbox', ''.join([
+            'From MAILER-DAEMON Mon Jan  1 00:00:00 2018\n',
+            certificate_email(self.certificate_id, 'read.com').replace('\n\n', '\nStatus: RO\n\n', 1), '\n',
+            'From MAILER-DAEMON Mon Jan  1 00:00:00 2018\n',
+            certificate_email(self.certificate_id, 'unread.com'), '\n',
+        ]))
+
+        with confirm.open_mailboxes({'mbox': filename}) as mailbox:
+            self.assertTrue(mailbox.confirm_certificate(self.certificate_id))
+            get_mock.assert_called_once_with('unread.com', headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+
+            with self.assertRaises(acmagent.NoEmailsFoundException):
+                mailbox.confirm_certificate(self.other_certificate_id)
+
+            with open(filename, 'a') as f:
+                f.write('From MAILER-DAEMON Mon Jan  1 00:00:00 2018\n')
+                f.write(certificate_email(self.other_certificate_id, 'other.com'))
+            self.assertTrue(mailbox.confirm_certificate(self.other_certificate_id))
+
+        get_mock.assert_called_with('other.com', headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+
+    def test_eml_directory_emails_are_found_with_single_scan(self):
+        self.write('first.eml', certificate_email(self.certificate_id, 'first.com'))
+        self.write('second.eml', certificate_email(self.other_certificate_id, 'second.com'))
+        self.write('notes.txt', certificate_email(self.other_certificate_id, 'notes.com'))
+
+        with confirm.open_mailboxes({'eml': self.tmpdir}) as mailbox:
+            with patch.object(mailbox, '_approve_newest', return_value=True) as approve_mock:
+                results = mailbox.confirm_certificates([self.certificate_id, self.other_certificate_id])
+
+        self.assertEqual({self.certificate_id: True, self.other_certificate_id: True}, results)
+        chunks = {call[0][0]: list(call[0][1]) for call in approve_mock.call_args_list}
+        self.assertEqual([[os.path.join(self.tmpdir, 'second.eml')]], chunks[self.other_certificate_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import acmagent
+from acmagent import preflight
+from acmagent import request
+
+
+def certificate(domain_name, alternative_names=None, validation_domain=None):
+    return request.Certificate({
+        'domain_name': domain_name,
+        'subject_alternative_names': alternative_names or [],
+        'domain_validation_options': validation_domain
+    })
+
+
+class TestValidator(unittest.TestCase):
+    def setUp(self):
+        self.validator = preflight.Validator()
+
+    def test_valid_certificate_has_no_errors(self):
+        self.assertEqual([], self.validator.errors(certificate(
+            'www.example.com', ['*.api.example.com', 'Example.com'], 'example.com')))
+
+    def test_names_which_are_not_fully_qualified_are_rejected(self):
+        errors = self.validator.errors(certificate('localhost', ['-bad.example.com', 'www.*.example.com', '10.0.0.1',
+                                                                'ok.example.com']))
+
+        self.assertEqual(['localhost is not a fully qualified domain name',
+                          '-bad.example.com is not a fully qualified domain name',
+                          'www.*.example.com is not a fully qualified domain name',
+                          '10.0.0.1 is not a fully qualified domain name'], errors)
+        self.assertEqual(['Domain name is missing'], self.validator.errors(certificate('')))
+
+    def test_duplicate_and_too_many_alternative_names_are_rejected(self):
+        alternative_names = ['www{}.example.com'.format(number) for number in range(10)] + ['WWW1.example.com']
+
+        self.assertEqual(['Duplicate alternative names: www1.example.com',
+                          'Certificate has 11 domain names, at most 10 are allowed'],
+                         self.validator.errors(certificate('example.com', alternative_names)))
+        self.assertEqual([], preflight.Validator(max_domain_names=20).errors(certificate(
+            'example.com', alternative_names[:-1])))
+
+    def test_validation_domain_must_be_a_suffix_of_every_name(self):
+        self.assertEqual(['Validation domain example.com is not a suffix of www.example.org, xexample.com'],
+                         self.validator.errors(certificate('www.example.com', ['www.example.org', 'xexample.com'],
+                                                           'example.com')))
+
+    def test_long_domain_name_is_rejected(self):
+        domain_name = '{}.example.com'.format('a' * 60)
+
+        self.assertEqual(['{} is longer than 64 characters, use it as an alternative name'.format(domain_name)],
+                         self.validator.errors(certificate(domain_name)))
+        self.assertEqual([], self.validator.errors(certificate('example.com', [domain_name])))
+
+    def test_check_raises_exception_with_all_errors(self):
+        with self.assertRaises(acmagent.InvalidCertificateSpecException) as context:
+            self.validator.check(certificate('www.example.com', ['a.example.com', 'a.example.com'], 'example.org'))
+
+        self.assertEqual('Duplicate alternative names: a.example.com; '
+                         'Validation domain example.org is not a suffix of a.example.com, www.example.com',
+                         str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
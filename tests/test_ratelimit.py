@@ -0,0 +1,68 @@
+import unittest
+from botocore.exceptions import ClientError
+from acmagent import loadtest
+from acmagent import metrics
+from acmagent import ratelimit
+from acmagent import request
+from mock import patch
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.now = [100.0]
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+    def limiter(self, **options):
+        return ratelimit.AdaptiveRateLimiter(clock=lambda: self.now[0], sleep=self.sleep, labels={'region': 'test'},
+                                             **options)
+
+    def test_calls_of_all_threads_are_paced_at_the_current_rate(self):
+        limiter = self.limiter(rate=2)
+        for call in range(3):
+            limiter.acquire()
+
+        self.assertEqual([0.5, 1.0], self.sleeps)
+
+    def test_rate_is_halved_once_per_throttled_burst_and_recovers_after_successes(self):
+        limiter = self.limiter(rate=4, min_rate=1, max_rate=4.2)
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(2, limiter.rate)
+        self.assertEqual(2, metrics.get('acm_throttled', region='test'))
+
+        self.now[0] += 1
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(1, limiter.rate)
+        self.assertEqual(1, metrics.get('acm_rate_limit', region='test'))
+
+        for call in range(40):
+            limiter.succeeded()
+        self.assertEqual(4.2, limiter.rate)
+        self.assertEqual(4.2, metrics.get('acm_rate_limit', region='test'))
+
+    def test_shared_limiter_is_reused_for_region_and_account(self):
+        limiter = ratelimit.shared_limiter('ap-southeast-2', 'AKIAEXAMPLE1234')
+
+        self.assertIs(limiter, ratelimit.shared_limiter('ap-southeast-2', 'AKIAEXAMPLE1234'))
+        self.assertIsNot(limiter, ratelimit.shared_limiter('us-east-1', 'AKIAEXAMPLE1234'))
+        self.assertIsNotNone(metrics.get('acm_rate_limit', region='ap-southeast-2', account='*1234'))
+
+    @patch("botocore.endpoint.time.sleep")
+    def test_every_attempt_of_acm_call_goes_through_limiter(self, sleep_mock):
+        limiter = ratelimit.AdaptiveRateLimiter(rate=40, labels={'region': 'stub'})
+        with loadtest.StubACMServer(throttle_rate=1) as server:
+            acm_certificate_request = request.RequestCertificate(loadtest.stub_client(server.url), limiter)
+            with self.assertRaises(ClientError):
+                acm_certificate_request.describe_certificate('arn:aws:acm:us-east-1:123456789012:certificate/1')
+
+        self.assertTrue(limiter.rate < 40)
+        self.assertEqual(server.requests['DescribeCertificate'], metrics.get('acm_throttled', region='stub'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -116,6 +116,62 @@ class TestCertificate(unittest.TestCase):
         with self.assertRaises(acmagent.InvalidCertificateJsonFileException) as context:
             request.Certificate.from_json_input(json_input)
 
+    def test_certificate_template_is_expanded_lazily_for_every_dimension_combination(self):
+        template = {
+            'DomainName': '{svc}.{env}.example.com',
+            'ValidationDomain': self.domain_validation_options,
+            'SubjectAlternativeNames': ['www.{svc}.{env}.example.com'],
+            'Dimensions': {
+                'svc': ['api', 'web'],
+                'env': ['dev', 'prod']
+            }
+        }
+
+        certificates = request.Certificate.from_template(template)
+        first = next(certificates)
+        self.assertEqual('api.dev.example.com', first.domain_name)
+        self.assertEqual(['www.api.dev.example.com'], first.subject_alternative_names)
+
+        domain_names = [first.domain_name] + [certificate.domain_name for certificate in certificates]
+        # dimensions are combined in the alphabetical order of their names
+        self.assertEqual(['api.dev.example.com', 'web.dev.example.com', 'api.prod.example.com', 'web.prod.example.com'],
+                         domain_names)
+
+    def test_certificate_template_triggers_exception_if_dimension_is_unknown(self):
+        template = {
+            'DomainName': '{svc}.{region}.example.com',
+            'ValidationDomain': self.domain_validation_options,
+            'SubjectAlternativeNames': [],
+            'Dimensions': {'svc': ['api']}
+        }
+
+        with self.assertRaises(acmagent.InvalidCertificateJsonFileException):
+            list(request.Certificate.from_template(template))
+
+    def test_certificate_template_passes_values_other_than_strings_as_they_are(self):
+        template = {
+            'DomainName': '{svc}.example.com',
+            'ValidationDomain': None,
+            'SubjectAlternativeNames': [],
+            'Dimensions': {'svc': ['api']}
+        }
+
+        certificate = next(request.Certificate.from_template(template))
+
+        self.assertEqual('api.example.com', certificate.domain_name)
+        self.assertIsNone(certificate.domain_validation_options)
+
+    def test_certificate_template_triggers_exception_if_dimension_is_not_a_list(self):
+        template = {
+            'DomainName': '{svc}.example.com',
+            'ValidationDomain': self.domain_validation_options,
+            'SubjectAlternativeNames': [],
+            'Dimensions': {'svc': 'api'}
+        }
+
+        with self.assertRaises(acmagent.InvalidCertificateJsonFileException):
+            list(request.Certificate.from_template(template))
+
     def test_certificate_template_method_returns_required_structure(self):
         string = request.Certificate.template()
         certificate_template = json.loads(string)
@@ -0,0 +1,146 @@
+import unittest
+import BaseHTTPServer
+import SocketServer
+import os
+import threading
+import urllib
+import urlparse
+import acmagent
+from acmagent import confirm
+from acmagent import s3mail
+from mock import patch
+from tests.test_confirm import CertificateApprovalPageStub, CertificateApprovalFormStub, HTTP_TIMEOUT
+from tests.test_localmail import certificate_email
+
+LIST_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+<Name>{bucket}</Name><Prefix>{prefix}</Prefix><KeyCount>{count}</KeyCount><MaxKeys>1000</MaxKeys>
+<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>'''
+CONTENTS_TEMPLATE = '''<Contents><Key>{key}</Key><LastModified>{modified}</LastModified><ETag>"etag"</ETag>
+<Size>{size}</Size><StorageClass>STANDARD</StorageClass></Contents>'''
+
+
+class StubS3RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _object(self):
+        url = urlparse.urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        return bucket, urllib.unquote(key), urlparse.parse_qs(url.query)
+
+    def do_GET(self):
+        bucket, key, query = self._object()
+        objects = self.server.objects
+        if not key:
+            prefix = query.get('prefix', [''])[0]
+            keys = sorted(k for k in objects if k.startswith(prefix))
+            contents = ''.join(CONTENTS_TEMPLATE.format(key=k, modified=objects[k][0], size=len(objects[k][1]))
+                               for k in keys)
+            return self._respond(200, LIST_TEMPLATE.format(bucket=bucket, prefix=prefix, count=len(keys),
+                                                           contents=contents))
+
+        body = objects[key][1]
+        byte_range = self.headers.get('Range')
+        self.server.gets.append((key, byte_range))
+        if byte_range:
+            start, end = byte_range.split('=')[1].split('-')
+            return self._respond(206, body[int(start):int(end) + 1])
+        self._respond(200, body)
+
+    def do_PUT(self):
+        bucket, key, query = self._object()
+        source = urllib.unquote(self.headers['x-amz-copy-source']).lstrip('/').partition('/')[2]
+        self.server.objects[key] = self.server.objects[source]
+        self._respond(200, '<CopyObjectResult><ETag>"etag"</ETag>'
+                           '<LastModified>2018-01-01T00:00:00.000Z</LastModified></CopyObjectResult>')
+
+    def do_DELETE(self):
+        bucket, key, query = self._object()
+        del self.server.objects[key]
+        self._respond(204)
+
+
+class StubS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, objects):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubS3RequestHandler)
+        self.objects = objects
+        self.gets = []
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+
+@patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'stub', 'AWS_SECRET_ACCESS_KEY': 'stub'})
+class TestS3Source(unittest.TestCase):
+    def setUp(self):
+        self.certificate_id = '12345678-1234-1234-1234-123456789012'
+        self.other_certificate_id = '87654321-1234-1234-1234-123456789012'
+        self.objects = {
+            'inbound/old': ('2018-01-01T00:00:00.000Z', certificate_email(self.certificate_id, 'old.com')),
+            'inbound/new': ('2018-01-02T00:00:00.000Z', certificate_email(self.certificate_id, 'new.com')),
+            'inbound/other': ('2018-01-03T00:00:00.000Z', certificate_email(self.other_certificate_id, 'other.com')),
+            'inbound/approved/done': ('2018-01-04T00:00:00.000Z', certificate_email(self.certificate_id, 'done.com')),
+        }
+
+    def mailbox(self, server, **options):
+        mailbox = {'s3': 's3://mail/inbound/', 'region': 'us-east-1', 'endpoint_url': server.url}
+        mailbox.update(options)
+        return mailbox
+
+    def test_invalid_s3_location_is_rejected(self):
+        with self.assertRaises(acmagent.InvalidIMAPCredentailsFileException):
+            s3mail.S3Source({'s3': 'mail/inbound'})
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    def test_newest_email_is_approved_and_moved_to_approved_prefix(self, post_mock, get_mock):
+        with StubS3Server(self.objects) as server:
+            mailbox = self.mailbox(server, approved_prefix='inbound/approved/')
+            with confirm.open_mailboxes(mailbox) as confirm_certificate:
+                self.assertIsInstance(confirm_certificate._source, s3mail.S3Source)
+                self.assertTrue(confirm_certificate.confirm_certificate(self.certificate_id))
+
+        get_mock.assert_called_once_with('new.com', headers=acmagent.UserHeaders, timeout=HTTP_TIMEOUT)
+        self.assertEqual(['inbound/approved/done', 'inbound/approved/new', 'inbound/old', 'inbound/other'],
+                         sorted(self.objects))
+        scan_range = 'bytes=0-{}'.format(s3mail.S3Source.SCAN_BYTES - 1)
+        self.assertEqual([('inbound/new', scan_range), ('inbound/old', scan_range), ('inbound/other', scan_range)],
+                         sorted(get for get in server.gets if get[1]))
+        self.assertIn(('inbound/new', None), server.gets)
+
+    @patch("acmagent.confirm.requests.get", side_effect=CertificateApprovalPageStub)
+    @patch("acmagent.confirm.requests.post", side_effect=CertificateApprovalFormStub)
+    def test_objects_are_scanned_once_and_left_without_approved_prefix(self, post_mock, get_mock):
+        with StubS3Server(self.objects) as server:
+            with confirm.open_mailboxes(self.mailbox(server)) as confirm_certificate:
+                results = confirm_certificate.confirm_certificates([self.certificate_id, self.other_certificate_id])
+
+        self.assertEqual({self.certificate_id: True, self.other_certificate_id: True}, results)
+        self.assertEqual(4, len(self.objects))
+        self.assertEqual(4, len([get for get in server.gets if get[1]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from acmagent import trace
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'trace.json')
+
+    def tearDown(self):
+        trace.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_span_is_noop_when_tracer_is_not_started(self):
+        with trace.span('IMAP SEARCH', 'imap'):
+            pass
+
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_span_writes_begin_and_end_records(self):
+        trace.start(self.filename)
+        with trace.span('GET', 'http', url='test.com'):
+            pass
+        trace.stop()
+
+        with open(self.filename) as f:
+            records = json.load(f)
+
+        self.assertEqual(['B', 'E'], [record['ph'] for record in records])
+        self.assertEqual({'url': 'test.com'}, records[0]['args'])
+        self.assertTrue(records[0]['ts'] <= records[1]['ts'])
+
+    def test_nested_spans_inherit_outer_span_arguments(self):
+        trace.start(self.filename)
+        with trace.span('confirm_certificate', 'confirm', certificate_id='12345'):
+            with trace.span('fetch_message', 'confirm', message_id='1'):
+                pass
+        with trace.span('IMAP CLOSE', 'imap'):
+            pass
+        trace.stop()
+
+        with open(self.filename) as f:
+            records = json.load(f)
+
+        self.assertDictEqual({'certificate_id': '12345', 'message_id': '1'}, records[1]['args'])
+        self.assertDictEqual({}, records[-1]['args'])
+
+
+if __name__ == '__main__':
+    unittest.main()